@@ -2,17 +2,44 @@
 Dependencies for FastAPI to be used in the routers.
 """
 
-from typing import Annotated
-
-from elasticsearch import Elasticsearch
-from fastapi import Depends, HTTPException, Header
+import asyncio
+import hashlib
+import json
+import secrets
+import time
+import uuid
+from functools import lru_cache
+from typing import Annotated, Callable, Dict, List, TypeVar
+
+from elasticsearch import ConnectionTimeout, Elasticsearch
+from fastapi import Depends, HTTPException, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 
-from app.config import get_settings, Settings
+from app.config import get_settings, Settings, ElasticsearchCluster
+from app.exceptions.search import DeadlineExceededException, OverloadedException
+from app.services.cache import TTLCache, shared_store
+from app.services.cache_backends import RedisBackend, SqliteBackend
+from app.services.metrics import (registry as metrics_registry, ADMISSION_REJECTED,
+                                  ADMISSION_SEARCHES, DEPENDENCY_DURATION, ES_CONNECTIONS,
+                                  QUEUE_WAIT)
+from app.services.profiling import Profile, phase
+from app.services.mongo_monitoring import CommandMetricsListener, PoolMetricsListener
+from app.services.query_log import LoggedQuery, WARMUP_HEADER, query_log
+from app.services.search.admission import AdmissionController, AdmissionLimits
+from app.services.search.dataclasses import RequestOrigin, SearchContext
+from app.services.search.slow_log import slow_query_log
 from app.services.search.elastic_index import Index
 from app.models import Tenant, Dataset, Facet
 
+T = TypeVar("T")
+
 database_connections = {}
+# Clients for the named Elasticsearch clusters, reused across requests
+es_clusters = {}
+# Configuration documents from MongoDB, per (database, collection, query). The time to live is set
+# from the settings at startup.
+config_cache = TTLCache(maxsize=4096, ttl=30, name="config", shared=True)
 
 
 async def startup_db_client(_app) -> None:
@@ -24,28 +51,70 @@ async def startup_db_client(_app) -> None:
     settings = get_settings()
     database_connections["mongo"] = AsyncIOMotorClient(
         settings.mongo_connection,
+        event_listeners=[CommandMetricsListener(), PoolMetricsListener()],
     )
 
+def create_es_client(cluster: ElasticsearchCluster) -> Elasticsearch:
+    """
+    Create a client for an Elasticsearch cluster. Requests are spread over all nodes.
+    :param cluster:
+    :return:
+    """
+    basic_auth = None
+
+    if cluster.username is not None:
+        basic_auth = (cluster.username, cluster.password)
+
+    return Elasticsearch(
+        cluster.hosts,
+        basic_auth=basic_auth,
+        verify_certs=cluster.verify_certs,
+        connections_per_node=cluster.connections_per_node,
+        sniff_on_start=cluster.sniff_on_start,
+        sniff_on_node_failure=cluster.sniff_on_node_failure,
+        min_delay_between_sniffing=cluster.min_delay_between_sniffing,
+    )
+
+
 async def startup_es_client(_app) -> None:
     """
-    Init the Elasticsearch connection.
+    Init the Elasticsearch connections, for the default cluster and the named clusters.
     :param _app:
     :return:
     """
     settings = get_settings()
 
-    basic_auth = None
+    slow_query_log.threshold = settings.slow_query_threshold
+    slow_query_log.sample_rate = settings.slow_query_sample_rate
 
-    if settings.es_username is not None:
-        basic_auth = (settings.es_username, settings.es_password)
+    database_connections["elastic"] = create_es_client(settings.default_es_cluster())
+    for name, cluster in settings.es_clusters.items():
+        es_clusters[name] = create_es_client(cluster)
 
-    database_connections["elastic"] = Elasticsearch([{
-        "scheme": settings.es_scheme,
-        "host": settings.es_host,
-        "port": settings.es_port,
 
-    }], basic_auth=basic_auth
-    , verify_certs=False)
+async def startup_cache(_app) -> None:
+    """
+    Configure the caches, and the backend sharing cache entries between the workers.
+    :param _app:
+    :return:
+    """
+    settings = get_settings()
+    config_cache.ttl = settings.config_cache_ttl
+    if settings.cache_backend == "sqlite":
+        shared_store.configure(SqliteBackend(settings.cache_path))
+    elif settings.cache_backend == "redis":
+        shared_store.configure(RedisBackend(settings.cache_redis_url, settings.cache_timeout))
+    else:
+        shared_store.configure(None)
+
+
+async def shutdown_cache(_app) -> None:
+    """
+    Close the connections to the shared cache backend.
+    :param _app:
+    :return:
+    """
+    shared_store.configure(None)
 
 
 async def shutdown_db_client(_app) -> None:
@@ -63,10 +132,46 @@ async def shutdown_es_client(_app) -> None:
     :return:
     """
     database_connections["elastic"].close()
+    for client in es_clusters.values():
+        client.close()
+    es_clusters.clear()
 
 
 SettingsDep = Annotated[Settings, Depends(get_settings)]
 
+
+def is_admin_token(token: str | None) -> bool:
+    """
+    Check whether a token is the admin token. Without a configured admin token, nobody is admin.
+    :param token:
+    :return:
+    """
+    admin_token = get_settings().admin_token
+    if not admin_token or not token:
+        return False
+    return secrets.compare_digest(token.encode(), admin_token.encode())
+
+
+def verify_admin(x_admin_token: Annotated[str | None, Header()] = None) -> None:
+    """
+    Only allow requests with the admin token in the X-Admin-Token header.
+    :param x_admin_token:
+    :return:
+    """
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+AdminDep = Annotated[None, Depends(verify_admin)]
+
+
+def request_profile(request: Request) -> Profile | None:
+    """
+    Get the profile of the current request, if it is being profiled.
+    :param request:
+    :return:
+    """
+    return getattr(request.state, "profile", None)
+
 def get_main_db() -> AsyncIOMotorDatabase:
     """
     Get the main database, which contains information about the tenants using the app.
@@ -78,18 +183,45 @@ def get_main_db() -> AsyncIOMotorDatabase:
 MainDbDep = Annotated[AsyncIOMotorClient, Depends(get_main_db)]
 
 
-async def get_tenant(main_db: MainDbDep, host: Annotated[str | None, Header()] = None) -> Tenant:
+async def find_config(db: AsyncIOMotorDatabase, collection: str, query: Dict,
+                      sort: str | None = None) -> List[Dict]:
+    """
+    Find configuration documents, like datasets and facets. The documents are cached, and shared
+    with the other workers; invalidate the cache of the tenant (the name of the database) after
+    changing them. The documents should not be modified.
+    :param db:
+    :param collection:
+    :param query:
+    :param sort: Field to sort the documents by
+    :return:
+    """
+    key = (db.name, collection, json.dumps(query, sort_keys=True), sort)
+    documents = await config_cache.aget(key)
+    if documents is None:
+        cursor = db[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        documents = await cursor.to_list()
+        await config_cache.aset(key, documents)
+    return documents
+
+
+async def get_tenant(request: Request, main_db: MainDbDep,
+                     host: Annotated[str | None, Header()] = None) -> Tenant:
     """
     Get information about the current tenant, based on the domain name used to access the app.
+    :param request:
     :param main_db:
     :param host:
     :return:
     """
-    domain = host.split(":")[0]
-    tenant = await main_db['tenants'].find_one({'domain': domain})
-    if not tenant:
-        raise HTTPException(status_code=404, detail="Domain name not known")
-    return Tenant(**tenant)
+    with phase(request_profile(request), "get_tenant"):
+        domain = host.split(":")[0]
+        tenants = await find_config(main_db, 'tenants', {'domain': domain})
+        if not tenants:
+            raise HTTPException(status_code=404, detail="Domain name not known")
+        request.state.tenant = tenants[0]['name']
+        return Tenant(**tenants[0])
 
 
 TenantDep = Annotated[Tenant, Depends(get_tenant)]
@@ -107,35 +239,255 @@ def get_tenant_db(tenant: TenantDep) -> AsyncIOMotorDatabase:
 TenantDbDep = Annotated[AsyncIOMotorClient, Depends(get_tenant_db)]
 
 
-async def get_dataset(tenant_db: TenantDbDep, dataset_name: str) -> Dataset:
+async def get_dataset(request: Request, tenant_db: TenantDbDep, dataset_name: str) -> Dataset:
     """
     Get the dataset which is being used.
+    :param request:
     :param tenant_db:
     :param dataset_name:
     :return:
     """
-    dataset = await tenant_db['datasets'].find_one({'name': dataset_name})
-    if not dataset:
-        raise HTTPException(status_code=404, detail="Dataset not found")
-    return Dataset(**dataset)
+    with phase(request_profile(request), "get_dataset"):
+        datasets = await find_config(tenant_db, 'datasets', {'name': dataset_name})
+        if not datasets:
+            raise HTTPException(status_code=404, detail="Dataset not found")
+        request.state.dataset = datasets[0]['name']
+        return Dataset(**datasets[0])
 
 DatasetDep = Annotated[Dataset, Depends(get_dataset)]
 
 
-async def get_es_index(dataset: DatasetDep, db: TenantDbDep) -> Index:
+async def log_query(request: Request, tenant: TenantDep, dataset: DatasetDep):
     """
-    Get the Elasticsearch index for the current dataset.
-    :param db:
+    Count the request in the query log, so the caches can be warmed up with frequent requests.
+    Requests are only counted when they succeed; failing requests (like requests over the cost
+    limits) raise an exception at the yield. Requests of the warm-up itself and profiled requests
+    are not counted.
+    :param request:
+    :param tenant:
     :param dataset:
     :return:
     """
-    cursor = db['facets'].find({
-        "dataset_name": dataset.name
-    })
+    if WARMUP_HEADER in request.headers or "profile" in request.query_params:
+        yield
+        return
+    body = await request.body()
+    yield
+    query_log.record(LoggedQuery(
+        tenant=tenant.name,
+        dataset_name=dataset.name,
+        method=request.method,
+        path=request.url.path,
+        query_string=request.url.query,
+        body=body.decode(errors="replace"),
+    ))
+
+QueryLogDep = Annotated[None, Depends(log_query)]
+
+
+def get_es_client(cluster: str | None = None) -> Elasticsearch:
+    """
+    Get the client for an Elasticsearch cluster.
+    :param cluster: Name of the cluster, or None for the default cluster
+    :return:
+    """
+    if cluster is None:
+        return database_connections["elastic"]
+    if cluster not in es_clusters:
+        raise HTTPException(status_code=500, detail="Unknown Elasticsearch cluster")
+    return es_clusters[cluster]
+
+
+@lru_cache
+def get_admission_controller() -> AdmissionController:
+    """
+    Admission controller shared by all searches in this process.
+    :return:
+    """
+    settings = get_settings()
+    return AdmissionController(AdmissionLimits(
+        concurrency=settings.admission_concurrency,
+        tenant_concurrency=settings.admission_tenant_concurrency,
+        dataset_concurrency=settings.admission_dataset_concurrency,
+        queue_depth=settings.admission_queue_depth,
+        max_wait=settings.admission_max_wait,
+    ))
+
+AdmissionControllerDep = Annotated[AdmissionController, Depends(get_admission_controller)]
+
+
+async def admit_search(tenant: TenantDep, dataset: DatasetDep, response: Response,
+                       controller: AdmissionControllerDep):
+    """
+    Wait for a search slot for the current tenant and dataset, and release it when the request is
+    done. Responds with 429 if there are too many searches waiting.
+    :param tenant:
+    :param dataset:
+    :param response:
+    :param controller:
+    :return:
+    """
+    try:
+        waited = await controller.acquire(tenant.name, dataset.name, tenant.weight)
+    except OverloadedException as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)}) from e
+    response.headers["X-Queue-Wait"] = f"{waited * 1000:.0f}"
+    QUEUE_WAIT.observe(tenant.name, value=waited)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        controller.release(tenant.name, dataset.name, time.monotonic() - started)
+
+AdmissionDep = Annotated[None, Depends(admit_search)]
+
+
+def get_search_context(request: Request, settings: SettingsDep, tenant: TenantDep,
+                       x_session_id: Annotated[str | None, Header()] = None) -> SearchContext:
+    """
+    Get information about the current request for searching. Searches from the same session
+    (identified by the X-Session-Id header, or else the client address) prefer the same shards.
+    The deadline of the searches depends on the endpoint.
+    :param request:
+    :param settings:
+    :param tenant:
+    :param x_session_id:
+    :return:
+    """
+    session = x_session_id or (request.client.host if request.client else None)
+    preference = hashlib.sha256(session.encode()).hexdigest()[:16] if session else None
+    route = request.scope.get("route")
+    deadline = settings.request_deadlines.get(getattr(route, "name", None),
+                                              settings.request_deadline)
+    return SearchContext(
+        preference=preference,
+        deadline=time.monotonic() + deadline,
+        opaque_id=uuid.uuid4().hex,
+        profile=request_profile(request),
+        origin=RequestOrigin(
+            tenant=tenant.name,
+            dataset=request.path_params.get("dataset_name"),
+            endpoint=getattr(route, "name", None),
+        ),
+    )
 
-    facets_raw = await cursor.to_list()
+SearchContextDep = Annotated[SearchContext, Depends(get_search_context)]
 
-    facets = [Facet(**facet) for facet in facets_raw]
-    return Index(database_connections["elastic"], dataset.es_index, facets)
+
+async def get_es_index(dataset: DatasetDep, db: TenantDbDep, context: SearchContextDep,
+                       _admission: AdmissionDep) -> Index:
+    """
+    Get the Elasticsearch index for the current dataset. Searches on the index are subject to
+    admission control.
+    :param db:
+    :param dataset:
+    :param context:
+    :param _admission:
+    :return:
+    """
+    with context.phase("get_es_index"):
+        facets_raw = await find_config(db, 'facets', {"dataset_name": dataset.name})
+
+        facets = [Facet(**facet) for facet in facets_raw]
+        es_index = Index(get_es_client(dataset.es_cluster), dataset.es_index, facets,
+                         dataset.search_configuration)
+        es_index.context = context
+        es_index.cluster = dataset.es_cluster
+        return es_index
 
 ElasticIndexDep = Annotated[Index, Depends(get_es_index)]
+
+
+class SearchRunner:
+    """
+    Runs searches on the index of the current dataset in the threadpool. When the client
+    disconnects, the searches are cancelled in Elasticsearch. Partial results are flagged with the
+    X-Partial-Results header.
+    """
+    index: Index
+
+    def __init__(self, index: Index, request: Request, response: Response):
+        self.index = index
+        self.request = request
+        self.response = response
+
+    async def wait_for_disconnect(self):
+        """
+        Wait until the client disconnects. The request body should have been read already.
+        :return:
+        """
+        while (await self.request.receive())["type"] != "http.disconnect":
+            pass
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """
+        Run a function searching the index.
+        :param func:
+        :param args:
+        :return:
+        """
+        search = asyncio.ensure_future(run_in_threadpool(func, *args))
+        disconnect = asyncio.ensure_future(self.wait_for_disconnect())
+        try:
+            await asyncio.wait({search, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+
+        if not search.done():
+            # Nobody is waiting for the result anymore, so stop wasting cluster resources on it
+            search.add_done_callback(lambda task: task.exception())
+            self.index.cancel()
+            raise HTTPException(status_code=499, detail="Client closed request")
+
+        try:
+            result = search.result()
+        except (DeadlineExceededException, ConnectionTimeout) as e:
+            raise HTTPException(status_code=504, detail="Search timed out") from e
+        if self.index.context.partial:
+            self.response.headers["X-Partial-Results"] = "true"
+        return result
+
+
+def get_search_runner(es_index: ElasticIndexDep, request: Request,
+                      response: Response) -> SearchRunner:
+    """
+    Get a runner for searches on the index of the current dataset.
+    :param es_index:
+    :param request:
+    :param response:
+    :return:
+    """
+    started = getattr(request.state, "started", None)
+    if started is not None:
+        DEPENDENCY_DURATION.observe(getattr(request.scope.get("route"), "path", ""),
+                                    value=time.monotonic() - started)
+    return SearchRunner(es_index, request, response)
+
+
+def collect_connection_metrics():
+    """
+    Update the metrics of the Elasticsearch connection pools and admission control.
+    :return:
+    """
+    clients = dict(es_clusters)
+    if "elastic" in database_connections:
+        clients["default"] = database_connections["elastic"]
+    for cluster, client in clients.items():
+        for node in client.transport.node_pool.all():
+            # The urllib3 pool holds a slot for every connection which is not in use
+            pool = getattr(node, "pool", None)
+            if pool is None or not hasattr(pool, "pool"):
+                continue
+            ES_CONNECTIONS.set(cluster, node.base_url, "max", value=pool.pool.maxsize)
+            ES_CONNECTIONS.set(cluster, node.base_url, "in_use",
+                               value=pool.pool.maxsize - pool.pool.qsize())
+
+    for tenant, statistics in get_admission_controller().statistics().items():
+        ADMISSION_SEARCHES.set(tenant, "running", value=statistics.running)
+        ADMISSION_SEARCHES.set(tenant, "queued", value=statistics.queued)
+        ADMISSION_REJECTED.set(tenant, value=statistics.rejected)
+
+metrics_registry.add_collector(collect_connection_metrics)
+
+SearchRunnerDep = Annotated[SearchRunner, Depends(get_search_runner)]
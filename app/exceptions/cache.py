@@ -0,0 +1,10 @@
+"""
+Errors of the caches.
+"""
+
+
+class CacheBackendException(Exception):
+    """
+    This error occurs when a shared cache backend cannot be reached or fails. Caches treat it as a
+    miss, so requests do not fail when the backend is unavailable.
+    """
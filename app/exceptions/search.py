@@ -14,3 +14,33 @@ class UnknownFacetsException(Exception):
     def __init__(self, message: str, facets: List[str]):
         super().__init__(message)
         self.facets = facets
+
+
+class OverloadedException(Exception):
+    """
+    This error occurs when there are too many searches waiting to be executed.
+    """
+    retry_after: int
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceededException(Exception):
+    """
+    This error occurs when the deadline of a request passed before a search could be executed.
+    """
+
+
+class QueryCostException(Exception):
+    """
+    This error occurs when a request exceeds a limit of the cost policy of a dataset.
+    """
+    limit: str
+    maximum: int
+
+    def __init__(self, message: str, limit: str, maximum: int):
+        super().__init__(message)
+        self.limit = limit
+        self.maximum = maximum
@@ -3,30 +3,77 @@ FastAPI setup.
 """
 
 from contextlib import asynccontextmanager
+import asyncio
+import logging
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
+from app.config import get_settings
 from app.dependencies import (startup_es_client, shutdown_es_client, startup_db_client,
-                              shutdown_db_client)
+                              shutdown_db_client, startup_cache, shutdown_cache,
+                              database_connections)
+from app.exceptions.search import QueryCostException
+from app.middleware import MemoryMiddleware, MetricsMiddleware, ProfilingMiddleware
+from app.services.metrics import registry
+from app.services.query_log import query_log
+from app.services.warmup import warmer
+from .routers.admin import router as admin_router
 from .routers.datasets import router as datasets_router, datasets_router as datasets_list_router
 
+logger = logging.getLogger(__name__)
+
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
     """
-    Manage database and elasticsearch lifecycle.
+    Manage database, elasticsearch and shared cache lifecycle, warm up the caches in the
+    background and periodically flush the query log.
     :param application:
     :return:
     """
     await startup_db_client(application)
     await startup_es_client(application)
+    await startup_cache(application)
+    settings = get_settings()
+    query_log.max_entries = settings.query_log_size
+    flusher = asyncio.create_task(query_log.run(database_connections["mongo"],
+                                                settings.query_log_flush_interval,
+                                                settings.query_log_ttl))
+    if settings.warmup_enabled:
+        warmup = asyncio.create_task(warmer.run(application, settings))
+    else:
+        warmer.ready = True
     yield
+    if settings.warmup_enabled:
+        warmup.cancel()
+    flusher.cancel()
+    try:
+        await query_log.flush(database_connections["mongo"], settings.query_log_ttl)
+    except Exception: # pylint: disable=broad-exception-caught
+        logger.exception("Flushing the query log failed")
     await shutdown_db_client(application)
     await shutdown_es_client(application)
+    await shutdown_cache(application)
 
 app = FastAPI(lifespan=lifespan)
 
+@app.exception_handler(QueryCostException)
+async def query_cost_exception_handler(_request: Request, exc: QueryCostException):
+    """
+    Reject queries exceeding the cost limits of the dataset.
+    :param _request:
+    :param exc:
+    :return:
+    """
+    return JSONResponse(status_code=400, content={"detail": {
+        "error": "query_too_expensive",
+        "message": str(exc),
+        "limit": exc.limit,
+        "maximum": exc.maximum
+    }})
+
 @app.get("/health")
 def health_check():
     """
@@ -35,6 +82,26 @@ def health_check():
     """
     return {"status": "ok"}
 
+@app.get("/ready")
+def readiness_check():
+    """
+    Readiness check endpoint for Kubernetes: the process is ready to receive traffic when the
+    caches are warmed up.
+    :return:
+    """
+    if not warmer.ready:
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return {"status": "ready"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Metrics in the Prometheus text format.
+    :return:
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+app.include_router(admin_router)
 app.include_router(datasets_list_router)
 app.include_router(datasets_router)
 
@@ -45,3 +112,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MemoryMiddleware)
+app.add_middleware(MetricsMiddleware)
@@ -0,0 +1,165 @@
+"""
+ASGI middleware.
+"""
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+from app.config import get_settings
+from app.dependencies import is_admin_token
+from app.services.memory import memory_profiler
+from app.services.metrics import REQUEST_DURATION, RESPONSE_SIZE
+from app.services.profiling import Profile
+
+# Profiles of requests are written to this log
+trace_logger = logging.getLogger("app.trace")
+
+
+class MetricsMiddleware:
+    """
+    Records the duration of every request, by route, tenant and dataset. The start time is stored
+    in the request state (request.state.started), so dependencies can measure from it as well.
+    Only datasets which were found are used as label, so unknown names do not add label values.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        state = scope.setdefault("state", {})
+        state["started"] = started
+        status = 500
+        size = 0
+
+        async def send_with_status(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            RESPONSE_SIZE.observe(route, value=size)
+            REQUEST_DURATION.observe(
+                scope["method"],
+                route,
+                str(status),
+                state.get("tenant", ""),
+                dataset_label(scope, state),
+                value=time.monotonic() - started,
+            )
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests with the profile query parameter, if they have the admin token (X-Admin-Token
+    header). The durations of the phases are returned in the Server-Timing header, and the complete
+    profile, including the query profiles of Elasticsearch, is written to the trace log.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        if not is_admin_token(Headers(scope=scope).get("x-admin-token")):
+            response = JSONResponse({"detail": "Admin token required for profiling"},
+                                    status_code=403)
+            await response(scope, receive, send)
+            return
+
+        profile = Profile()
+        scope.setdefault("state", {})["profile"] = profile
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                now = time.monotonic()
+                # Everything after the last measured phase is mostly serializing the response
+                profile.add_phase("serialization", profile.last_end(), now)
+                profile.add_phase("total", profile.started, now)
+                MutableHeaders(scope=message).append("Server-Timing", profile.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            trace_logger.info(json.dumps({
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                **profile.to_dict(),
+            }, default=str))
+
+
+class MemoryMiddleware:
+    """
+    Records the peak allocation and response size of requests to the endpoints configured in
+    memory_profile_endpoints, while allocations are being traced.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not memory_profiler.tracing():
+            await self.app(scope, receive, send)
+            return
+
+        started = memory_profiler.request_started()
+        size = 0
+
+        async def send_with_size(message):
+            nonlocal size
+            if message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_size)
+        finally:
+            # The route is only known after routing, so every request is measured
+            endpoint = getattr(scope.get("route"), "name", None)
+            if endpoint not in get_settings().memory_profile_endpoints:
+                endpoint = None
+            memory_profiler.request_done(started, endpoint, size)
+
+
+def dataset_label(scope, state) -> str:
+    """
+    Get the dataset label of a request: the dataset found by the get_dataset dependency, or
+    "unknown" if the route has a dataset which was not found.
+    :param scope:
+    :param state:
+    :return:
+    """
+    if "dataset" in state:
+        return state["dataset"]
+    return "unknown" if "dataset_name" in scope.get("path_params", {}) else ""
+
+
+def wants_profile(scope) -> bool:
+    """
+    Check whether profiling was requested with the profile query parameter.
+    :param scope:
+    :return:
+    """
+    if b"profile" not in scope.get("query_string", b""):
+        return False
+    values = parse_qs(scope["query_string"].decode("latin-1")).get("profile", [])
+    return any(value.lower() in ("1", "true", "yes") for value in values)
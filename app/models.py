@@ -3,11 +3,13 @@ Data models for use with the database.
 """
 from abc import ABC
 from dataclasses import dataclass
+from datetime import datetime
 from enum import Enum
-from typing import Optional, Annotated, Dict
+import math
+from typing import Optional, Annotated, Dict, List
 
 import jsonpath
-from pydantic import BaseModel, BeforeValidator, Field
+from pydantic import BaseModel, BeforeValidator, Field, model_validator
 
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model so that it can be serialized to JSON.
@@ -20,6 +22,8 @@ class Tenant(BaseModel):
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
     name: str
     domain: str
+    # Share of the search capacity when tenants compete for it
+    weight: float = 1.0
 
 
 @dataclass
@@ -39,6 +43,112 @@ class DataConfiguration:
         return self.auth is not None
 
 
+class HighlighterType(Enum):
+    """
+    Highlighter implementation used by Elasticsearch
+    """
+    UNIFIED = 'unified'
+    PLAIN = 'plain'
+    FVH = 'fvh' # Requires term vectors with positions and offsets in the mapping
+
+
+class HighlightConfiguration(BaseModel):
+    """
+    Configuration for highlighting search results
+    """
+    fields: List[str] = ["*"]
+    type: Optional[HighlighterType] = None
+    fragment_size: int = 100
+    number_of_fragments: int = 1
+    # Stop analyzing large text fields after this many characters
+    max_analyzed_offset: Optional[int] = None
+
+
+class SamplingMethod(Enum):
+    """
+    How to sample documents for approximate facet counts
+    """
+    RANDOM = 'random' # Random sample of all documents
+    SAMPLER = 'sampler' # Top documents per shard
+    DIVERSIFIED = 'diversified' # Top documents per shard, limiting documents with the same value
+
+
+class SamplingConfiguration(BaseModel):
+    """
+    Configuration for approximating facet counts using a sample of the documents
+    """
+    enabled: bool = False
+    method: SamplingMethod = SamplingMethod.RANDOM
+    probability: float = 0.1 # For random sampling, at most 0.5 (or exactly 1)
+    shard_size: int = 1000 # For (diversified) sampler
+    diversify_field: Optional[str] = None # For diversified sampler
+
+
+class CostPolicy(BaseModel):
+    """
+    Limits on the cost of search and facet requests
+    """
+    # Reduce page sizes, facet amounts and short prefixes to the limit instead of rejecting. The
+    # response does not tell the client, so only enable it for clients which do not rely on it.
+    degrade: bool = False
+    max_page_size: int = 100
+    max_result_window: int = 10000 # Maximum offset plus page size
+    max_facet_amount: int = 1000 # Maximum amount of options of a facet
+    max_tree_buckets: int = 10000 # Maximum amount of options for building a tree
+    max_filter_values: int = 100 # Maximum amount of selected facet values
+    max_facet_filter_length: int = 100
+    max_query_length: int = 1000
+    min_prefix_length: int = 2 # Minimum length of prefix queries (like abc*) in the text query
+    # Operators allowed in the text query (flags of the simple_query_string query). All of them
+    # by default; leave out FUZZY, NEAR and SLOP to disallow the more expensive ~ syntax.
+    query_operators: List[str] = [
+        "AND", "OR", "NOT", "PHRASE", "PRECEDENCE", "ESCAPE", "WHITESPACE", "PREFIX", "FUZZY",
+        "NEAR", "SLOP"
+    ]
+
+
+class SearchField(BaseModel):
+    """
+    A field the text query searches in
+    """
+    field: str # Can also be a catch-all field the mapping copies other fields to
+    boost: float = 1.0
+
+
+class SuggestionType(Enum):
+    """
+    How suggestions for the text query are taken from a field
+    """
+    COMPLETION = 'completion' # Field of type completion, using the completion suggester
+    SEARCH_AS_YOU_TYPE = 'search_as_you_type' # Field of type search_as_you_type
+
+
+class SuggestField(BaseModel):
+    """
+    A field suggestions for the text query are taken from
+    """
+    field: str
+    type: SuggestionType = SuggestionType.SEARCH_AS_YOU_TYPE
+    # Keyword field with the values to suggest, for search_as_you_type fields. Defaults to the
+    # keyword subfield (<field>.keyword).
+    value_field: Optional[str] = None
+
+
+class SearchConfiguration(BaseModel):
+    """
+    Configuration for searching in the index of a dataset
+    """
+    highlight: HighlightConfiguration = Field(default_factory=HighlightConfiguration)
+    # Count the hits exactly (true), up to a threshold (number) or not at all (false)
+    track_total_hits: bool | int = True
+    sampling: SamplingConfiguration = Field(default_factory=SamplingConfiguration)
+    cost: CostPolicy = Field(default_factory=CostPolicy)
+    # Fields the text query searches in. Searches in all fields if empty.
+    fields: List[SearchField] = []
+    # Fields suggestions for the text query are taken from. No suggestions if empty.
+    suggest: List[SuggestField] = []
+
+
 class Dataset(BaseModel):
     """
     Represents a dataset belonging to a tenant
@@ -47,10 +157,12 @@ class Dataset(BaseModel):
     tenant_name: str
     name: str
     es_index: str
+    es_cluster: Optional[str] = None # Name of the Elasticsearch cluster, if not the default
     data_type: str
     data_configuration: Dict[str, str | Dict]
     metadata: Dict[str, str | Dict]
     detail_id: str # Field that determines the ID of an item
+    search_configuration: SearchConfiguration = Field(default_factory=SearchConfiguration)
 
     def get_config(self) -> DataConfiguration:
         """
@@ -82,9 +194,31 @@ class Facet(BaseModel):
     name: str # Readable name
     type: FacetType
     order: int = 0
-    interval: int | str | None = None
+    # Numeric for histogram facets, like 1y or 3M for date facets
+    interval: int | float | str | None = None
+    buckets: Optional[int] = None # Target amount of buckets if there is no fixed interval
     tree_separator: Optional[str] = '|'
     start_open: bool = False
+    # Keyword subfield with a lowercase/asciifolding normalizer, used for filtering the options
+    filter_property: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_interval(self) -> "Facet":
+        """
+        Convert the interval of a histogram facet to a number, as it may be stored as a string.
+        :return:
+        """
+        if self.type != FacetType.HISTOGRAM or self.interval is None:
+            return self
+        try:
+            interval = float(self.interval)
+        except ValueError:
+            interval = math.nan
+        if not math.isfinite(interval) or interval <= 0:
+            raise ValueError(f"Interval of histogram facet {self.property} is not a positive "
+                             f"number: {self.interval!r}")
+        self.interval = int(interval) if interval.is_integer() else interval
+        return self
 
 
 class BaseProperty(ABC):
@@ -106,6 +240,14 @@ class BaseProperty(ABC):
         """
         return self.path
 
+    def references(self, field: str) -> bool:
+        """
+        Whether the jsonpath of this property refers to the given field.
+        :param field:
+        :return:
+        """
+        return field in self.path
+
 
     def render_value(self, item_data: Dict):
         """
@@ -129,3 +271,41 @@ class DetailProperty(BaseModel, BaseProperty):
     Represents a property to show in the detail view.
     """
     type: str
+
+
+class JobStatus(Enum):
+    """
+    Status of a background job
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    RETRYING = 'retrying'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+
+class JobProgress(BaseModel):
+    """
+    Progress of a background job: the current step, and how much of it is done.
+    """
+    step: str = "queued"
+    done: int = 0
+    total: Optional[int] = None
+
+
+class Job(BaseModel):
+    """
+    Represents a background job, like rebuilding the tree of a facet. While a job is queued or
+    running, other jobs of the same type for the same target are not started.
+    """
+    id: str = Field(alias="_id")
+    type: str
+    dataset_name: str
+    target: str # Name of the facet the job is for
+    status: JobStatus = JobStatus.QUEUED
+    progress: JobProgress = JobProgress()
+    attempts: int = 0
+    error: Optional[str] = None
+    created: datetime
+    updated: datetime
+    finished: Optional[datetime] = None
@@ -0,0 +1,128 @@
+"""
+API endpoints for administrators, for inspecting the behaviour of the service. All endpoints need
+the admin token in the X-Admin-Token header.
+"""
+from dataclasses import asdict
+
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from starlette.concurrency import run_in_threadpool
+
+from app.dependencies import config_cache, verify_admin
+from app.services.cache import named_caches
+from app.services.memory import memory_profiler, process_memory
+from app.services.search.facet_values import facet_value_registry
+from app.services.search.slow_log import slow_query_log
+
+router = APIRouter(
+    prefix="/api/admin",
+    tags=["admin"],
+    dependencies=[Depends(verify_admin)],
+)
+
+
+@router.get("/slow-queries")
+def get_slow_queries(amount: int = 20):
+    """
+    Get the shapes of the slow Elasticsearch requests which cost the most time in total.
+    :param amount: Query param: amount of request shapes
+    :return:
+    """
+    return {
+        "threshold": slow_query_log.threshold,
+        "shapes": [asdict(shape) for shape in slow_query_log.worst(amount)],
+    }
+
+
+@router.delete("/slow-queries", status_code=status.HTTP_204_NO_CONTENT)
+def clear_slow_queries():
+    """
+    Forget the statistics of the slow requests.
+    :return:
+    """
+    slow_query_log.clear()
+
+
+@router.post("/cache/invalidate", status_code=status.HTTP_204_NO_CONTENT)
+async def invalidate_caches(tenant: str | None = None):
+    """
+    Invalidate the cached configuration of a tenant, for example after changing its datasets or
+    facets, or all cached entries. Entries shared between the workers are invalidated for all
+    workers, which notice within a second.
+    :param tenant: Query param: only invalidate the configuration of this tenant
+    :return:
+    """
+    if tenant is not None:
+        await run_in_threadpool(config_cache.invalidate, tenant)
+        await run_in_threadpool(config_cache.invalidate, "main")
+        return
+    for cache in named_caches:
+        await run_in_threadpool(cache.invalidate)
+
+
+@router.get("/memory")
+def get_memory(caches: bool = True):
+    """
+    Get the memory usage of the worker: the resident set size, the traced allocations and the
+    peak allocation of requests per endpoint (while tracing), and the sizes of the caches.
+    :param caches: Query param: include the sizes of the caches, which takes a while for large
+        caches
+    :return:
+    """
+    result = {
+        **process_memory(),
+        "tracing": memory_profiler.tracing(),
+        "endpoints": {endpoint: asdict(statistics)
+                      for endpoint, statistics in memory_profiler.endpoints.items()},
+        "caches": None,
+    }
+    if caches:
+        result["caches"] = {
+            cache.name: {
+                "entries": len(cache),
+                "maxsize": cache.maxsize,
+                "size": cache.memory_usage(),
+            }
+            for cache in named_caches
+        }
+        result["caches"]["facet_values"] = {
+            "entries": len(facet_value_registry),
+            "maxsize": None,
+            "size": facet_value_registry.memory_usage(),
+        }
+    return result
+
+
+@router.post("/memory/tracing", status_code=status.HTTP_204_NO_CONTENT)
+def start_tracing(frames: int = Query(default=1, ge=1, le=50)):
+    """
+    Start tracing allocations. Restarting forgets the previous snapshot and peaks.
+    :param frames: Query param: amount of frames stored per allocation
+    :return:
+    """
+    memory_profiler.start(frames)
+
+
+@router.delete("/memory/tracing", status_code=status.HTTP_204_NO_CONTENT)
+def stop_tracing():
+    """
+    Stop tracing allocations.
+    :return:
+    """
+    memory_profiler.stop()
+
+
+@router.post("/memory/snapshots")
+def take_snapshot(group_by: Literal["lineno", "filename", "traceback"] = "lineno",
+                  limit: int = Query(default=20, ge=1), app_only: bool = False):
+    """
+    Take a snapshot of the traced allocations, and compare it with the previous snapshot.
+    :param group_by: Query param: group the allocations by line, file or traceback
+    :param limit: Query param: amount of allocations to return
+    :param app_only: Query param: only count allocations made by the code of the application
+    :return:
+    """
+    if not memory_profiler.tracing():
+        raise HTTPException(status_code=409, detail="Allocations are not being traced")
+    return memory_profiler.snapshot(group_by, limit, app_only)
@@ -1,27 +1,34 @@
 """
 API endpoints for dealing with a dataset.
 """
-from typing import Dict, List, Optional
+from typing import Annotated, Dict, List, Optional
 from urllib.parse import urlparse
+import asyncio
 import logging
 import math
 
-import boto3
-from fastapi import APIRouter, HTTPException, BackgroundTasks, status
-from pydantic import BaseModel, model_serializer
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
+from pydantic import BaseModel, Field, model_serializer
 
-from app.dependencies import DatasetDep, TenantDbDep, ElasticIndexDep
+from app.dependencies import (DatasetDep, TenantDep, TenantDbDep, SearchRunnerDep, QueryLogDep,
+                              find_config, request_profile)
 from app.exceptions.search import UnknownFacetsException
-from app.models import Facet, DetailProperty, ResultProperty, FacetType
+from app.models import Facet, DetailProperty, ResultProperty, FacetType, Job
 from app.services.search.elastic_index import FilterOptions
+from app.services.search.suggest import get_suggestions
 from app.services.datasets.connectors import DatasetConnectorDep
-from app.tasks.tree_facets import construct_tree
+from app.services.datasets.s3 import signed_url
+from app.services.profiling import phase
+from app.tasks.jobs import get_job, submit_job
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)-5s %(name)s - %(message)s",
                     datefmt="%Y-%m-%d %H:%M:%S")
 logger = logging.getLogger(__name__)
 
+# Maximum amount of suggestions per request
+MAX_SUGGESTIONS = 25
+
 router = APIRouter(
     prefix="/api/datasets/{dataset_name}",
     tags=["datasets"]
@@ -67,8 +74,18 @@ class BrowseRequestBody(BaseModel):
     """
     Request body for searching in a dataset.
     """
-    offset: int = 0
-    limit: int = 10
+    offset: int = Field(0, ge=0)
+    limit: int = Field(10, ge=1)
+    facets: Dict[str, list]
+    query: str = ""
+    # Overrides the track_total_hits setting of the dataset
+    track_total_hits: Optional[bool | int] = None
+
+
+class CountRequestBody(BaseModel):
+    """
+    Request body for counting the results of a search.
+    """
     facets: Dict[str, list]
     query: str = ""
 
@@ -107,32 +124,28 @@ async def resolve(dataset: DatasetDep, request: ResolveRequestBody):
     path = parsed.path.lstrip('/')
     logger.info("Resolved bucket: %s, path: %s", bucket, path)
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=config['s3_key_id'],
-        aws_secret_access_key=config['s3_secret'],
-        endpoint_url=config['s3_endpoint']
-    )
-    url = s3.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={'Bucket': bucket, 'Key': path},
-        ExpiresIn=3600
-    )
+    url = signed_url(config, bucket, path)
     logger.info("Created signed url: %s", url)
     return {
         "url": url
     }
 
 @router.post("/search")
-async def browse(es_index: ElasticIndexDep, struc: BrowseRequestBody, db: TenantDbDep,
-                 dataset: DatasetDep):
+async def browse(runner: SearchRunnerDep, struc: BrowseRequestBody, db: TenantDbDep,
+                 dataset: DatasetDep, _query_log: QueryLogDep):
     """
     Search for articles using elasticsearch.
     :return:
     """
+    properties = await find_config(db, 'result_properties', {"dataset_name": dataset.name},
+                                   sort="order")
+    properties = [ResultProperty(**data) for data in properties]
+
     filter_options = FilterOptions(facets=struc.facets, query=struc.query)
+    highlight = any(prop.references("_highlight") for prop in properties)
     try:
-        search_results = es_index.browse(struc.offset, struc.limit, filter_options)
+        search_results = await runner.run(runner.index.browse, struc.offset, struc.limit,
+                                          filter_options, highlight, struc.track_total_hits)
     except UnknownFacetsException as e:
         raise HTTPException(status_code=400, detail={
             "error": "unknown_facets",
@@ -140,20 +153,64 @@ async def browse(es_index: ElasticIndexDep, struc: BrowseRequestBody, db: Tenant
             "facets": e.facets
         }) from e
 
-    cursor = db.result_properties.find({
-        "dataset_name": dataset.name
-    }).sort("order")
-
-    properties = await cursor.to_list()
-    properties = [ResultProperty(**data) for data in properties]
+    with runner.index.context.phase("post_processing"):
+        items = search_results.format_results(properties)
 
     return {
         "amount": search_results.total_results,
+        "amountRelation": search_results.total_relation,
+        "partial": runner.index.context.partial,
         "pages": search_results.pages,
-        "items": search_results.format_results(properties)
+        "items": items
+    }
+
+
+@router.post("/count")
+async def count(runner: SearchRunnerDep, struc: CountRequestBody, _query_log: QueryLogDep):
+    """
+    Count the results of a search exactly. Can be used when the search itself only returned a lower
+    bound for the amount of results.
+    :return:
+    """
+    filter_options = FilterOptions(facets=struc.facets, query=struc.query)
+    try:
+        amount = await runner.run(runner.index.count, filter_options)
+    except UnknownFacetsException as e:
+        raise HTTPException(status_code=400, detail={
+            "error": "unknown_facets",
+            "message": str(e),
+            "facets": e.facets
+        }) from e
+    return {
+        "amount": amount
     }
 
 
+class Suggestion(BaseModel):
+    """
+    A suggestion for the text query, with the amount of documents having it if known.
+    """
+    value: str
+    count: Optional[int] = None
+
+
+@router.get("/suggest")
+async def suggest(runner: SearchRunnerDep, dataset: DatasetDep, query: str,
+                  amount: Annotated[int, Query(ge=1, le=MAX_SUGGESTIONS)] = 10) -> List[Suggestion]:
+    """
+    Get suggestions for the text query while typing, from the suggest fields of the dataset.
+    :param runner:
+    :param dataset:
+    :param query: Query param: what was typed so far
+    :param amount: Query param: maximum amount of suggestions
+    :return:
+    """
+    if not dataset.search_configuration.suggest:
+        raise HTTPException(status_code=404, detail="Suggestions are not configured")
+    suggestions = await runner.run(get_suggestions, runner.index, query, amount)
+    return [Suggestion(**suggestion) for suggestion in suggestions]
+
+
 class FacetResponse(Facet):
     """
     A facet in a response. Added some additional fields compared to the Facet model so the min/max
@@ -163,6 +220,7 @@ class FacetResponse(Facet):
     end: Optional[int] = None
     step: Optional[int] = None
     tree: Optional[dict] = None
+    options: Optional[list] = None
     order: int = 0
 
     @model_serializer
@@ -183,23 +241,26 @@ class FacetResponse(Facet):
             data['step'] = self.step
         if self.type == FacetType.TREE:
             data['tree'] = self.tree
+        if self.options is not None:
+            data['options'] = self.options
         return data
 
 
 @router.get("/facets")
-async def get_facets(db: TenantDbDep, dataset: DatasetDep, es_index: ElasticIndexDep):
+async def get_facets(db: TenantDbDep, dataset: DatasetDep, runner: SearchRunnerDep,
+                     _query_log: QueryLogDep, options: bool = False,
+                     amount: Annotated[int, Query(ge=1)] = 10):
     """
     Get all facets for this dataset.
-    :param es_index:
+    :param runner:
+    :param _query_log:
     :param db:
     :param dataset:
+    :param options: Query param: also get the initial options of each facet
+    :param amount: Query param: amount of initial options per facet
     :return:
     """
-    cursor = db['facets'].find({
-        "dataset_name": dataset.name
-    })
-
-    facets_data = await cursor.to_list()
+    facets_data = await find_config(db, 'facets', {"dataset_name": dataset.name})
 
     facets = {facet['property']: Facet(**facet) for facet in facets_data}
     facet_responses = {facet['property']: FacetResponse(**facet) for facet in facets_data}
@@ -208,11 +269,18 @@ async def get_facets(db: TenantDbDep, dataset: DatasetDep, es_index: ElasticInde
         if facet.type in [FacetType.RANGE, FacetType.HISTOGRAM]
     ]
 
-    if len(range_props) > 0:
-        mins_maxes = es_index.get_min_max(range_props)
+    # The options are retrieved while waiting for the minimum and maximum values
+    mins_maxes, facet_options = await asyncio.gather(
+        runner.run(runner.index.get_min_max, range_props) if range_props else no_result({}),
+        runner.run(runner.index.get_initial_facets, list(facets.values()), amount)
+        if options else no_result({}),
+    )
+
+    for prop, data in facet_options.items():
+        facet_responses[prop].options = data
 
+    if len(range_props) > 0:
         for prop, data in mins_maxes.items():
-            facet = facets[prop]
             facet_responses[prop].start = data['min']
             facet_responses[prop].end = data['max']
             facet_responses[prop].step = 1
@@ -223,12 +291,21 @@ async def get_facets(db: TenantDbDep, dataset: DatasetDep, es_index: ElasticInde
     return response
 
 
+async def no_result(value):
+    """
+    Awaitable for a value which does not have to be retrieved.
+    :param value:
+    :return:
+    """
+    return value
+
+
 class FacetRequestBody(BaseModel):
     """
     Request body for retrieving facet options.
     """
     name: str
-    amount: int
+    amount: int = Field(ge=1)
     filter: str
     facets: Dict[str, List[str]]
     query: str = ""
@@ -236,27 +313,27 @@ class FacetRequestBody(BaseModel):
 
 
 @router.post("/facet/{name}")
-async def get_facet(name: str, es_index: ElasticIndexDep, facet: FacetRequestBody, db: TenantDbDep,
-              dataset: DatasetDep):
+async def get_facet(name: str, runner: SearchRunnerDep, facet: FacetRequestBody, db: TenantDbDep,
+              dataset: DatasetDep, _query_log: QueryLogDep):
     """
     Get options for a given facet
     :param name:
+    :param _query_log:
     :param db:
     :param dataset:
-    :param es_index:
+    :param runner:
     :param facet:
     :return:
     """
-    cursor = db['facets'].find({
+    facet_data = (await find_config(db, 'facets', {
         "dataset_name": dataset.name,
         "property": name
-    })
-    facet_data = (await cursor.to_list())[0]
+    }))[0]
     facet_obj = Facet(**facet_data)
     filter_options = FilterOptions(facets=facet.facets, query=facet.query)
     try:
         if facet_obj.type == FacetType.RANGE:
-            min_max = es_index.get_min_max([facet.name])
+            min_max = await runner.run(runner.index.get_min_max, [facet.name])
             entry = min_max.get(name) or {
                 "min": facet_data.get("min", -math.inf),
                 "max": facet_data.get("max", math.inf)
@@ -267,9 +344,9 @@ async def get_facet(name: str, es_index: ElasticIndexDep, facet: FacetRequestBod
                 "step": facet_data.get("step", 1)
             }]
         if facet_obj.type == FacetType.TREE:
-            return es_index.get_tree(facet_obj, filter_options)
-        return es_index.get_facet(facet_obj, facet.amount, facet.filter, filter_options,
-                                  facet.sort)
+            return await runner.run(runner.index.get_tree, facet_obj, filter_options)
+        return await runner.run(runner.index.get_facet, facet_obj, facet.amount, facet.filter,
+                                filter_options, facet.sort)
     except UnknownFacetsException as e:
         raise HTTPException(status_code=400, detail={
             "error": "unknown_facets",
@@ -310,24 +387,49 @@ async def get_tree(name: str, db: TenantDbDep, dataset: DatasetDep,
 
 
 @router.post("/facet/{name}/rebuild", status_code=status.HTTP_202_ACCEPTED)
-def rebuild_tree(name: str, background_tasks: BackgroundTasks, db: TenantDbDep, dataset: DatasetDep,
-                 es_index: ElasticIndexDep):
+async def rebuild_tree(name: str, response: Response, tenant: TenantDep, db: TenantDbDep,
+                       dataset: DatasetDep):
     """
-    Rebuild the tree for a given facet.
-    :param dataset:
-    :param db:
-    :param es_index:
+    Rebuild the tree for a given facet, in a background job. If the tree is already being rebuilt,
+    the running job is returned instead of starting another one.
     :param name:
-    :param background_tasks:
+    :param response:
+    :param tenant:
+    :param db:
+    :param dataset:
     :return:
     """
-    background_tasks.add_task(construct_tree, name, dataset, db, es_index)
+    facet_data = await db['facets'].find_one({
+        "dataset_name": dataset.name,
+        "property": name
+    })
+    if facet_data is None or facet_data["type"] != FacetType.TREE.value:
+        raise HTTPException(status_code=404, detail="Tree facet not found")
+
+    job, created = await submit_job(db, tenant.name, "rebuild_tree", dataset.name, name)
+    response.headers["Location"] = f"/api/datasets/{dataset.name}/jobs/{job.id}"
     return {
         "name": name,
-        "message": "rebuild tree scheduled"
+        "message": "rebuild tree scheduled" if created else "rebuild tree already scheduled",
+        "job": job,
     }
 
 
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, db: TenantDbDep, dataset: DatasetDep) -> Job:
+    """
+    Get the status and progress of a background job.
+    :param job_id:
+    :param db:
+    :param dataset:
+    :return:
+    """
+    job = await get_job(db, dataset.name, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
 class CreateFacetRequestBody(BaseModel):
     """
     Request body for facet creation.
@@ -356,21 +458,10 @@ def process_property(prop: DetailProperty, item_data: Dict, data_configuration:
 
     if prop.type == 'image_s3':
         # Get signed URL from s3
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=data_configuration['s3_key_id'],
-            aws_secret_access_key=data_configuration['s3_secret'],
-            endpoint_url=data_configuration['s3_endpoint']
-        )
         value_without_prefix = value[5:]
         bucket, path = value_without_prefix.split('/', 1)
-        print(f"Bucket: {bucket}, Path: {path}")
-        signed_url = s3.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={'Bucket': bucket, 'Key': path},
-            ExpiresIn=3600
-        )
-        value = signed_url
+        logger.debug("Bucket: %s, Path: %s", bucket, path)
+        value = signed_url(data_configuration, bucket, path)
 
     return {
         "name": prop.name,
@@ -382,27 +473,29 @@ def process_property(prop: DetailProperty, item_data: Dict, data_configuration:
 
 @router.get("/details/{item_id}")
 async def by_id(dataset_connector: DatasetConnectorDep, dataset: DatasetDep,
-                item_id: str, db: TenantDbDep):
+                item_id: str, db: TenantDbDep, request: Request):
     """
     Get details for a specific item.
     :param db:
     :param dataset:
     :param dataset_connector:
     :param item_id:
+    :param request:
     :return:
     """
-    item_data = dataset_connector.get_item(item_id)
-
-    cursor = db.detail_properties.find({
-        "dataset_name": dataset.name
-    }).sort("order")
+    profile = request_profile(request)
+    with phase(profile, "get_item"):
+        item_data = dataset_connector.get_item(item_id)
 
-    properties = await cursor.to_list()
+    properties = await find_config(db, 'detail_properties', {"dataset_name": dataset.name},
+                                   sort="order")
     properties = [DetailProperty(**data) for data in properties]
 
-    return {
-        "item_id": item_id,
-        "item_data": [
-            process_property(prop, item_data, dataset.data_configuration) for prop in properties
-        ]
-    }
+    with phase(profile, "post_processing"):
+        return {
+            "item_id": item_id,
+            "item_data": [
+                process_property(prop, item_data, dataset.data_configuration)
+                for prop in properties
+            ]
+        }
@@ -0,0 +1,331 @@
+"""
+cache.py
+Caches for data which is expensive to retrieve but changes rarely. Entries are kept in-process,
+and caches can share them with the other worker processes through a shared backend (see
+cache_backends.py). Shared entries are serialized as compact JSON, compressed when large.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any, Dict, List, Tuple
+
+from app.exceptions.cache import CacheBackendException
+from app.services.cache_backends import CacheBackend
+from app.services.memory import approximate_size
+from app.services.metrics import registry, CACHE_ENTRIES, CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the keys in the shared backend
+KEY_PREFIX = "panoptes:"
+# Serialized values of at least this many bytes are compressed
+COMPRESS_THRESHOLD = 1024
+# Seconds the versions of shared caches are kept in-process. Invalidations in other processes are
+# noticed within this time.
+VERSION_TTL = 1.0
+# Seconds the shared backend is not used after it failed
+BACKEND_RETRY_DELAY = 5.0
+# Scope of the version which applies to all entries of a cache
+GLOBAL_SCOPE = "*"
+
+_MISSING = object()
+
+
+def encode(value: Any) -> bytes:
+    """
+    Serialize a value for the shared backend, as JSON with a header telling whether it is
+    compressed.
+    :param value:
+    :return:
+    """
+    data = json.dumps(value, separators=(",", ":"), default=str).encode()
+    if len(data) >= COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(data, 1)
+    return b"j" + data
+
+
+def decode(data: bytes) -> Any:
+    """
+    Deserialize a value from the shared backend.
+    :param data:
+    :return:
+    """
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+
+class SharedStore:
+    """
+    The shared backend of the caches. When the backend fails, it is not used for a while, so
+    requests do not all wait for a backend which is down.
+    """
+    def __init__(self):
+        self.backend: CacheBackend | None = None
+        self.unavailable_until = 0.0
+
+    def configure(self, backend: CacheBackend | None):
+        """
+        Set the backend, closing the previous one.
+        :param backend: None to only cache in-process
+        :return:
+        """
+        if self.backend is not None:
+            self.backend.close()
+        self.backend = backend
+        self.unavailable_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether the backend can be used.
+        :return:
+        """
+        return self.backend is not None and self.unavailable_until <= time.monotonic()
+
+    def call(self, method: str, *args) -> Any:
+        """
+        Call a method of the backend.
+        :param method: get, set or incr
+        :param args:
+        :return:
+        """
+        if not self.available:
+            raise CacheBackendException("Shared cache is not available")
+        try:
+            return getattr(self.backend, method)(*args)
+        except CacheBackendException as e:
+            self.unavailable_until = time.monotonic() + BACKEND_RETRY_DELAY
+            logger.warning("Shared cache failed, caching in-process for %s seconds: %s",
+                           BACKEND_RETRY_DELAY, e)
+            raise
+
+
+shared_store = SharedStore()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache where entries expire after a fixed amount of time.
+
+    Shared caches also store their entries in the shared backend, and look entries up there when
+    they are not in this process. Keys should then be tuples of strings and numbers, of which the
+    first element is the scope used for invalidation, like the tenant or the index.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, name: str | None = None,
+                 shared: bool = False):
+        """
+        :param maxsize:
+        :param ttl: Time to live of the entries, in seconds
+        :param name: Name in the metrics and in the shared backend. Caches without a name are not
+            measured.
+        :param shared: Share the entries with the other processes
+        """
+        if shared and name is None:
+            raise ValueError("Shared caches need a name")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.shared = shared
+        self._entries: OrderedDict = OrderedDict()
+        self._versions: Dict[Hashable, Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+        if name is not None:
+            named_caches.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def scope(key: Hashable) -> Hashable:
+        """
+        Get the scope of a key.
+        :param key:
+        :return:
+        """
+        return key[0] if isinstance(key, tuple) and key else key
+
+    def _version_key(self, scope: Hashable) -> str:
+        return f"{KEY_PREFIX}{self.name}:version:{scope}"
+
+    def _shared_key(self, key: Hashable, version: str) -> str:
+        digest = hashlib.sha1(repr(key).encode(), usedforsecurity=False).hexdigest()
+        return f"{KEY_PREFIX}{self.name}:{version}:{digest}"
+
+    def _version(self, key: Hashable, fetch: bool = True) -> str | None:
+        """
+        Get the version of the scope of a key, which changes when the scope or the whole cache is
+        invalidated.
+        :param key:
+        :param fetch: Get the version from the shared backend if it is not known in-process
+        :return: The version, or None if it is not known in-process and not fetched
+        """
+        if not self.shared or shared_store.backend is None:
+            return ""
+        scope = self.scope(key)
+        known = self._versions.get(scope)
+        if known is not None and known[0] > time.monotonic():
+            return known[1]
+        if not fetch:
+            return None
+        try:
+            numbers = [shared_store.call("get", self._version_key(name))
+                       for name in (GLOBAL_SCOPE, scope)]
+            version = ".".join((number or b"0").decode() for number in numbers)
+        except CacheBackendException:
+            version = known[1] if known is not None else "0.0"
+        self._versions[scope] = (time.monotonic() + VERSION_TTL, version)
+        return version
+
+    def _get_local(self, key: Hashable, version: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] < time.monotonic() or entry[2] != version):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set_local(self, key: Hashable, value: Any, version: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _count(self, result: str):
+        if self.name is not None:
+            CACHE_REQUESTS.inc(self.name, result)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a value from the cache. Shared caches look in the shared backend if the value is not
+        in this process, which blocks; use aget in coroutines.
+        :param key:
+        :param default: Returned if the key is not in the cache or has expired
+        :return:
+        """
+        version = self._version(key)
+        value = self._get_local(key, version)
+        if value is not _MISSING:
+            self._count("hit")
+            return value
+        if self.shared and shared_store.available:
+            try:
+                data = shared_store.call("get", self._shared_key(key, version))
+            except CacheBackendException:
+                data = None
+            if data is not None:
+                value = decode(data)
+                # The entry expires here no later than in the backend, give or take a request
+                self._set_local(key, value, version, self.ttl)
+                self._count("shared")
+                return value
+        self._count("miss")
+        return default
+
+    async def aget(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a value from the cache in a coroutine. The shared backend is used in a thread.
+        :param key:
+        :param default:
+        :return:
+        """
+        if not self.shared:
+            return self.get(key, default)
+        version = self._version(key, fetch=False)
+        if version is not None:
+            value = self._get_local(key, version)
+            if value is not _MISSING:
+                self._count("hit")
+                return value
+        return await asyncio.to_thread(self.get, key, default)
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Put a value in the cache, removing the least recently used entry if the cache is full.
+        Shared caches also store it in the shared backend, which blocks; use aset in coroutines.
+        :param key:
+        :param value:
+        :return:
+        """
+        version = self._version(key)
+        self._set_local(key, value, version, self.ttl)
+        if self.shared and shared_store.available:
+            try:
+                shared_store.call("set", self._shared_key(key, version), encode(value), self.ttl)
+            except CacheBackendException:
+                pass
+
+    async def aset(self, key: Hashable, value: Any):
+        """
+        Put a value in the cache in a coroutine. The shared backend is used in a thread.
+        :param key:
+        :param value:
+        :return:
+        """
+        if self.shared:
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def invalidate(self, scope: Hashable | None = None):
+        """
+        Remove the entries of a scope, or all entries, in this process and, for shared caches, in
+        the other processes. Other processes notice the invalidation within VERSION_TTL seconds.
+        Blocks when the cache is shared.
+        :param scope: None for all entries
+        :return:
+        """
+        with self._lock:
+            if scope is None:
+                self._entries.clear()
+                self._versions.clear()
+            else:
+                for key in [key for key in self._entries if self.scope(key) == scope]:
+                    del self._entries[key]
+                self._versions.pop(scope, None)
+        if self.shared and shared_store.available:
+            try:
+                shared_store.call("incr", self._version_key(GLOBAL_SCOPE if scope is None
+                                                            else scope))
+            except CacheBackendException:
+                pass
+
+    def memory_usage(self) -> int:
+        """
+        Approximate the memory used by the entries, in bytes.
+        :return:
+        """
+        with self._lock:
+            return approximate_size(self._entries)
+
+    def clear(self):
+        """
+        Remove all entries in this process.
+        :return:
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+named_caches: List[TTLCache] = []
+
+
+def collect_cache_metrics():
+    """
+    Update the amount of entries of the named caches.
+    :return:
+    """
+    for cache in named_caches:
+        CACHE_ENTRIES.set(cache.name, value=len(cache))
+
+registry.add_collector(collect_cache_metrics)
@@ -0,0 +1,295 @@
+"""
+cache_backends.py
+Stores for cache entries which are shared by the worker processes, so a value retrieved by one
+worker can be used by the others. Entries are stored as bytes; the caches in cache.py serialize
+the values.
+"""
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, List
+from urllib.parse import urlparse
+
+from app.exceptions.cache import CacheBackendException
+
+# Size of the memory map of the SQLite file, in bytes
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+# Expired entries are removed after this many writes
+SQLITE_PURGE_INTERVAL = 1000
+
+
+class CacheBackend(ABC):
+    """
+    Store for cache entries shared by processes.
+    """
+    @abstractmethod
+    def get(self, key: str) -> bytes | None:
+        """
+        Get an entry.
+        :param key:
+        :return: The value, or None if the key is unknown or the entry expired
+        """
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: float):
+        """
+        Store an entry.
+        :param key:
+        :param value:
+        :param ttl: Time to live of the entry, in seconds
+        :return:
+        """
+
+    @abstractmethod
+    def incr(self, key: str) -> int:
+        """
+        Increment a counter which does not expire, like the version of a cache.
+        :param key:
+        :return: The new value
+        """
+
+    @abstractmethod
+    def set_if_changed(self, key: str, value: bytes, ttl: float) -> bool:
+        """
+        Store an entry, atomically telling whether it had another value, so only one process acts
+        on a change.
+        :param key:
+        :param value:
+        :param ttl: Time to live of the entry, in seconds
+        :return: Whether the entry did not exist, had expired or had another value
+        """
+
+    def close(self):
+        """
+        Close the connections to the store.
+        :return:
+        """
+
+
+class SqliteBackend(CacheBackend):
+    """
+    Entries in a memory-mapped SQLite database, shared by the workers on the same host. The file
+    should be on a memory file system, like /dev/shm.
+    """
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=0.1, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            row = self._connection().execute(
+                "SELECT value FROM entries WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise CacheBackendException(str(e)) from e
+        return None if row is None else bytes(row[0])
+
+    def set(self, key: str, value: bytes, ttl: float):
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl)
+            )
+            self._writes += 1
+            if self._writes % SQLITE_PURGE_INTERVAL == 0:
+                self.purge()
+        except sqlite3.Error as e:
+            raise CacheBackendException(str(e)) from e
+
+    def incr(self, key: str) -> int:
+        try:
+            row = self._connection().execute(
+                "INSERT INTO entries (key, value, expires) VALUES (?, CAST(1 AS BLOB), ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = CAST(CAST(value AS INTEGER) + 1 AS BLOB) "
+                "RETURNING value", (key, float("inf"))
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise CacheBackendException(str(e)) from e
+        return int(row[0])
+
+    def set_if_changed(self, key: str, value: bytes, ttl: float) -> bool:
+        now = time.time()
+        try:
+            row = self._connection().execute(
+                "INSERT INTO entries (key, value, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, "
+                "expires = excluded.expires "
+                "WHERE entries.value != excluded.value OR entries.expires <= ? RETURNING key",
+                (key, value, now + ttl, now)
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise CacheBackendException(str(e)) from e
+        return row is not None
+
+    def purge(self):
+        """
+        Remove the expired entries, and the entries expiring first if there are too many.
+        :return:
+        """
+        connection = self._connection()
+        connection.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+        connection.execute(
+            "DELETE FROM entries WHERE key IN "
+            "(SELECT key FROM entries ORDER BY expires LIMIT max(0, "
+            "(SELECT count(*) FROM entries) - ?))", (self.max_entries,)
+        )
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class RedisConnection:
+    """
+    Connection to a Redis server, speaking the RESP protocol.
+    """
+    def __init__(self, host: str, port: int, timeout: float):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.socket.makefile("rb")
+
+    def command(self, *args: str | bytes | int) -> Any:
+        """
+        Send a command and read its reply.
+        :param args:
+        :return:
+        """
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode())
+            parts.append(data)
+            parts.append(b"\r\n")
+        self.socket.sendall(b"".join(parts))
+        return self.read_reply()
+
+    def read_reply(self) -> Any:
+        """
+        Read a reply of the server.
+        :return:
+        """
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by Redis")
+        kind, data = line[:1], line[1:-2]
+        if kind == b"+":
+            return data
+        if kind == b"-":
+            raise CacheBackendException(f"Redis error: {data.decode(errors='replace')}")
+        if kind == b":":
+            return int(data)
+        if kind == b"$":
+            length = int(data)
+            if length < 0:
+                return None
+            value = self.reader.read(length + 2)
+            return value[:-2]
+        if kind == b"*":
+            length = int(data)
+            return None if length < 0 else [self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected reply from Redis: {line!r}")
+
+    def close(self):
+        """
+        Close the connection.
+        :return:
+        """
+        self.reader.close()
+        self.socket.close()
+
+
+class RedisBackend(CacheBackend):
+    """
+    Entries in a Redis server, shared by the workers on all hosts. Connections are kept in a pool,
+    so threads do not wait for each other.
+    """
+    def __init__(self, url: str, timeout: float = 0.1):
+        """
+        :param url: Like redis://:password@host:6379/0
+        :param timeout: Timeout of connecting and of every command, in seconds
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.strip("/") or 0)
+        self.timeout = timeout
+        self._pool: queue.LifoQueue = queue.LifoQueue()
+
+    def _connect(self) -> RedisConnection:
+        connection = RedisConnection(self.host, self.port, self.timeout)
+        try:
+            if self.password:
+                connection.command("AUTH", self.password)
+            if self.database:
+                connection.command("SELECT", self.database)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def command(self, *args: str | bytes | int) -> Any:
+        """
+        Execute a command on a pooled connection. Connections with I/O errors are closed; after an
+        error reply of Redis, the connection is returned to the pool.
+        :param args:
+        :return:
+        """
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = None
+        try:
+            if connection is None:
+                connection = self._connect()
+            return connection.command(*args)
+        except (OSError, ValueError) as e:
+            if connection is not None:
+                connection.close()
+                connection = None
+            raise CacheBackendException(f"Redis unavailable: {e}") from e
+        finally:
+            if connection is not None:
+                self._pool.put(connection)
+
+    def get(self, key: str) -> bytes | None:
+        return self.command("GET", key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.command("SET", key, value, "PX", max(1, int(ttl * 1000)))
+
+    def incr(self, key: str) -> int:
+        return self.command("INCR", key)
+
+    def set_if_changed(self, key: str, value: bytes, ttl: float) -> bool:
+        # Needs Redis 6.2 or later, for getting the previous value while setting
+        return self.command("SET", key, value, "PX", max(1, int(ttl * 1000)), "GET") != value
+
+    def close(self):
+        connections: List[RedisConnection] = []
+        while not self._pool.empty():
+            connections.append(self._pool.get_nowait())
+        for connection in connections:
+            connection.close()
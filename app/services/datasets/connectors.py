@@ -2,6 +2,7 @@
 Implementation specific classes for dealing with dataset connections.
 """
 import base64
+import logging
 from abc import ABC, abstractmethod
 from typing import Annotated
 
@@ -12,6 +13,8 @@ from app.dependencies import DatasetDep, ElasticIndexDep
 from app.models import Dataset, DataConfiguration
 from app.services.search.elastic_index import Index
 
+logger = logging.getLogger(__name__)
+
 
 class DatasetConnector(ABC):
     """
@@ -66,13 +69,13 @@ class CMDIEditorConnector(DatasetConnector):
                 password = self.data_configuration.auth["password"]
                 token = base64.b64encode(f"{username}:{password}".encode('utf-8')).decode("ascii")
                 headers["Authorization"] = f"Basic {token}"
-            print("Getting " + f"{self.api_base}/{item_id}")
+            logger.info("Getting %s/%s", self.api_base, item_id)
             response = requests.get(f"{self.api_base}/{item_id}.json2", headers=headers, timeout=5)
         except requests.exceptions.Timeout as exc:
             raise HTTPException(status_code=504, detail="External source timed out.") from exc
         if response.status_code >= 400:
-            print(response)
-            print(response.json())
+            logger.warning("External source responded with %s: %s", response.status_code,
+                           response.text)
             raise HTTPException(status_code=502, detail="Unable to get data from external source")
         return response.json()
 
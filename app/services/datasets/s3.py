@@ -0,0 +1,46 @@
+"""
+Signed URLs for resources in S3 buckets. boto3 is imported when the first URL is signed, as it
+takes long to import and only datasets with resources in S3 need it.
+"""
+from functools import lru_cache
+from typing import Dict
+
+# Signed URLs are valid for this many seconds
+URL_EXPIRATION = 3600
+
+
+@lru_cache(maxsize=32)
+def s3_client(key_id: str, secret: str, endpoint: str):
+    """
+    Get a client for an S3 endpoint. Clients are cached, as creating one takes long.
+    :param key_id:
+    :param secret:
+    :param endpoint:
+    :return:
+    """
+    import boto3 # pylint: disable=import-outside-toplevel
+
+    return boto3.client(
+        "s3",
+        aws_access_key_id=key_id,
+        aws_secret_access_key=secret,
+        endpoint_url=endpoint
+    )
+
+
+def signed_url(data_configuration: Dict, bucket: str, path: str) -> str:
+    """
+    Get a signed URL for an object in a bucket, using the S3 credentials of a dataset.
+    :param data_configuration: Data configuration of the dataset, with s3_key_id, s3_secret and
+        s3_endpoint
+    :param bucket:
+    :param path:
+    :return:
+    """
+    client = s3_client(data_configuration['s3_key_id'], data_configuration['s3_secret'],
+                       data_configuration['s3_endpoint'])
+    return client.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={'Bucket': bucket, 'Key': path},
+        ExpiresIn=URL_EXPIRATION
+    )
@@ -0,0 +1,203 @@
+"""
+memory.py
+Memory instrumentation for finding out which code paths make the memory of a worker grow:
+tracemalloc snapshots and differences between them, the peak allocation of requests, and the sizes
+of in-process data. Tracing allocations slows down the process, so it is only done on demand.
+"""
+import linecache
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+# Directory of the application code, for leaving out allocations of libraries
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass
+class EndpointMemory:
+    """
+    Allocations of the requests to an endpoint while tracing.
+    """
+    requests: int = 0
+    peak_total: int = 0
+    peak_max: int = 0
+    response_size_max: int = 0
+
+
+def process_memory() -> Dict[str, Optional[int]]:
+    """
+    Get the memory usage of the process in bytes.
+    :return: The current resident set size (None if unknown), and the highest resident set size
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            rss = int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        rss = None
+    return {"rss": rss, "max_rss": max_rss}
+
+
+def approximate_size(value: Any, seen: Optional[set] = None) -> int:
+    """
+    Approximate the memory used by a value, including the values it contains. Objects referenced
+    more than once are counted once.
+    :param value:
+    :param seen: Ids of the objects already counted
+    :return: The size in bytes
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    # For numpy arrays owning their data this includes the buffer
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(key, seen) + approximate_size(item, seen)
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, seen) for item in value)
+    elif hasattr(value, "__dict__"):
+        size += approximate_size(vars(value), seen)
+    return size
+
+
+class MemoryProfiler:
+    """
+    Takes tracemalloc snapshots and records the peak allocation of requests while tracing.
+
+    tracemalloc has a single peak for the whole process, so the peak of a request is only reset
+    when no other measured request is running. The peaks of concurrent requests are upper bounds.
+    """
+    def __init__(self):
+        self.endpoints: Dict[str, EndpointMemory] = {}
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._running = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tracing() -> bool:
+        """
+        Check whether allocations are being traced.
+        :return:
+        """
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        """
+        Start tracing allocations.
+        :param frames: Amount of frames stored per allocation. More frames show which code paths
+            lead to an allocation, but use more memory.
+        :return:
+        """
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        with self._lock:
+            self._snapshot = None
+            self.endpoints.clear()
+        tracemalloc.start(frames)
+
+    def stop(self):
+        """
+        Stop tracing allocations, and forget the snapshot.
+        :return:
+        """
+        tracemalloc.stop()
+        with self._lock:
+            self._snapshot = None
+
+    def snapshot(self, group_by: str = "lineno", limit: int = 20, app_only: bool = False) -> Dict:
+        """
+        Take a snapshot of the traced allocations. The largest allocations are returned, together
+        with the largest differences with the previous snapshot.
+        :param group_by: lineno, filename or traceback, see tracemalloc.Snapshot.statistics
+        :param limit: Amount of allocations to return
+        :param app_only: Only count allocations made by the code of the application
+        :return:
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            # Leave out the allocations of the profiler itself
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        if app_only:
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(True, os.path.join(APP_DIRECTORY, "*"), all_frames=True),
+            ))
+        with self._lock:
+            previous, self._snapshot = self._snapshot, snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "traced": current,
+            "peak": peak,
+            "top": [format_statistic(statistic)
+                    for statistic in snapshot.statistics(group_by)[:limit]],
+            "diff": None,
+        }
+        if previous is not None:
+            result["diff"] = [format_statistic(statistic)
+                              for statistic in snapshot.compare_to(previous, group_by)[:limit]]
+        return result
+
+    def request_started(self) -> int:
+        """
+        Start measuring the peak allocation of a request.
+        :return: The traced memory at the start of the request
+        """
+        with self._lock:
+            if self._running == 0:
+                tracemalloc.reset_peak()
+            self._running += 1
+        return tracemalloc.get_traced_memory()[0]
+
+    def request_done(self, started: int, endpoint: Optional[str], response_size: int):
+        """
+        Record the peak allocation of a request.
+        :param started: Traced memory at the start of the request, from request_started
+        :param endpoint: Name of the endpoint function, None if it should not be recorded
+        :param response_size: Size of the response body in bytes
+        :return:
+        """
+        peak = max(0, tracemalloc.get_traced_memory()[1] - started)
+        with self._lock:
+            self._running -= 1
+            if endpoint is None:
+                return
+            statistics = self.endpoints.setdefault(endpoint, EndpointMemory())
+            statistics.requests += 1
+            statistics.peak_total += peak
+            statistics.peak_max = max(statistics.peak_max, peak)
+            statistics.response_size_max = max(statistics.response_size_max, response_size)
+
+
+def format_statistic(statistic) -> Dict:
+    """
+    Format a tracemalloc statistic (or statistic difference).
+    :param statistic:
+    :return:
+    """
+    frames = [
+        {
+            "file": frame.filename,
+            "line": frame.lineno,
+            "code": linecache.getline(frame.filename, frame.lineno).strip(),
+        }
+        for frame in statistic.traceback
+    ]
+    result = {"size": statistic.size, "count": statistic.count, "traceback": frames}
+    if isinstance(statistic, tracemalloc.StatisticDiff):
+        result["size_diff"] = statistic.size_diff
+        result["count_diff"] = statistic.count_diff
+    return result
+
+
+memory_profiler = MemoryProfiler()
@@ -0,0 +1,305 @@
+"""
+metrics.py
+Metrics in the Prometheus text format. Metrics are kept in memory per process, and rendered when
+/metrics is scraped. Values which are cheap to read on demand (pool usage, cache sizes) are
+collected at scrape time instead of being updated on every request. Every sample has a `worker`
+label with the id of the process, so the series of different workers are not mixed up and a
+restarted worker shows up as a counter reset. Each worker has to be scraped separately.
+"""
+import bisect
+import functools
+import inspect
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Buckets for latencies in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Buckets for sizes in bytes
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+# Buckets for background tasks, which take a lot longer
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def format_value(value: float) -> str:
+    """
+    Format a sample value.
+    :param value:
+    :return:
+    """
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """
+    Format the labels of a sample.
+    :param names:
+    :param values:
+    :return:
+    """
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """
+    Base class for metrics with labels.
+    """
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        """
+        Get the samples of the metric as (suffix, label names, label values, value) tuples.
+        :return:
+        """
+        raise NotImplementedError
+
+    def render(self, label_names: Sequence[str] = (), label_values: Sequence[str] = ()) -> str:
+        """
+        Render the metric in the Prometheus text format.
+        :param label_names: Names of labels added to every sample
+        :param label_values:
+        :return:
+        """
+        label_names, label_values = tuple(label_names), tuple(label_values)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, names, values, value in self.samples():
+            labels = format_labels(label_names + names, label_values + values)
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A value which only goes up.
+    """
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        """
+        Increase the counter.
+        :param labels: Values of the labels, in the same order as the label names
+        :param amount:
+        :return:
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, *labels: str, value: float):
+        """
+        Set the counter to a value counted elsewhere. Used by collectors.
+        :param labels:
+        :param value:
+        :return:
+        """
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        with self._lock:
+            return [("_total", self.label_names, labels, value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """
+    A value which can go up and down.
+    """
+    type_name = "gauge"
+
+    def samples(self):
+        with self._lock:
+            return [("", self.label_names, labels, value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, in cumulative buckets.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: count per bucket (the last one is +Inf), and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, *labels: str, value: float):
+        """
+        Record an observation.
+        :param labels: Values of the labels, in the same order as the label names
+        :param value:
+        :return:
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self):
+        names = self.label_names + ("le",)
+        samples = []
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    samples.append(("_bucket", names, labels + (format_value(bound),),
+                                    cumulative))
+                samples.append(("_sum", self.label_names, labels, total[0]))
+                samples.append(("_count", self.label_names, labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    Collection of metrics, rendered together.
+    """
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add a metric.
+        :param metric:
+        :return: The metric
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """
+        Add a function which updates metrics right before they are rendered.
+        :param collector:
+        :return:
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text format, labelled with the id of the process.
+        :return:
+        """
+        for collector in self._collectors:
+            collector()
+        # Read at render time, as workers are forked after this module is imported
+        worker = (str(os.getpid()),)
+        return "\n".join(metric.render(("worker",), worker)
+                         for metric in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.register(Histogram(
+    "panoptes_request_duration_seconds", "Duration of HTTP requests",
+    ("method", "route", "status", "tenant", "dataset")
+))
+RESPONSE_SIZE = registry.register(Histogram(
+    "panoptes_response_size_bytes", "Size of HTTP response bodies", ("route",),
+    buckets=SIZE_BUCKETS
+))
+DEPENDENCY_DURATION = registry.register(Histogram(
+    "panoptes_dependency_duration_seconds",
+    "Time from the start of a request until its dependencies are resolved",
+    ("route",)
+))
+QUEUE_WAIT = registry.register(Histogram(
+    "panoptes_admission_wait_seconds", "Time searches waited for an admission slot", ("tenant",)
+))
+ADMISSION_SEARCHES = registry.register(Gauge(
+    "panoptes_admission_searches", "Searches admitted and waiting, per tenant",
+    ("tenant", "state")
+))
+ADMISSION_REJECTED = registry.register(Counter(
+    "panoptes_admission_rejected", "Searches rejected by admission control", ("tenant",)
+))
+ES_DURATION = registry.register(Histogram(
+    "panoptes_elasticsearch_request_seconds", "Wall time of Elasticsearch requests",
+    ("operation", "index")
+))
+ES_TOOK = registry.register(Histogram(
+    "panoptes_elasticsearch_took_seconds",
+    "Time Elasticsearch reported spending on requests (took)", ("operation", "index")
+))
+ES_OVERHEAD = registry.register(Histogram(
+    "panoptes_elasticsearch_overhead_seconds",
+    "Wall time of Elasticsearch requests minus took: network, queueing and serialization",
+    ("operation", "index")
+))
+ES_CONNECTIONS = registry.register(Gauge(
+    "panoptes_elasticsearch_connections", "Connections to Elasticsearch nodes",
+    ("cluster", "node", "state")
+))
+MONGO_DURATION = registry.register(Histogram(
+    "panoptes_mongo_command_seconds", "Duration of MongoDB commands", ("command", "outcome")
+))
+MONGO_CONNECTIONS = registry.register(Gauge(
+    "panoptes_mongo_connections", "Connections to MongoDB servers", ("address", "state")
+))
+CACHE_REQUESTS = registry.register(Counter(
+    "panoptes_cache_requests", "Lookups in caches, by result (hit, shared or miss)",
+    ("cache", "result")
+))
+CACHE_ENTRIES = registry.register(Gauge(
+    "panoptes_cache_entries", "Entries in in-process caches", ("cache",)
+))
+TASK_DURATION = registry.register(Histogram(
+    "panoptes_background_task_seconds", "Duration of background tasks", ("task", "outcome"),
+    buckets=TASK_BUCKETS
+))
+
+
+class timed_task: # pylint: disable=invalid-name
+    """
+    Context manager and decorator recording the duration of a background task.
+    """
+    def __init__(self, task: str):
+        self.task = task
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        TASK_DURATION.observe(self.task, "error" if exc_type else "success",
+                              value=time.monotonic() - self.started)
+
+    def __call__(self, func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed_task(self.task):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed_task(self.task):
+                return func(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,74 @@
+"""
+mongo_monitoring.py
+Listeners recording metrics for MongoDB commands and connection pools.
+"""
+from pymongo import monitoring
+
+from app.services.metrics import MONGO_DURATION, MONGO_CONNECTIONS
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    Records the duration of MongoDB commands.
+    """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_DURATION.observe(event.command_name, "success",
+                               value=event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_DURATION.observe(event.command_name, "failure",
+                               value=event.duration_micros / 1_000_000)
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Records the size and usage of the MongoDB connection pools.
+    """
+    def pool_created(self, event):
+        address = format_address(event.address)
+        MONGO_CONNECTIONS.set(address, "max", value=event.options.get("maxPoolSize", 100))
+        MONGO_CONNECTIONS.set(address, "open", value=0)
+        MONGO_CONNECTIONS.set(address, "in_use", value=0)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_CONNECTIONS.inc(format_address(event.address), "open")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_CONNECTIONS.inc(format_address(event.address), "open", amount=-1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        MONGO_CONNECTIONS.inc(format_address(event.address), "in_use")
+
+    def connection_checked_in(self, event):
+        MONGO_CONNECTIONS.inc(format_address(event.address), "in_use", amount=-1)
+
+
+def format_address(address) -> str:
+    """
+    Format a (host, port) address.
+    :param address:
+    :return:
+    """
+    host, port = address
+    return f"{host}:{port}"
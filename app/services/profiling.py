@@ -0,0 +1,119 @@
+"""
+profiling.py
+Timings of the phases of a single request, for finding out where the time of a slow request went.
+Profiling is opt-in per request, so these are only collected when asked for.
+"""
+import contextlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class Profile:
+    """
+    Timings of the phases of a request, and the query profiles returned by Elasticsearch.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        # Name, start and end time of every phase, in the order they ended
+        self.phases: List[Tuple[str, float, float]] = []
+        self.elasticsearch: List[Dict] = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Measure a phase.
+        :param name:
+        :return:
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, start, time.monotonic())
+
+    def add_phase(self, name: str, start: float, end: float):
+        """
+        Add a phase which has been measured already.
+        :param name:
+        :param start: time.monotonic() at the start of the phase
+        :param end: time.monotonic() at the end of the phase
+        :return:
+        """
+        with self._lock:
+            self.phases.append((name, start, end))
+
+    def add_elasticsearch(self, operation: str, response: Dict):
+        """
+        Add the profile Elasticsearch returned for a request.
+        :param operation:
+        :param response:
+        :return:
+        """
+        with self._lock:
+            self.elasticsearch.append({
+                "operation": operation,
+                "took": response.get("took"),
+                "profile": response.get("profile"),
+            })
+
+    def last_end(self) -> float:
+        """
+        Get the time the last phase ended.
+        :return:
+        """
+        with self._lock:
+            return max((end for _, _, end in self.phases), default=self.started)
+
+    def durations(self) -> Dict[str, float]:
+        """
+        Get the total duration per phase name in milliseconds, in the order the phases started.
+        Phases which run multiple times (or concurrently) are summed.
+        :return:
+        """
+        durations = {}
+        with self._lock:
+            for name, start, end in sorted(self.phases, key=lambda phase: phase[1]):
+                durations[name] = durations.get(name, 0.0) + (end - start) * 1000
+        return durations
+
+    def server_timing(self) -> str:
+        """
+        Format the phase durations as a Server-Timing header.
+        :return:
+        """
+        return ", ".join(f"{name};dur={duration:.1f}"
+                         for name, duration in self.durations().items())
+
+    def to_dict(self) -> Dict:
+        """
+        Get the complete profile, for the trace log.
+        :return:
+        """
+        with self._lock:
+            phases = [
+                {
+                    "name": name,
+                    "start": round((start - self.started) * 1000, 3),
+                    "duration": round((end - start) * 1000, 3),
+                }
+                for name, start, end in sorted(self.phases, key=lambda phase: phase[1])
+            ]
+            elasticsearch = list(self.elasticsearch)
+        return {
+            "phases": phases,
+            "elasticsearch": elasticsearch,
+        }
+
+
+def phase(profile: Optional[Profile], name: str):
+    """
+    Measure a phase if the request is being profiled.
+    :param profile:
+    :param name:
+    :return: A context manager
+    """
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.phase(name)
@@ -0,0 +1,156 @@
+"""
+query_log.py
+Log of recent search requests, used for warming up the caches with the most frequent requests.
+Requests are counted in memory and periodically added to the "query_log" collection of the tenant
+database, so new processes can warm up with the requests other processes have seen. Requests are
+counted per hour, and the counts of an hour expire a while after it, so the most frequent requests
+are those of the recent past.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+QUERY_LOG_COLLECTION = "query_log"
+# Requests with larger bodies are not logged
+MAX_BODY_SIZE = 4096
+# Header marking requests made by the warm-up, which are not logged
+WARMUP_HEADER = "x-panoptes-warmup"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class LoggedQuery:
+    """
+    A request which can be replayed.
+    """
+    tenant: str
+    dataset_name: str
+    method: str
+    path: str
+    query_string: str
+    body: str
+
+    @property
+    def key(self) -> str:
+        """
+        Id of the request in the query log collection.
+        :return:
+        """
+        return hashlib.sha1("\n".join(
+            (self.dataset_name, self.method, self.path, self.query_string, self.body)
+        ).encode(), usedforsecurity=False).hexdigest()[:16]
+
+
+class QueryLog:
+    """
+    Counts the requests since the last flush. When the log is full, only requests which are
+    already in it are counted.
+    """
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        # Databases of which the indexes of the query log collection have been created
+        self._indexed: Set[str] = set()
+
+    def record(self, query: LoggedQuery):
+        """
+        Count a request.
+        :param query:
+        :return:
+        """
+        if len(query.body) > MAX_BODY_SIZE:
+            return
+        with self._lock:
+            if query in self._counts or len(self._counts) < self.max_entries:
+                self._counts[query] += 1
+
+    def drain(self) -> List[Tuple[LoggedQuery, int]]:
+        """
+        Get the counted requests and start counting anew.
+        :return:
+        """
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        return list(counts.items())
+
+    async def flush(self, client: AsyncIOMotorClient, ttl: int):
+        """
+        Add the counted requests to the counts of the current hour in the query log collections of
+        the tenants.
+        :param client:
+        :param ttl: The counts of an hour expire this many seconds after they were last updated
+        :return:
+        """
+        per_tenant: Dict[str, List[UpdateOne]] = {}
+        now = datetime.now(timezone.utc)
+        hour = now.strftime("%Y%m%d%H")
+        for query, count in self.drain():
+            per_tenant.setdefault(query.tenant, []).append(UpdateOne(
+                {"_id": f"{query.key}-{hour}"},
+                {"$inc": {"count": count},
+                 "$set": {"key": query.key, "dataset_name": query.dataset_name,
+                          "method": query.method, "path": query.path,
+                          "query_string": query.query_string, "body": query.body,
+                          "last_seen": now}},
+                upsert=True
+            ))
+        for tenant, updates in per_tenant.items():
+            collection = client.get_database(tenant)[QUERY_LOG_COLLECTION]
+            if tenant not in self._indexed:
+                await collection.create_index("last_seen", expireAfterSeconds=ttl)
+                await collection.create_index([("dataset_name", 1), ("key", 1)])
+                self._indexed.add(tenant)
+            await collection.bulk_write(updates, ordered=False)
+
+    async def run(self, client: AsyncIOMotorClient, interval: float, ttl: int):
+        """
+        Periodically flush the counted requests. Runs until cancelled.
+        :param client:
+        :param interval: Seconds between flushes
+        :param ttl: Entries not seen for this many seconds expire
+        :return:
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(client, ttl)
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception("Flushing the query log failed")
+
+
+async def frequent_queries(client: AsyncIOMotorClient, tenant: str, dataset_name: str,
+                           amount: int) -> List[LoggedQuery]:
+    """
+    Get the most frequent requests to a dataset from the query log, adding up the counts of the
+    hours which have not expired yet.
+    :param client:
+    :param tenant:
+    :param dataset_name:
+    :param amount:
+    :return:
+    """
+    cursor = client.get_database(tenant)[QUERY_LOG_COLLECTION].aggregate([
+        # Entries written before the counts were kept per hour have no key
+        {"$match": {"dataset_name": dataset_name, "key": {"$exists": True}}},
+        {"$group": {"_id": "$key", "count": {"$sum": "$count"}, "method": {"$first": "$method"},
+                    "path": {"$first": "$path"}, "query_string": {"$first": "$query_string"},
+                    "body": {"$first": "$body"}}},
+        {"$sort": {"count": -1, "_id": 1}},
+        {"$limit": amount},
+    ])
+    return [LoggedQuery(tenant, dataset_name, entry["method"], entry["path"],
+                        entry["query_string"], entry["body"])
+            for entry in await cursor.to_list()]
+
+
+query_log = QueryLog()
@@ -0,0 +1,181 @@
+"""
+admission.py
+Admission control for searches. Limits how many searches run concurrently, in total, per tenant
+and per dataset, so a single tenant can not saturate Elasticsearch. Waiting searches are started
+in weighted fair queuing order across tenants, and rejected when a queue is full.
+"""
+import asyncio
+import itertools
+import math
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from app.exceptions.search import OverloadedException
+
+# Weight of a new service time in the moving average used for estimating Retry-After
+SERVICE_TIME_SMOOTHING = 0.1
+
+
+@dataclass
+class QueueStatistics:
+    """
+    Queue statistics of a tenant.
+    """
+    admitted: int = 0
+    rejected: int = 0
+    queued: int = 0
+    running: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+
+@dataclass
+class AdmissionLimits:
+    """
+    Limits of the admission controller.
+    """
+    concurrency: int = 32 # Concurrent searches in total
+    tenant_concurrency: int = 8 # Concurrent searches per tenant
+    dataset_concurrency: int = 4 # Concurrent searches per dataset
+    queue_depth: int = 50 # Waiting searches per tenant
+    max_wait: float = 10 # Maximum time to wait for a slot, in seconds
+
+
+@dataclass
+class _TenantState:
+    statistics: QueueStatistics = field(default_factory=QueueStatistics)
+    # Virtual finish tag of the last search of the tenant
+    last_tag: float = 0.0
+
+
+@dataclass
+class _Waiter:
+    tag: float
+    sequence: int
+    tenant: str
+    dataset: str
+    future: asyncio.Future = field(compare=False)
+
+
+class AdmissionController:
+    """
+    Schedules searches over a limited amount of concurrency slots. Every tenant gets a share of
+    the slots proportional to its weight when there is contention (weighted fair queuing): each
+    waiting search gets a virtual finish tag, and the waiting search with the lowest tag which is
+    within the limits of its tenant and dataset is started first.
+
+    Should only be used from the event loop.
+    """
+    def __init__(self, limits: AdmissionLimits):
+        self.limits = limits
+        self.service_time = 0.1
+        self._waiters: List[_Waiter] = []
+        self._running: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._virtual_time = 0.0
+        self._tenants: Dict[str, _TenantState] = defaultdict(_TenantState)
+        self._sequence = itertools.count()
+
+    def running(self) -> int:
+        """
+        Get the amount of running searches.
+        :return:
+        """
+        return sum(self._running.values())
+
+    def _can_start(self, tenant: str, dataset: str) -> bool:
+        return self.running() < self.limits.concurrency \
+            and self._tenants[tenant].statistics.running < self.limits.tenant_concurrency \
+            and self._running[(tenant, dataset)] < self.limits.dataset_concurrency
+
+    def _start(self, tenant: str, dataset: str):
+        self._running[(tenant, dataset)] += 1
+        self._tenants[tenant].statistics.running += 1
+        self._tenants[tenant].statistics.admitted += 1
+
+    def retry_after(self, tenant: str) -> int:
+        """
+        Estimate after how many seconds a rejected search of a tenant can be retried.
+        :param tenant:
+        :return:
+        """
+        queued = self._tenants[tenant].statistics.queued
+        return max(1, math.ceil(self.service_time * (queued + 1) / self.limits.tenant_concurrency))
+
+    async def acquire(self, tenant: str, dataset: str, weight: float = 1.0) -> float:
+        """
+        Wait for a slot for a search. Should be followed by release when the search is done.
+        :param tenant:
+        :param dataset:
+        :param weight: Share of the tenant in the slots
+        :return: The time waited for the slot, in seconds
+        """
+        state = self._tenants[tenant]
+        statistics = state.statistics
+        if not self._waiters and self._can_start(tenant, dataset):
+            self._start(tenant, dataset)
+            return 0.0
+        if statistics.queued >= self.limits.queue_depth:
+            statistics.rejected += 1
+            raise OverloadedException("Too many searches waiting", self.retry_after(tenant))
+
+        state.last_tag = max(self._virtual_time, state.last_tag) + 1 / max(weight, 1e-6)
+        waiter = _Waiter(state.last_tag, next(self._sequence), tenant, dataset,
+                         asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        statistics.queued += 1
+        # Slots can be free while the other waiting searches are limited by their tenant or dataset
+        self._dispatch()
+        enqueued = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter.future, self.limits.max_wait)
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                statistics.queued -= 1
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Got a slot, but nobody is going to use it
+                self.release(tenant, dataset)
+            if isinstance(e, TimeoutError):
+                statistics.rejected += 1
+                raise OverloadedException("Timed out waiting for a search slot",
+                                          self.retry_after(tenant)) from e
+            raise
+        waited = time.monotonic() - enqueued
+        statistics.wait_total += waited
+        statistics.wait_max = max(statistics.wait_max, waited)
+        return waited
+
+    def release(self, tenant: str, dataset: str, duration: float | None = None):
+        """
+        Release the slot of a search and start waiting searches.
+        :param tenant:
+        :param dataset:
+        :param duration: How long the search took, used for estimating Retry-After
+        :return:
+        """
+        self._running[(tenant, dataset)] -= 1
+        self._tenants[tenant].statistics.running -= 1
+        if duration is not None:
+            self.service_time += SERVICE_TIME_SMOOTHING * (duration - self.service_time)
+        self._dispatch()
+
+    def _dispatch(self):
+        for waiter in sorted(self._waiters, key=lambda waiter: (waiter.tag, waiter.sequence)):
+            if self.running() >= self.limits.concurrency:
+                break
+            if waiter.future.done() or not self._can_start(waiter.tenant, waiter.dataset):
+                continue
+            self._waiters.remove(waiter)
+            self._tenants[waiter.tenant].statistics.queued -= 1
+            self._virtual_time = waiter.tag
+            self._start(waiter.tenant, waiter.dataset)
+            waiter.future.set_result(True)
+
+    def statistics(self) -> Dict[str, QueueStatistics]:
+        """
+        Get the queue statistics per tenant.
+        :return:
+        """
+        return {tenant: state.statistics for tenant, state in self._tenants.items()}
@@ -0,0 +1,68 @@
+"""
+cancellation.py
+Cancels the Elasticsearch searches of requests whose client disconnected. Elasticsearch cannot
+filter its task list on the X-Opaque-Id header, so the search tasks of the whole cluster are
+listed. To not list them for every aborted keystroke, cancellations are collected for a short
+while and done in a batch, with a single task listing per cluster.
+"""
+import logging
+import threading
+from typing import Dict, Set, Tuple
+
+from elasticsearch import Elasticsearch
+
+# Seconds cancellations are collected before the tasks are listed
+CANCEL_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class SearchCanceller:
+    """
+    Collects the opaque ids of the requests of which the searches should be cancelled, per
+    Elasticsearch client, and cancels them in batches in a background thread.
+    """
+    def __init__(self, interval: float = CANCEL_INTERVAL):
+        self.interval = interval
+        # Client and opaque ids of the requests to cancel, by id of the client
+        self._pending: Dict[int, Tuple[Elasticsearch, Set[str]]] = {}
+        self._lock = threading.Lock()
+
+    def cancel(self, client: Elasticsearch, opaque_id: str):
+        """
+        Schedule cancelling the searches of a request. Does not block.
+        :param client:
+        :param opaque_id: The X-Opaque-Id of the searches of the request
+        :return:
+        """
+        with self._lock:
+            pending = self._pending.get(id(client))
+            if pending is not None:
+                pending[1].add(opaque_id)
+                return
+            self._pending[id(client)] = (client, {opaque_id})
+
+        timer = threading.Timer(self.interval, self._cancel_pending, args=(id(client),))
+        timer.daemon = True
+        timer.start()
+
+    def _cancel_pending(self, key: int):
+        with self._lock:
+            client, opaque_ids = self._pending.pop(key)
+        try:
+            tasks = client.tasks.list(actions="*search*", group_by="none")
+            cancelled = 0
+            for task in tasks.get("tasks", []):
+                # Cancelling a search also cancels its child tasks on the shards
+                if task.get("headers", {}).get("X-Opaque-Id") in opaque_ids \
+                        and task.get("cancellable") and "parent_task_id" not in task:
+                    client.tasks.cancel(task_id=f"{task['node']}:{task['id']}")
+                    cancelled += 1
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to cancel the searches of %d requests", len(opaque_ids))
+            return
+        logger.info("Cancelled %d searches of %d disconnected requests", cancelled,
+                    len(opaque_ids))
+
+
+search_canceller = SearchCanceller()
@@ -0,0 +1,96 @@
+"""
+cost.py
+Guards against expensive search and facet requests, based on the cost policy of a dataset.
+Requests over a limit are rejected with a QueryCostException, or, if the policy allows it and the
+request can still be answered meaningfully, degraded to the limit.
+"""
+import re
+from typing import Tuple
+
+from app.exceptions.search import QueryCostException
+from app.models import CostPolicy
+from app.services.search.dataclasses import FilterOptions
+
+
+def limit_page(policy: CostPolicy, offset: int, limit: int) -> Tuple[int, int]:
+    """
+    Limit the page size of a search, and check the page is within the result window.
+    :param policy:
+    :param offset:
+    :param limit:
+    :return: The offset and the (possibly reduced) page size
+    """
+    if limit > policy.max_page_size:
+        if not policy.degrade:
+            raise QueryCostException("Page size too large", "max_page_size",
+                                     policy.max_page_size)
+        limit = policy.max_page_size
+    if offset + limit > policy.max_result_window:
+        raise QueryCostException("Offset too large", "max_result_window",
+                                 policy.max_result_window)
+    return offset, limit
+
+
+def limit_buckets(policy: CostPolicy, amount: int) -> int:
+    """
+    Limit the amount of options requested for a facet.
+    :param policy:
+    :param amount:
+    :return:
+    """
+    if amount <= policy.max_facet_amount:
+        return amount
+    if not policy.degrade:
+        raise QueryCostException("Too many facet options requested", "max_facet_amount",
+                                 policy.max_facet_amount)
+    return policy.max_facet_amount
+
+
+def check_filters(policy: CostPolicy, filter_options: FilterOptions):
+    """
+    Check the amount of selected facet values.
+    :param policy:
+    :param filter_options:
+    :return:
+    """
+    values = sum(len(values) for values in filter_options.facets.values())
+    if values > policy.max_filter_values:
+        raise QueryCostException("Too many facet values selected", "max_filter_values",
+                                 policy.max_filter_values)
+
+
+def check_facet_filter(policy: CostPolicy, facet_filter: str | None):
+    """
+    Check the length of a filter for facet options. Facet filters are executed as regular
+    expressions or lists of values, which get slower with longer filters.
+    :param policy:
+    :param facet_filter:
+    :return:
+    """
+    if facet_filter and len(facet_filter) > policy.max_facet_filter_length:
+        raise QueryCostException("Facet filter too long", "max_facet_filter_length",
+                                 policy.max_facet_filter_length)
+
+
+def check_query(policy: CostPolicy, query: str) -> str:
+    """
+    Check a text query. Prefix queries with a very short prefix (like a*) expand to a huge amount
+    of terms; these are removed when degrading.
+    :param policy:
+    :param query:
+    :return: The (possibly degraded) query
+    """
+    if len(query) > policy.max_query_length:
+        raise QueryCostException("Query too long", "max_query_length", policy.max_query_length)
+    if "PREFIX" not in policy.query_operators or policy.min_prefix_length <= 0:
+        return query
+
+    short_prefix = re.compile(
+        rf'(^|[\s+\-|("])([^\s+\-|()"*\\]{{0,{policy.min_prefix_length - 1}}})\*+'
+    )
+    if short_prefix.search(query) is None:
+        return query
+    if not policy.degrade:
+        raise QueryCostException("Prefix too short", "min_prefix_length",
+                                 policy.min_prefix_length)
+    return short_prefix.sub(r"\1\2", query)
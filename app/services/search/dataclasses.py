@@ -3,13 +3,15 @@ dataclasses.py
 Data classes for dealing with the search services.
 """
 
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional
 from enum import StrEnum
 
 import jsonpath
 
-from app.models import BaseProperty
+from app.models import BaseProperty, Facet
+from app.services.profiling import Profile, phase
 
 
 @dataclass
@@ -78,6 +80,67 @@ class FilterOptions:
         self.facets.pop(name, None)
 
 
+@dataclass
+class FacetRequest:
+    """
+    A search request for the options of a facet, with what is needed to process the response
+    """
+    facet: Facet
+    amount: int
+    body: Dict
+    agg_settings: Dict
+    # Whether the aggregation is done on a sample of the documents
+    sampled: bool = False
+
+
+@dataclass
+class RequestOrigin:
+    """
+    Where a search request came from
+    """
+    tenant: Optional[str] = None
+    dataset: Optional[str] = None
+    endpoint: Optional[str] = None
+
+    def __str__(self):
+        return f"{self.tenant}/{self.dataset}/{self.endpoint}"
+
+
+@dataclass
+class SearchContext:
+    """
+    Information about the request a search is executed for
+    """
+    # Routes the searches of a session to the same shard copies
+    preference: Optional[str] = None
+    # Time (time.monotonic) after which the searches are abandoned
+    deadline: Optional[float] = None
+    # Identifies the searches of the request in the Elasticsearch task list, for cancelling them
+    opaque_id: Optional[str] = None
+    # Set when a search returned partial results, because shards timed out or failed
+    partial: bool = False
+    # Set when the request is being profiled
+    profile: Optional[Profile] = None
+    origin: RequestOrigin = field(default_factory=RequestOrigin)
+
+    def phase(self, name: str):
+        """
+        Measure a phase of the request if it is being profiled.
+        :param name:
+        :return: A context manager
+        """
+        return phase(self.profile, name)
+
+    def remaining(self) -> Optional[float]:
+        """
+        Get the time left until the deadline, in seconds.
+        :return: None if there is no deadline
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+
 @dataclass
 class SearchResult:
     """
@@ -86,6 +149,8 @@ class SearchResult:
     total_results: int
     pages: int
     items: List[ResultItem]
+    # "eq" if total_results is exact, "gte" if it is a lower bound
+    total_relation: str = "eq"
 
     def format_results(self, properties: List[BaseProperty]) -> List[Dict]:
         """
@@ -3,18 +3,96 @@ elastic_index.py
 This includes class Index for dealing with Elasticsearch.
 Contains methods for finding articles.
 """
-import datetime
+import copy
+import hashlib
+import logging
 import math
-from typing import List, Dict
+import time
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 import re
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
+import numpy as np
 from elasticsearch import Elasticsearch
 
-from app.exceptions.search import UnknownFacetsException
-from app.models import Facet, FacetType
-from app.services.search.dataclasses import FilterOptions, SearchResult, ResultItem, Sort
+from app.exceptions.search import DeadlineExceededException
+from app.models import Facet, FacetType, SearchConfiguration, SamplingMethod
+from app.services.search.dataclasses import (FilterOptions, SearchResult, ResultItem, Sort,
+                                             SearchContext, FacetRequest)
+from app.services.cache import TTLCache
+from app.services.metrics import ES_DURATION, ES_OVERHEAD, ES_TOOK
+from app.services.search.cancellation import search_canceller
+from app.services.search.cost import check_facet_filter, limit_buckets, limit_page
+from app.services.search.facet_values import FacetValueIndex, facet_value_registry
+from app.services.search.query_builder import QueryBuilder
+from app.services.search.slow_log import ElasticRequest, slow_query_log
+from app.services.search.text import normalize_value
+
+logger = logging.getLogger(__name__)
+
+# Minimum and maximum values of fields without a search context, per (index, field)
+min_max_cache = TTLCache(maxsize=4096, ttl=60, name="min_max", shared=True)
+# Options of the facets without a search context, per (index, amount, facets)
+facet_options_cache = TTLCache(maxsize=1024, ttl=60, name="facet_options", shared=True)
+
+# Amount of options to get for building the tree of a tree facet
+TREE_BUCKETS = 10000
+# Most values matching a facet filter which are included by name, the most frequent first
+MAX_INCLUDE_VALUES = 10000
+# Original values per bucket of a normalized subfield, for finding the spelling of the value
+DISPLAY_VALUES = 10
+# Page size when loading all values of a facet
+COMPOSITE_PAGE_SIZE = 10000
+# Target amount of buckets for date facets without an interval
+DEFAULT_DATE_BUCKETS = 50
+# Target amount of buckets for histogram facets without an interval. Histograms are merged into at
+# most twice as many buckets as the target.
+DEFAULT_HISTOGRAM_BUCKETS = 50
+# Fraction of the time left until the deadline of a request which shards get for searching
+SHARD_TIMEOUT_FRACTION = 0.8
+# Tails of a histogram with less than this fraction of the documents are merged into one bucket
+SPARSE_TAIL_FRACTION = 0.01
+# Map interval units to relativedelta keyword arguments
+INTERVAL_UNITS = {
+    's': 'seconds',
+    'm': 'minutes',
+    'h': 'hours',
+    'd': 'days',
+    'M': 'months',
+    'y': 'years'
+}
+# Units which can be used as a fixed interval in a date histogram, with their numpy unit
+FIXED_INTERVAL_UNITS = {'s': 's', 'm': 'm', 'h': 'h', 'd': 'D'}
+# Minimum interval of an auto date histogram, per unit
+MINIMUM_INTERVALS = {
+    's': 'second',
+    'm': 'minute',
+    'h': 'hour',
+    'd': 'day',
+    'M': 'month',
+    'y': 'year'
+}
+
+
+@lru_cache(maxsize=64)
+def split_interval(interval_str: str) -> Tuple[int, str]:
+    """
+    Split an Elasticsearch interval like "5y" into its value and unit.
+    :param interval_str:
+    :return:
+    """
+    # Regex to extract the numeric value and the unit character
+    match = re.match(r"(\d+)\s*([a-zA-Z]+)", interval_str.strip())
+    if not match:
+        raise ValueError(f"Invalid format: {interval_str}")
+
+    value = int(match.group(1))
+    unit = match.group(2)
+
+    if unit not in INTERVAL_UNITS:
+        raise ValueError(f"Unsupported unit: {unit}. Use s, m, h, d, M, or y.")
+    return value, unit
 
 
 def parse_interval(interval_str):
@@ -25,30 +103,226 @@ def parse_interval(interval_str):
     Supports: s (seconds), m (minutes), h (hours), d (days),
               M (months), y (years)
     """
-    # Regex to extract the numeric value and the unit character
-    match = re.match(r"(\d+)\s*([a-zA-Z]+)", interval_str.strip())
-    if not match:
-        raise ValueError(f"Invalid format: {interval_str}")
+    value, unit = split_interval(interval_str)
 
-    value = int(match.group(1))
-    unit = match.group(2)
+    # Create the relativedelta object
+    kwargs = {INTERVAL_UNITS[unit]: value}
+    return relativedelta(**kwargs)
+
+
+def bucket_ends(starts: np.ndarray, interval_str: str) -> np.ndarray:
+    """
+    Get the (inclusive) end of date histogram buckets, one second before the start of the next
+    bucket.
+    :param starts: Start of the buckets, as datetime64
+    :param interval_str: Interval of the buckets, for example "5y"
+    :return:
+    """
+    value, unit = split_interval(interval_str)
+    starts = starts.astype("datetime64[ms]")
+    if unit in FIXED_INTERVAL_UNITS:
+        ends = starts + np.timedelta64(value, FIXED_INTERVAL_UNITS[unit])
+    else:
+        # Months and years have a variable length, so add them to the month of the start
+        months = value * 12 if unit == 'y' else value
+        start_months = starts.astype("datetime64[M]")
+        ends = (start_months + months).astype("datetime64[ms]") + (starts - start_months)
+    return ends - np.timedelta64(1, 's')
+
+
+def nice_interval(minimum: float, maximum: float, buckets: int) -> float:
+    """
+    Get a round interval (1, 2 or 5 times a power of ten) which divides the range from :minimum: to
+    :maximum: into at most about :buckets: buckets.
+    :param minimum:
+    :param maximum:
+    :param buckets:
+    :return:
+    """
+    span = maximum - minimum
+    if span <= 0:
+        return 1
+    raw = span / buckets
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(step for step in (1, 2, 5, 10) if raw <= step * magnitude)
+    interval = step * magnitude
+    if float(minimum).is_integer() and float(maximum).is_integer():
+        # Don't split integer values like years
+        interval = max(interval, 1)
+    return interval
+
+
+def merge_sparse_tails(starts: np.ndarray, ends: np.ndarray,
+                       counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merge the buckets at the start and end of a histogram containing only a small fraction of the
+    documents (for example because of a few outliers) into a single bucket on both sides.
+    :param starts:
+    :param ends:
+    :param counts:
+    :return: The new starts, ends and counts
+    """
+    threshold = counts.sum() * SPARSE_TAIL_FRACTION
+    # First bucket where the head contains more than the threshold, same for the tail
+    head = int(np.searchsorted(np.cumsum(counts), threshold, side="right"))
+    tail = len(counts) - 1 - int(np.searchsorted(np.cumsum(counts[::-1]), threshold, side="right"))
+    if head >= tail:
+        return starts, ends, counts
+
+    merged_counts = counts[head:tail + 1].copy()
+    merged_counts[0] += counts[:head].sum()
+    merged_counts[-1] += counts[tail + 1:].sum()
+    merged_starts = starts[head:tail + 1].copy()
+    merged_starts[0] = starts[0]
+    merged_ends = ends[head:tail + 1].copy()
+    merged_ends[-1] = ends[-1]
+    return merged_starts, merged_ends, merged_counts
+
+
+def shape_histogram(keys: np.ndarray, counts: np.ndarray, interval: float,
+                    max_buckets: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Turn the buckets of a histogram into start, end and count columns with at most :max_buckets:
+    buckets. Gaps are filled with empty buckets. If there are too many buckets, sparse tails are
+    merged first, then adjacent buckets are merged.
+    :param keys: Start of each bucket
+    :param counts: Document count of each bucket
+    :param interval:
+    :param max_buckets:
+    :return: Starts, ends and counts of the buckets
+    """
+    if len(keys) == 0:
+        return keys, keys, counts
+
+    positions = np.rint((keys - keys[0]) / interval).astype(np.int64)
+    filled = np.zeros(positions[-1] + 1, dtype=np.int64)
+    filled[positions] = counts
+    starts = keys[0] + np.arange(len(filled)) * interval
+    ends = starts + interval
+
+    if len(filled) > max_buckets:
+        starts, ends, filled = merge_sparse_tails(starts, ends, filled)
+    if len(filled) > max_buckets:
+        factor = math.ceil(len(filled) / max_buckets)
+        groups = np.arange(0, len(filled), factor)
+        ends = ends[np.minimum(groups + factor, len(filled)) - 1]
+        starts = starts[groups]
+        filled = np.add.reduceat(filled, groups)
+    return starts, ends, filled
+
+
+def is_partial(response: Dict) -> bool:
+    """
+    Check whether a search response misses results, as the search timed out or shards failed.
+    :param response:
+    :return:
+    """
+    return bool(response.get("timed_out") or response.get("_shards", {}).get("failed"))
+
+
+def display_value(bucket: Dict):
+    """
+    Get the value of a terms bucket as it is stored. Buckets of a normalized subfield have the
+    most frequent original values of their documents, the first one normalizing to the key is used.
+    :param bucket:
+    :return:
+    """
+    for original in bucket.get("values", {}).get("buckets", []):
+        value = str(original["key"])
+        if value.lower() == bucket["key"] or normalize_value(value) == bucket["key"]:
+            return original["key"]
+    return bucket["key"]
 
-    # Map unit characters to relativedelta keyword arguments
-    unit_mapping = {
-        's': 'seconds',
-        'm': 'minutes',
-        'h': 'hours',
-        'd': 'days',
-        'M': 'months',
-        'y': 'years'
+
+def make_date_histogram(facet: Facet) -> Tuple[str, Dict]:
+    """
+    Create the aggregation for a date facet. Uses the interval of the facet if there is one and
+    Elasticsearch supports it, otherwise lets Elasticsearch choose an interval resulting in
+    about the target amount of buckets.
+    :param facet:
+    :return: Aggregation type and settings
+    """
+    agg_settings = {
+        "field": facet.property,
+        "format": "yyyy-MM-dd"
     }
+    if facet.interval:
+        interval = str(facet.interval)
+        value, unit = split_interval(interval)
+        if unit in FIXED_INTERVAL_UNITS:
+            return 'date_histogram', {**agg_settings, "fixed_interval": interval}
+        if value == 1:
+            return 'date_histogram', {**agg_settings, "calendar_interval": interval}
+        # Multiple months or years are not supported as calendar interval
+        agg_settings["minimum_interval"] = MINIMUM_INTERVALS[unit]
+    agg_settings["buckets"] = facet.buckets or DEFAULT_DATE_BUCKETS
+    return 'auto_date_histogram', agg_settings
+
+
+def format_date_buckets(buckets: List[Dict], interval: str) -> List[Dict]:
+    """
+    Format the buckets of a date histogram. We need to make the labels more clear by adding the
+    'to' end of the bucket.
+    :param buckets:
+    :param interval: Interval of the histogram, like "1y"
+    :return:
+    """
+    starts = np.array([hits["key"] for hits in buckets], dtype="datetime64[ms]")
+    ends = np.datetime_as_string(bucket_ends(starts, interval), unit="D").tolist()
+    return [{"value": hits["key_as_string"],
+             "start": hits["key_as_string"],
+             "end": end,
+             "count": hits["doc_count"],
+             }
+            for hits, end in zip(buckets, ends)]
+
+
+def format_histogram_buckets(buckets: List[Dict], interval: float,
+                             max_buckets: int) -> List[Dict]:
+    """
+    Format the buckets of a histogram, limiting the amount of buckets.
+    :param buckets:
+    :param interval:
+    :param max_buckets:
+    :return:
+    """
+    starts, ends, counts = shape_histogram(
+        np.array([hits["key"] for hits in buckets], dtype=np.float64),
+        np.array([hits["doc_count"] for hits in buckets], dtype=np.int64),
+        interval, max_buckets
+    )
+    return [{"value": start, "start": start, "end": end, "count": count}
+            for start, end, count in zip(starts.tolist(), ends.tolist(), counts.tolist())]
 
-    if unit not in unit_mapping:
-        raise ValueError(f"Unsupported unit: {unit}. Use s, m, h, d, M, or y.")
 
-    # Create the relativedelta object
-    kwargs = {unit_mapping[unit]: value}
-    return relativedelta(**kwargs)
+def record_timing(operation: str, index: str, started: float, took: int | None = None):
+    """
+    Record the duration of an Elasticsearch request, and the part of it spent outside of
+    Elasticsearch (network, queueing, serialization) if Elasticsearch reported how long it took.
+    :param operation:
+    :param index:
+    :param started: time.monotonic() before the request
+    :param took: Milliseconds Elasticsearch reported spending
+    :return:
+    """
+    duration = time.monotonic() - started
+    ES_DURATION.observe(operation, index, value=duration)
+    if took is not None:
+        ES_TOOK.observe(operation, index, value=took / 1000)
+        ES_OVERHEAD.observe(operation, index, value=max(0.0, duration - took / 1000))
+
+
+def make_order(sort: str) -> Dict:
+    """
+    Create the order of a terms aggregation.
+    :param sort:
+    :return:
+    """
+    return {
+        str(Sort.ASC): { "_key": str(Sort.ASC) },
+        str(Sort.DESC): { "_key": str(Sort.DESC) },
+        str(Sort.HITS): { "_count": str(Sort.DESC) },
+    }.get(sort, { "_count": str(Sort.DESC) })
 
 
 class Index:
@@ -58,154 +332,330 @@ class Index:
     client: Elasticsearch
     index_name: str
     facet_configuration: Dict[str, Facet]
+    config: SearchConfiguration
+    context: SearchContext
+    query_builder: QueryBuilder
+    cluster: Optional[str]
 
-    def __init__(self, client: Elasticsearch, index_name: str, available_facets: List[Facet]):
+    def __init__(self, client: Elasticsearch, index_name: str, available_facets: List[Facet],
+                 config: SearchConfiguration | None = None):
         self.client = client
         self.index_name = index_name
         self.facet_configuration = {
             facet.property: facet
             for facet in available_facets
         }
+        self.config = config or SearchConfiguration()
+        self.context = SearchContext()
+        self.query_builder = QueryBuilder(self.facet_configuration, self.config)
+        self.cluster = None
 
-    @staticmethod
-    def no_case(str_in):
+    @property
+    def cache_name(self) -> str:
         """
-        Create query from string, case-insensitive.
-        :param str_in:
+        Name of the index in in-process caches. Indexes with the same name can live in
+        different clusters.
         :return:
         """
-        string = str_in.strip()
-        ret_str = ""
-        if string != "":
-            for char in string:
-                ret_str = ret_str + "[" + char.upper() + char.lower() + "]"
-        return ret_str + ".*"
+        if self.cluster is None:
+            return self.index_name
+        return f"{self.cluster}:{self.index_name}"
 
-    def make_matches(self, filter_options: FilterOptions) -> List:
+    def msearch(self, bodies: List[Dict]) -> List[Dict]:
         """
-        Create match queries.
+        Execute multiple search requests on the index in a single round-trip, with the same
+        caching and preference as Index.search.
+        :param bodies:
+        :return: The responses, in the same order as the bodies
+        """
+        if not bodies:
+            return []
+        client, timeout = self._request_options()
+        searches = []
+        for body in bodies:
+            header = {}
+            if self.context.preference is not None:
+                header["preference"] = self.context.preference
+            if body.get("size") == 0:
+                header["request_cache"] = True
+            if timeout is not None:
+                body = {**body, "timeout": timeout}
+            if self.context.profile is not None:
+                body = {**body, "profile": True}
+            searches.extend([header, body])
+        started = time.monotonic()
+        with self.context.phase("elasticsearch"):
+            result = client.msearch(index=self.index_name, searches=searches)
+        record_timing("msearch", self.cache_name, started, result.get("took"))
+        duration = time.monotonic() - started
+        responses = result["responses"]
+        for body, response in zip(searches[1::2], responses):
+            # Searches are recorded with their own time, not with the time of the whole msearch
+            slow_query_log.record(self.context, ElasticRequest(
+                "msearch", body, response, response.get("took", duration * 1000) / 1000))
+            self._check_partial(response)
+            if self.context.profile is not None:
+                self.context.profile.add_elasticsearch("msearch", response)
+        return responses
+
+    def search(self, body: Dict, **params):
+        """
+        Execute a search request on the index. Aggregation-only requests use the shard request
+        cache. Requests within the same session prefer the same shard copies, so they hit warm
+        caches.
+        :param body:
+        :param params: Additional parameters for the search API
+        :return:
+        """
+        if body.get("size") == 0:
+            params.setdefault("request_cache", True)
+        client, timeout = self._request_options()
+        if timeout is not None:
+            params.setdefault("timeout", timeout)
+        if self.context.profile is not None:
+            body = {**body, "profile": True}
+        started = time.monotonic()
+        with self.context.phase("elasticsearch"):
+            response = client.search(index=self.index_name, body=body,
+                                     preference=self.context.preference, **params)
+        record_timing("search", self.cache_name, started, response.get("took"))
+        slow_query_log.record(self.context, ElasticRequest("search", body, response,
+                                                           time.monotonic() - started))
+        self._check_partial(response)
+        if self.context.profile is not None:
+            self.context.profile.add_elasticsearch("search", response)
+        return response
+
+    def _request_options(self) -> Tuple[Elasticsearch, Optional[str]]:
+        """
+        Get the client to use for a request within the deadline of the context, and the search
+        timeout for the shards. Shards get a bit less time than the request itself, so timed out
+        shards still result in partial results instead of an error.
+        :return:
+        """
+        options = {}
+        if self.context.opaque_id is not None:
+            options["opaque_id"] = self.context.opaque_id
+        remaining = self.context.remaining()
+        timeout = None
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceededException("Deadline exceeded before searching")
+            options["request_timeout"] = remaining
+            timeout = f"{max(1, int(remaining * 1000 * SHARD_TIMEOUT_FRACTION))}ms"
+        return (self.client.options(**options) if options else self.client), timeout
+
+    def _check_partial(self, response):
+        if is_partial(response):
+            self.context.partial = True
+
+    def cancel(self):
+        """
+        Cancel the searches of the current request which are still running in Elasticsearch.
+        They are cancelled in a batch with those of other requests, in the background.
+        :return:
+        """
+        if self.context.opaque_id is not None:
+            search_canceller.cancel(self.client, self.context.opaque_id)
+
+    def make_histogram(self, facet: Facet, filter_options: FilterOptions) -> Dict:
+        """
+        Create the settings of a histogram aggregation. Without a fixed interval, or with a target
+        amount of buckets, the interval is derived from the minimum and maximum value for the
+        current filter. A fixed interval is then used as the minimum interval.
+        :param facet:
         :param filter_options:
         :return:
         """
-        must_collection = []
-        unknown_facets = []
-        for key, values in filter_options.facets.items():
-            if key not in self.facet_configuration:
-                unknown_facets.append(key)
-                continue
-            facet = self.facet_configuration[key]
-            if facet.type in [FacetType.RANGE, FacetType.HISTOGRAM, FacetType.DATE]:
-                range_values = values[0]
-                r_array = range_values.split(':')
-                must_collection.append(
-                    {"range": {key: {"gte": r_array[0], "lte": r_array[1]}}}
-                )
-            else:
-                must_collection.append({"terms": {key: values}})
-        if unknown_facets:
-            raise UnknownFacetsException("Unknown facets", unknown_facets)
-        if filter_options.query != '':
-            must_collection.append(
-                {
-                    "simple_query_string": {
-                        "query": filter_options.query,
-                        "fields": ["*"],
-                    }
-                }
-            )
-        return must_collection
+        interval = facet.interval
+        if facet.buckets or not interval:
+            min_max = self.get_min_max([facet.property], filter_options)[facet.property]
+            if min_max.get("min") is not None and min_max.get("max") is not None:
+                derived = nice_interval(min_max["min"], min_max["max"],
+                                        facet.buckets or DEFAULT_HISTOGRAM_BUCKETS)
+                interval = max(derived, interval or 0)
+        return {
+            "field": facet.property,
+            "interval": interval or 1,
+        }
+
+    def get_indexed_facet(self, facet: Facet, amount: int, facet_filter: str,
+                          sort: str = "hits") -> List[Dict] | None:
+        """
+        Get the options for a text facet from the in-memory value index, ignoring the search
+        context. Returns None if the facet is not (yet) indexed.
+        :param facet:
+        :param amount:
+        :param facet_filter:
+        :param sort:
+        :return:
+        """
+        value_index = self._value_index(facet)
+        if value_index is None:
+            return None
+        return value_index.top(facet_filter, limit_buckets(self.config.cost, amount), sort)
+
+    def _value_index(self, facet: Facet) -> FacetValueIndex | None:
+        """
+        Get the in-memory value index of a text facet. Returns None if the facet is not (yet)
+        indexed.
+        :param facet:
+        :return:
+        """
+        if facet.type != FacetType.TEXT:
+            return None
+        # The values are loaded in the background, outside the deadline of the request
+        background = copy.copy(self)
+        background.context = SearchContext()
+        return facet_value_registry.get(
+            self.cache_name, facet.property, background.get_generation,
+            lambda max_values: background.get_values(facet.property, max_values)
+        )
 
     # 5 args as max is a bit conservative - we can gather args into objects,
     # but sorting options appear a valid separate arg to me...
-    def get_facet(self, facet: Facet, amount: int, facet_filter: str, # pylint: disable=too-many-arguments,too-many-positional-arguments
-                  filter_options: FilterOptions, sort: str = "hits"):
+    def make_facet_request(self, facet: Facet, amount: int, facet_filter: str, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                           filter_options: FilterOptions, sort: str = "hits") -> FacetRequest:
         """
-        Get the available options for a specific facet, based on a search query. This is used for
-        showing the options still relevant given the current search query.
-        :param sort:
+        Create the search request for the options of a facet.
         :param facet:
         :param amount:
         :param facet_filter:
         :param filter_options:
+        :param sort:
         :return:
         """
-        val_key = "key"
+        check_facet_filter(self.config.cost, facet_filter)
+        if facet.type == FacetType.TREE:
+            amount = min(amount, self.config.cost.max_tree_buckets)
+        else:
+            amount = limit_buckets(self.config.cost, amount)
+
         if facet.type == FacetType.HISTOGRAM:
-            agg_settings = {
-                "field": facet.property,
-                "interval": facet.interval,
-            }
+            agg_settings = self.make_histogram(facet, filter_options)
             agg_type = 'histogram'
         elif facet.type == FacetType.DATE:
-            agg_settings = {
-                "field": facet.property,
-                # "buckets": 50,
-                "calendar_interval": "1y",
-                "format": "yyyy-MM-dd"
-            }
-            agg_type = 'date_histogram'
-            val_key = "key_as_string"
+            agg_type, agg_settings = make_date_histogram(facet)
         else:
-            order = {
-                str(Sort.ASC): { "_key": str(Sort.ASC) },
-                str(Sort.DESC): { "_key": str(Sort.DESC) },
-                str(Sort.HITS): { "_count": str(Sort.DESC) },
-            }.get(sort, { "_count": str(Sort.DESC) })
             agg_settings = {
                 "field": facet.property,
                 "size": amount,
-                "order": order
+                "order": make_order(sort)
             }
             agg_type = 'terms'
 
-        if facet_filter:
-            filtered_filter = ''.join([f"[{char.upper()}{char.lower()}]" for char in facet_filter])
-            agg_settings["include"] = f'.*{filtered_filter}.*'
+        aggs = {
+            "names": {
+                agg_type: agg_settings
+            }
+        }
+        # Only narrow down the options of terms facets using the filter
+        if facet_filter and agg_type == 'terms':
+            value_index = self._value_index(facet)
+            agg_settings.update(self.query_builder.make_facet_include(
+                facet.property, facet_filter,
+                None if value_index is None else
+                [option["value"] for option in value_index.top(facet_filter, MAX_INCLUDE_VALUES)]
+            ))
+            if agg_settings["field"] != facet.property:
+                aggs["names"]["aggs"] = {
+                    "values": {"terms": {"field": facet.property, "size": DISPLAY_VALUES}}
+                }
+        sampled = self.query_builder.use_sampling(facet)
+        if sampled:
+            aggs = self.query_builder.make_sampler(aggs)
 
         body = {
             "size": 0,
-            "aggs": {
-                "names": {
-                    agg_type: agg_settings
-                }
-            }
+            "query": self.query_builder.make_query(filter_options, scoring=False),
+            "aggs": aggs
         }
+        if sampled and self.config.sampling.method != SamplingMethod.RANDOM:
+            # Needed for scaling the counts of samplers
+            body["track_total_hits"] = True
+        return FacetRequest(facet=facet, amount=amount, body=body, agg_settings=agg_settings,
+                            sampled=sampled)
+
+    def format_facet_response(self, request: FacetRequest, response) -> List[Dict]:
+        """
+        Process the response to a facet request into a list of options.
+        :param request:
+        :param response:
+        :return:
+        """
+        facet = request.facet
+        aggregation = response["aggregations"]
+        scale = None
+        if request.sampled:
+            aggregation = aggregation["sample"]
+            scale = self.sample_scale(aggregation, response)
+        aggregation = aggregation["names"]
 
-        if filter_options.not_empty():
-            filter_options.remove_facet(facet.property)
-            body["query"] = {
-                "bool": {
-                    "must": self.make_matches(filter_options)
-                }
-            }
-        response = self.client.search(index=self.index_name, body=body)
         if facet.type == FacetType.DATE:
-            # We need to make the labels more clear by adding the 'to' end of the bucket
-            # interval = response["aggregations"]["names"]["interval"]
-
-            response_data = [{"value": hits[val_key],
-                              "start": hits[val_key],
-                              "end": (datetime.strptime(hits[val_key], "%Y-%m-%d").date()
-                                     + parse_interval("1y") - relativedelta(seconds=1))
-                              .strftime("%Y-%m-%d"),
-                              "count": hits["doc_count"],
-                              }
-                             for hits in response["aggregations"]["names"]["buckets"]]
+            # The interval of an auto date histogram is only known afterwards
+            response_data = format_date_buckets(
+                aggregation["buckets"],
+                aggregation.get("interval") or request.agg_settings.get("calendar_interval")
+                or request.agg_settings.get("fixed_interval")
+            )
         elif facet.type == FacetType.HISTOGRAM:
-            interval = facet.interval
-            response_data = [{"value": hits[val_key],
-                              "start": hits[val_key],
-                              "end": hits[val_key] + interval,
-                              "count": hits["doc_count"],
-                              }
-                             for hits in response["aggregations"]["names"]["buckets"]]
+            response_data = format_histogram_buckets(
+                aggregation["buckets"], request.agg_settings["interval"],
+                2 * (facet.buckets or DEFAULT_HISTOGRAM_BUCKETS)
+            )
         else:
-            response_data = [{"value": hits[val_key], "count": hits["doc_count"]}
-                             for hits in response["aggregations"]["names"]["buckets"]]
-
+            response_data = [{"value": display_value(hits), "count": hits["doc_count"]}
+                             for hits in aggregation["buckets"]]
 
+        if scale is not None:
+            response_data = [{**option, "count": round(option["count"] * scale),
+                              "approximate": True}
+                             for option in response_data]
         return response_data
 
+    def sample_scale(self, sample: Dict, response) -> float:
+        """
+        Get the factor to scale counts of a sampled aggregation with, to approximate the counts
+        of all documents.
+        :param sample: The sampler aggregation
+        :param response:
+        :return:
+        """
+        if self.config.sampling.method == SamplingMethod.RANDOM:
+            # Elasticsearch already scales the counts of a random sample
+            return 1
+        if not sample["doc_count"]:
+            return 1
+        return response["hits"]["total"]["value"] / sample["doc_count"]
+
+    # 5 args as max is a bit conservative - we can gather args into objects,
+    # but sorting options appear a valid separate arg to me...
+    def get_facet(self, facet: Facet, amount: int, facet_filter: str, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                  filter_options: FilterOptions, sort: str = "hits"):
+        """
+        Get the available options for a specific facet, based on a search query. This is used for
+        showing the options still relevant given the current search query.
+        :param sort:
+        :param facet:
+        :param amount:
+        :param facet_filter:
+        :param filter_options:
+        :return:
+        """
+        # The options of a facet do not depend on the selected values of that facet
+        filter_options.remove_facet(facet.property)
+
+        # Without a search context, options can be looked up in the in-memory value index
+        if (not filter_options.not_empty() and
+                (options := self.get_indexed_facet(facet, amount, facet_filter, sort)) is not None):
+            return options
+
+        with self.context.phase("query_building"):
+            request = self.make_facet_request(facet, amount, facet_filter, filter_options, sort)
+        response = self.search(request.body)
+        with self.context.phase("post_processing"):
+            return self.format_facet_response(request, response)
+
     def get_tree(self, facet: Facet, filter_options: FilterOptions):
         """
         Get the tree with all options for a tree facet
@@ -213,9 +663,19 @@ class Index:
         :param filter_options:
         :return:
         """
-        options = self.get_facet(facet, 10000, "",
+        options = self.get_facet(facet, TREE_BUCKETS, "",
                                  filter_options)
+        with self.context.phase("post_processing"):
+            return self.build_tree(facet, options)
 
+    @staticmethod
+    def build_tree(facet: Facet, options: List[Dict]) -> List:
+        """
+        Build the tree of a tree facet from its options.
+        :param facet:
+        :param options:
+        :return:
+        """
         tree = {}
 
         for option in options:
@@ -250,7 +710,7 @@ class Index:
         results based on the specified field and filter value. It performs an
         aggregation to find terms within the field that match the given filter,
         and sorts the results by document count in descending order. Only terms
-        that contain the filter value (case-insensitive) are included in the
+        that start with the filter value (case-insensitive) are included in the
         returned list.
 
         :param field: The field name in the Elasticsearch index to perform the
@@ -264,46 +724,81 @@ class Index:
             "doc_count" (the number of documents matching the term).
         :rtype: list[dict]
         """
-        ret_array = []
-        response = self.client.search(
-            index=self.index_name,
-            body=
-            {
-                "query": {
-                    "regexp": {
-                        field: self.no_case(facet_filter)
-                    }
-                },
+        check_facet_filter(self.config.cost, facet_filter)
+        terms = self.query_builder.make_facet_include(field, facet_filter)
+        aggregation = {"terms": {**terms, "size": 20, "order": {"_count": "desc"}}}
+        if terms["field"] != field:
+            aggregation["aggs"] = {"values": {"terms": {"field": field, "size": DISPLAY_VALUES}}}
+        response = self.search({"size": 0, "aggs": {"names": aggregation}})
+        return [{"key": display_value(hits), "doc_count": hits["doc_count"]}
+                for hits in response["aggregations"]["names"]["buckets"]]
+
+    def get_generation(self) -> str:
+        """
+        Get a string identifying the current contents of the index. It changes when documents are
+        added, updated or deleted, or when the index (or alias) is replaced.
+        :return:
+        """
+        stats = self.client.indices.stats(index=self.index_name, metric="docs")
+        return ";".join(
+            f"{name}:{data.get('uuid', '')}:{data['primaries']['docs']['count']}:"
+            f"{data['primaries']['docs']['deleted']}"
+            for name, data in sorted(stats["indices"].items())
+        )
+
+    def get_values(self, field: str, max_values: int) -> List[Tuple[str, int]] | None:
+        """
+        Get all values of :field: with their document counts, sorted by value.
+        :param field:
+        :param max_values: Stop loading when there are more values than this
+        :return: A list of (value, count) tuples, or None if there are too many values
+        """
+        values = []
+        after_key = None
+        while True:
+            composite = {
+                "size": COMPOSITE_PAGE_SIZE,
+                "sources": [{"value": {"terms": {"field": field}}}],
+            }
+            if after_key is not None:
+                composite["after"] = after_key
+            response = self.search({
                 "size": 0,
                 "aggs": {
-                    "names": {
-                        "terms": {
-                            "field": field,
-                            "size": 20,
-                            "order": {
-                                "_count": "desc"
-                            }
-                        }
+                    "values": {
+                        "composite": composite
                     }
                 }
-            }
-        )
-        for hits in response["aggregations"]["names"]["buckets"]:
-            buffer = {"key": hits["key"], "doc_count": hits["doc_count"]}
-            if facet_filter.lower() in buffer["key"].lower():
-                ret_array.append(buffer)
-        return ret_array
+            })["aggregations"]["values"]
+
+            values.extend((bucket["key"]["value"], bucket["doc_count"])
+                          for bucket in response["buckets"])
+            if len(values) > max_values:
+                return None
+            after_key = response.get("after_key")
+            if after_key is None or len(response["buckets"]) < COMPOSITE_PAGE_SIZE:
+                return values
 
-    def get_min_max(self, fields):
+    def get_min_max(self, fields, filter_options: FilterOptions | None = None):
         """
         Get the minimum and maximum value for fields in :fields:
         :param fields: A list of fields to get the min/max for
+        :param filter_options: Only take the documents matching these filters into account
         :return:
         """
         aggs = {}
         tmp = {}
 
+        unfiltered = filter_options is None or not filter_options.not_empty()
+        if unfiltered:
+            for field in fields:
+                cached = min_max_cache.get((self.cache_name, field))
+                if cached is not None:
+                    tmp[field] = dict(cached)
+
         for field in fields:
+            if field in tmp:
+                continue
             aggs[f"min-{field}"] = {
                 "min": {
                     "field": field,
@@ -316,65 +811,147 @@ class Index:
             }
             tmp[field] = {}
 
-        response = self.client.search(
-            index=self.index_name,
-            body={
-                "size": 0,
-                "aggs": aggs
-            }
-        )['aggregations']
+        if not aggs:
+            return tmp
+
+        body = {
+            "size": 0,
+            "aggs": aggs
+        }
+        if not unfiltered:
+            body["query"] = self.query_builder.make_query(filter_options, scoring=False)
+
+        response = self.search(body)
 
-        for key, value in response.items():
-            agg_type, field = key.split('-')
+        for key, value in response['aggregations'].items():
+            agg_type, field = key.split('-', 1)
             tmp[field][agg_type] = value['value']
 
+        if unfiltered and not is_partial(response):
+            for field in {key.split('-', 1)[1] for key in aggs}:
+                min_max_cache.set((self.cache_name, field), tmp[field])
+
         return tmp
 
-    def browse(self, offset: int, limit: int, filter_options: FilterOptions) -> SearchResult:
+    def get_initial_facets(self, facets: List[Facet], amount: int) -> Dict[str, List]:
+        """
+        Get the options of facets without a search context, using a single multi search request.
+        :param facets:
+        :param amount: Amount of options per (non-tree) facet
+        :return: The options per facet property
+        """
+        configuration = hashlib.sha1("".join(facet.model_dump_json() for facet in facets).encode(),
+                                     usedforsecurity=False).hexdigest()
+        key = (self.cache_name, amount, configuration)
+        cached = facet_options_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Get the minimum and maximum values needed for histogram intervals in one go, so they
+        # are cached when creating the requests.
+        derived = [facet.property for facet in facets
+                   if facet.type == FacetType.HISTOGRAM and (facet.buckets or not facet.interval)]
+        if derived:
+            self.get_min_max(derived)
+
+        options = {}
+        requests = []
+        complete = True
+        for facet in facets:
+            if facet.type == FacetType.RANGE:
+                continue
+            indexed = self.get_indexed_facet(facet, amount, "")
+            if indexed is not None:
+                options[facet.property] = indexed
+                continue
+            requests.append(self.make_facet_request(
+                facet, TREE_BUCKETS if facet.type == FacetType.TREE else amount, "",
+                FilterOptions(facets={})
+            ))
+
+        for request, response in zip(requests, self.msearch([req.body for req in requests])):
+            if "error" in response:
+                logger.warning("Unable to get the options of %s: %s", request.facet.property,
+                               response["error"])
+                complete = False
+                continue
+            complete = complete and not is_partial(response)
+            facet_options = self.format_facet_response(request, response)
+            if request.facet.type == FacetType.TREE:
+                facet_options = self.build_tree(request.facet, facet_options)
+            options[request.facet.property] = facet_options
+        if complete:
+            facet_options_cache.set(key, options)
+        return options
+
+    # Highlighting and counting are separate options, as both are expensive in their own way
+    def browse(self, offset: int, limit: int, filter_options: FilterOptions, # pylint: disable=too-many-arguments,too-many-positional-arguments
+               highlight: bool = True, track_total_hits: bool | int | None = None) -> SearchResult:
         """
         Search for articles.
         :param filter_options:
         :param offset: Pagination offset.
         :param limit: Pagination limit.
+        :param highlight: Whether to highlight the results. Highlighting is expensive, so skip it
+            when no result property uses it.
+        :param track_total_hits: Count the hits exactly (True), up to a threshold or not at all
+            (False). Defaults to the setting of the dataset.
         :return:
         """
-        if filter_options.not_empty():
-            query = {
-                "bool": {
-                    "must": self.make_matches(filter_options)
-                }
+        offset, limit = limit_page(self.config.cost, offset, limit)
+        with self.context.phase("query_building"):
+            body = {
+                "query": self.query_builder.make_query(filter_options),
+                "sort": [
+                    {"_score": {"order": "desc"}},
+                ],
+                "size": limit,
+                "from": offset,
+                "track_total_hits": self.config.track_total_hits
+                if track_total_hits is None else track_total_hits,
             }
-        else:
-            query = {
-                "match_all": {}
-            }
-
-        response = self.client.search(index=self.index_name, body={
-            "query": query,
-            "highlight": {
-                "number_of_fragments": 1,
-                "fields": {
-                    "*": {}
-                }
-            },
-            "sort": [
-                {"_score": {"order": "desc"}},
-            ],
-            "size": limit,
-            "from": offset,
-        })
+            if highlight:
+                body["highlight"] = self.query_builder.make_highlight()
+
+        response = self.search(body)
+
+        total = response["hits"].get("total")
+        if total is None:
+            # Hits are not counted, so we only know there are at least as many as we've seen
+            total = {"value": offset + len(response["hits"]["hits"]), "relation": "gte"}
+
+        with self.context.phase("post_processing"):
+            return SearchResult(
+                total_results=total["value"],
+                pages=math.ceil(total["value"] / limit),
+                total_relation=total["relation"],
+                items=[
+                    ResultItem(
+                        es_result=item["_source"],
+                        highlight=item.get("highlight", {}),
+                        index=item["_id"]
+                    ) for item in response["hits"]["hits"]
+                ]
+            )
 
-        return SearchResult(
-            total_results=response['hits']['total']['value'],
-            pages=math.ceil(response["hits"]["total"]["value"] / limit),
-            items=[
-                ResultItem(
-                    es_result=item["_source"],
-                    highlight=item.get("highlight", {}),
-                    index=item["_id"]
-                ) for item in response["hits"]["hits"]
-            ]
-        )
+    def count(self, filter_options: FilterOptions) -> int:
+        """
+        Count the documents matching the filter exactly.
+        :param filter_options:
+        :return:
+        """
+        client, _ = self._request_options()
+        query = self.query_builder.make_query(filter_options, scoring=False)
+        started = time.monotonic()
+        with self.context.phase("elasticsearch"):
+            response = client.count(index=self.index_name, body={
+                "query": query
+            }, preference=self.context.preference)
+        record_timing("count", self.cache_name, started)
+        slow_query_log.record(self.context, ElasticRequest("count", {"query": query}, response,
+                                                           time.monotonic() - started))
+        self._check_partial(response)
+        return response["count"]
 
     def by_identifier(self, identifier: str, field: str) -> ResultItem:
         """
@@ -383,10 +960,10 @@ class Index:
         :param identifier:
         :return:
         """
-        response = self.client.search(index=self.index_name, body={
+        response = self.search({
             "query": {
                 "bool": {
-                    "must": [
+                    "filter": [
                         {
                             "term": {
                                 field: identifier
@@ -0,0 +1,262 @@
+"""
+facet_values.py
+In-memory index of the values of text facets, used for filtering facet options (typeahead) without
+running an aggregation in Elasticsearch for every keystroke.
+"""
+import logging
+import math
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.services.memory import approximate_size
+from app.services.metrics import registry, timed_task, CACHE_ENTRIES, CACHE_REQUESTS
+from app.services.search.dataclasses import Sort
+from app.services.search.text import normalize_value
+
+# Size of the n-grams in the postings. Shorter filters scan all values.
+NGRAM_SIZE = 3
+# Facets with more values than this are not indexed in memory
+MAX_VALUES = 100_000
+# How often to check if the Elasticsearch index has changed, in seconds
+GENERATION_CHECK_INTERVAL = 30
+# Separates the values when they are joined into a single string for scanning
+VALUE_SEPARATOR = "\x00"
+
+logger = logging.getLogger(__name__)
+
+
+class FacetValueIndex:
+    """
+    Sorted, interned values of a facet with their document counts, plus n-gram postings for
+    finding the values containing a substring.
+    """
+    values: List[str]
+    counts: np.ndarray
+    normalized: List[str]
+    postings: Dict[str, np.ndarray]
+
+    def __init__(self, values: Iterable[Tuple[str, int]]):
+        """
+        :param values: (value, count) tuples, sorted the same way Elasticsearch sorts the keys
+        """
+        self.values = []
+        counts = []
+        for value, count in values:
+            self.values.append(sys.intern(str(value)))
+            counts.append(count)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.normalized = [normalize_value(value) for value in self.values]
+
+        postings = defaultdict(list)
+        for value_id, value in enumerate(self.normalized):
+            for gram in self.ngrams(value):
+                postings[gram].append(value_id)
+        self.postings = {
+            gram: np.array(value_ids, dtype=np.int32) for gram, value_ids in postings.items()
+        }
+
+        # Short filters are looked up by scanning all values joined into a single string
+        self.joined = VALUE_SEPARATOR.join(self.normalized)
+        lengths = np.array([len(value) + 1 for value in self.normalized], dtype=np.int64)
+        self.starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lengths) \
+            else np.array([], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.values)
+
+    @staticmethod
+    def ngrams(value: str) -> set:
+        """
+        Get the distinct n-grams of a (normalized) value.
+        :param value:
+        :return:
+        """
+        return {value[i:i + NGRAM_SIZE] for i in range(len(value) - NGRAM_SIZE + 1)}
+
+    def matching(self, facet_filter: str) -> np.ndarray:
+        """
+        Get the ids of the values containing :facet_filter:, ignoring case and diacritics. The ids
+        are sorted, so they are in the same order as the values.
+        :param facet_filter:
+        :return:
+        """
+        needle = normalize_value(facet_filter.strip())
+        if not needle:
+            return np.arange(len(self.values), dtype=np.int32)
+
+        if len(needle) >= NGRAM_SIZE:
+            postings = sorted(
+                (self.postings.get(gram, np.array([], dtype=np.int32))
+                 for gram in self.ngrams(needle)),
+                key=len
+            )
+            candidates = postings[0]
+            for posting in postings[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            # Having all n-grams does not mean the value contains the filter, so verify
+            return np.array([value_id for value_id in candidates.tolist()
+                             if needle in self.normalized[value_id]], dtype=np.int32)
+
+        positions = [match.start() for match in re.finditer(re.escape(needle), self.joined)]
+        return np.unique(np.searchsorted(self.starts, positions, side="right") - 1)
+
+    def top(self, facet_filter: str, amount: int, sort: str = "hits") -> List[Dict]:
+        """
+        Get the facet options containing :facet_filter:, in the same format and order as
+        Index.get_facet.
+        :param facet_filter:
+        :param amount:
+        :param sort:
+        :return:
+        """
+        value_ids = self.matching(facet_filter)
+        if sort == str(Sort.ASC):
+            value_ids = value_ids[:amount]
+        elif sort == str(Sort.DESC):
+            value_ids = value_ids[::-1][:amount]
+        else:
+            counts = self.counts[value_ids]
+            if len(value_ids) > amount:
+                top_k = np.argpartition(-counts, amount)[:amount]
+                value_ids, counts = value_ids[top_k], counts[top_k]
+            # Highest count first, ties by value like Elasticsearch does
+            value_ids = value_ids[np.lexsort((value_ids, -counts))]
+
+        return [{"value": self.values[value_id], "count": int(self.counts[value_id])}
+                for value_id in value_ids.tolist()]
+
+
+class FacetValueRegistry:
+    """
+    Keeps the value indexes per (Elasticsearch index, facet). Indexes are built in the background,
+    requests fall back on Elasticsearch until the index is available. When the generation of the
+    Elasticsearch index changes, the value index is rebuilt. The generation is checked in the
+    background as well, so a slow or failing check does not affect requests.
+    """
+    def __init__(self, max_values: int = MAX_VALUES,
+                 check_interval: float = GENERATION_CHECK_INTERVAL):
+        self.max_values = max_values
+        self.check_interval = check_interval
+        # Generation and value index per key. The value index is None if the facet has too many
+        # values to be indexed.
+        self._indexes: Dict[Tuple[str, str], Tuple[str, Optional[FacetValueIndex]]] = {}
+        self._generations: Dict[str, Tuple[float, Optional[str]]] = {}
+        self._checking = set()
+        self._building = set()
+        self._lock = threading.Lock()
+
+    def get(self, index_name: str, facet_property: str,
+            get_generation: Callable[[], str],
+            load_values: Callable[[int], Optional[List[Tuple[str, int]]]]
+            ) -> Optional[FacetValueIndex]:
+        """
+        Get the value index for a facet if it is available and up to date. Otherwise, schedule a
+        (re)build and return None.
+        :param index_name:
+        :param facet_property:
+        :param get_generation: Function returning the current generation of the ES index
+        :param load_values: Function loading at most the given number of (value, count) tuples,
+            returning None if there are more values.
+        :return:
+        """
+        generation = self.generation(index_name, get_generation)
+        if generation is None:
+            CACHE_REQUESTS.inc("facet_values", "miss")
+            return None
+        key = (index_name, facet_property)
+        with self._lock:
+            entry = self._indexes.get(key)
+            if entry is not None and entry[0] == generation:
+                CACHE_REQUESTS.inc("facet_values", "hit" if entry[1] is not None else "skip")
+                return entry[1]
+            CACHE_REQUESTS.inc("facet_values", "miss")
+            if key in self._building:
+                return None
+            self._building.add(key)
+
+        threading.Thread(
+            target=self._build, args=(key, generation, load_values), daemon=True
+        ).start()
+        return None
+
+    def generation(self, index_name: str, get_generation: Callable[[], str]) -> Optional[str]:
+        """
+        Get the last known generation of an Elasticsearch index. Every check_interval seconds, the
+        generation is checked for changes in a background thread.
+        :param index_name:
+        :param get_generation:
+        :return: None if the generation is not known yet
+        """
+        with self._lock:
+            checked_at, generation = self._generations.get(index_name, (-math.inf, None))
+            if (time.monotonic() - checked_at < self.check_interval
+                    or index_name in self._checking):
+                return generation
+            self._checking.add(index_name)
+
+        threading.Thread(
+            target=self._check_generation, args=(index_name, get_generation), daemon=True
+        ).start()
+        return generation
+
+    def _check_generation(self, index_name: str, get_generation: Callable[[], str]):
+        try:
+            generation = get_generation()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to check the generation of %s, keeping the last known one",
+                             index_name)
+            generation = self._generations.get(index_name, (-math.inf, None))[1]
+        with self._lock:
+            # Failed checks are also only retried after check_interval seconds
+            self._generations[index_name] = (time.monotonic(), generation)
+            self._checking.discard(index_name)
+
+    def _build(self, key: Tuple[str, str], generation: str,
+               load_values: Callable[[int], Optional[List[Tuple[str, int]]]]):
+        try:
+            with timed_task("facet_value_index"):
+                values = load_values(self.max_values)
+                value_index = FacetValueIndex(values) if values is not None else None
+            if value_index is None:
+                logger.info("Not indexing values of %s: more than %d values", key, self.max_values)
+            with self._lock:
+                self._indexes[key] = (generation, value_index)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to build the value index of %s", key)
+        finally:
+            with self._lock:
+                self._building.discard(key)
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def memory_usage(self) -> int:
+        """
+        Approximate the memory used by the value indexes, in bytes.
+        :return:
+        """
+        with self._lock:
+            return approximate_size(self._indexes)
+
+    def clear(self):
+        """
+        Remove all value indexes.
+        :return:
+        """
+        with self._lock:
+            self._indexes.clear()
+            self._generations.clear()
+
+
+facet_value_registry = FacetValueRegistry()
+registry.add_collector(
+    lambda: CACHE_ENTRIES.set("facet_values", value=len(facet_value_registry))
+)
@@ -0,0 +1,178 @@
+"""
+query_builder.py
+Builds the queries for searching in an Elasticsearch index.
+"""
+from typing import Dict, List, Optional
+
+from app.exceptions.search import UnknownFacetsException
+from app.models import Facet, FacetType, SearchConfiguration, SamplingMethod
+from app.services.search.cost import check_filters, check_query
+from app.services.search.dataclasses import FilterOptions
+from app.services.search.text import normalize_value, prefix_regex
+
+
+class QueryBuilder:
+    """
+    Creates the query parts of search requests, based on the facet and search configuration of a
+    dataset.
+    """
+    facet_configuration: Dict[str, Facet]
+    config: SearchConfiguration
+    search_fields: List[str]
+
+    def __init__(self, facet_configuration: Dict[str, Facet], config: SearchConfiguration):
+        self.facet_configuration = facet_configuration
+        self.config = config
+        self.search_fields = [
+            field.field if field.boost == 1 else f"{field.field}^{field.boost:g}"
+            for field in config.fields
+        ]
+
+    def make_facet_include(self, field: str, facet_filter: str,
+                           values: Optional[List[str]] = None) -> Dict:
+        """
+        Create the field and include settings of a terms aggregation for the values of :field:
+        matching :facet_filter:, so the filter is applied to the buckets instead of the documents.
+        The matching values are included by name if they are known (from the in-memory value
+        index). Otherwise, the values starting with the filter are included, ignoring case and
+        diacritics in the normalized subfield of the facet if one is configured, or ignoring case
+        in the field itself.
+        :param field:
+        :param facet_filter:
+        :param values: The values containing the filter, if known
+        :return:
+        """
+        if values is not None:
+            return {"field": field, "include": values}
+        facet = self.facet_configuration.get(field)
+        if facet is not None and facet.filter_property:
+            return {"field": facet.filter_property,
+                    "include": prefix_regex(normalize_value(facet_filter.strip()))}
+        return {"field": field, "include": prefix_regex(facet_filter.strip(), ignore_case=True)}
+
+    def make_filters(self, filter_options: FilterOptions) -> List:
+        """
+        Create the (non-scoring) clauses for the selected facet values. The clauses are in a
+        canonical order, so equal filters result in equal requests, which can be cached by
+        Elasticsearch.
+        :param filter_options:
+        :return:
+        """
+        check_filters(self.config.cost, filter_options)
+        filter_collection = []
+        unknown_facets = []
+        for key in sorted(filter_options.facets):
+            values = filter_options.facets[key]
+            if key not in self.facet_configuration:
+                unknown_facets.append(key)
+                continue
+            facet = self.facet_configuration[key]
+            if facet.type in [FacetType.RANGE, FacetType.HISTOGRAM, FacetType.DATE]:
+                range_values = values[0]
+                r_array = range_values.split(':')
+                filter_collection.append(
+                    {"range": {key: {"gte": r_array[0], "lte": r_array[1]}}}
+                )
+            else:
+                filter_collection.append({"terms": {key: sorted(set(values), key=str)}})
+        if unknown_facets:
+            raise UnknownFacetsException("Unknown facets", unknown_facets)
+        return filter_collection
+
+    def make_matches(self, filter_options: FilterOptions) -> List:
+        """
+        Create match queries (the scoring clauses) for the text query, in the search fields of the
+        dataset. Only the operators allowed by the cost policy are available.
+        :param filter_options:
+        :return:
+        """
+        must_collection = []
+        query = check_query(self.config.cost, filter_options.query)
+        if query.strip() != '':
+            match = {
+                "query": query,
+                "fields": self.search_fields or ["*"],
+                "flags": "|".join(self.config.cost.query_operators) or "NONE",
+            }
+            if self.search_fields:
+                # Searching in all fields already ignores fields of other types, like dates
+                match["lenient"] = True
+            must_collection.append({"simple_query_string": match})
+        return must_collection
+
+    def make_query(self, filter_options: FilterOptions, scoring: bool = True,
+                   extra_filters: List | None = None) -> Dict:
+        """
+        Create the query for the given filter options. Facet values are always in filter context,
+        so they are not scored and can be cached by Elasticsearch.
+        :param filter_options:
+        :param scoring: Whether the hits are scored. If not (for example, when only aggregating),
+            the text query is in filter context as well.
+        :param extra_filters: Additional clauses to add to the filter context
+        :return:
+        """
+        filters = self.make_filters(filter_options) + (extra_filters or [])
+        matches = self.make_matches(filter_options)
+        if not scoring:
+            filters, matches = filters + matches, []
+        if not filters and not matches:
+            return {"match_all": {}}
+
+        query = {"bool": {}}
+        if matches:
+            query["bool"]["must"] = matches
+        if filters:
+            query["bool"]["filter"] = filters
+        return query
+
+    def make_highlight(self) -> Dict:
+        """
+        Create the highlight part of a search request, based on the highlight configuration of the
+        dataset.
+        :return:
+        """
+        highlight_config = self.config.highlight
+        highlight = {
+            "number_of_fragments": highlight_config.number_of_fragments,
+            "fragment_size": highlight_config.fragment_size,
+            "fields": {
+                field: {} for field in highlight_config.fields
+            }
+        }
+        if highlight_config.type is not None:
+            highlight["type"] = highlight_config.type.value
+        if highlight_config.max_analyzed_offset is not None:
+            highlight["max_analyzed_offset"] = highlight_config.max_analyzed_offset
+        return highlight
+
+    def use_sampling(self, facet: Facet) -> bool:
+        """
+        Whether to approximate the options of a facet using a sample of the documents. Trees are
+        never sampled, as rare values would disappear from the tree.
+        :param facet:
+        :return:
+        """
+        return self.config.sampling.enabled and facet.type != FacetType.TREE
+
+    def make_sampler(self, aggs: Dict) -> Dict:
+        """
+        Wrap aggregations in a sampler aggregation, based on the sampling configuration.
+        :param aggs:
+        :return:
+        """
+        sampling = self.config.sampling
+        if sampling.method == SamplingMethod.RANDOM:
+            sampler = {"random_sampler": {"probability": sampling.probability}}
+        elif sampling.method == SamplingMethod.DIVERSIFIED:
+            sampler = {"diversified_sampler": {
+                "shard_size": sampling.shard_size,
+                "field": sampling.diversify_field,
+            }}
+        else:
+            sampler = {"sampler": {"shard_size": sampling.shard_size}}
+        return {
+            "sample": {
+                **sampler,
+                "aggs": aggs
+            }
+        }
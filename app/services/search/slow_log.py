@@ -0,0 +1,212 @@
+"""
+slow_log.py
+Log of slow Elasticsearch requests. Requests slower than a threshold are logged with their
+canonicalised body, and a sample of the other requests is logged as well. Request bodies are
+fingerprinted by their shape (the body without the values searched for), so the slowest kinds of
+requests can be aggregated. The concrete body of the slowest request is kept with each shape, so
+it can be replayed.
+"""
+import hashlib
+import json
+import logging
+import random
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from app.services.search.dataclasses import SearchContext
+
+# Values of these keys are part of the shape of a request, other values are replaced
+SHAPE_KEYS = {
+    "field", "fields", "order", "calendar_interval", "fixed_interval", "interval", "type",
+    "track_total_hits", "flags", "_source", "sort", "method", "probability", "shard_size",
+}
+# Placeholder for values which are not part of the shape
+PLACEHOLDER = "?"
+# Maximum length of the example body kept per shape, in characters of JSON
+MAX_EXAMPLE_SIZE = 16_384
+
+logger = logging.getLogger("app.slow_queries")
+
+
+def canonicalize(value: Any, key: Optional[str] = None) -> Any:
+    """
+    Get the shape of (a part of) a request body: keys are sorted, and values which are not part
+    of the shape (query text, selected values, sizes) are replaced by a placeholder. Lists of
+    values are collapsed into a single placeholder, so selecting more values is the same shape.
+    :param value:
+    :param key: The key of the value in its parent
+    :return:
+    """
+    if key in SHAPE_KEYS:
+        return value
+    if isinstance(value, dict):
+        return {child_key: canonicalize(child, child_key)
+                for child_key, child in sorted(value.items())}
+    if isinstance(value, list):
+        if all(not isinstance(item, (dict, list)) for item in value):
+            return [PLACEHOLDER] if value else []
+        return [canonicalize(item) for item in value]
+    return PLACEHOLDER
+
+
+def fingerprint(shape: Dict) -> str:
+    """
+    Get a short hash of the shape of a request.
+    :param shape:
+    :return:
+    """
+    return hashlib.sha1(json.dumps(shape, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def count_buckets(aggregations: Dict | None) -> int:
+    """
+    Count the buckets in the aggregations of a response, including sub aggregations.
+    :param aggregations:
+    :return:
+    """
+    if not isinstance(aggregations, dict):
+        return 0
+    total = 0
+    for aggregation in aggregations.values():
+        if not isinstance(aggregation, dict):
+            continue
+        buckets = aggregation.get("buckets")
+        if isinstance(buckets, list):
+            total += len(buckets)
+            for bucket in buckets:
+                total += count_buckets(bucket)
+        else:
+            total += count_buckets(aggregation)
+    return total
+
+
+@dataclass
+class ElasticRequest:
+    """
+    An Elasticsearch request which was executed, with its response.
+    """
+    operation: str # search, msearch or count
+    body: Dict
+    response: Any
+    duration: float # Time the request took, in seconds
+
+
+@dataclass
+class QueryShapeStatistics: # pylint: disable=too-many-instance-attributes
+    """
+    Statistics of the slow requests with the same shape.
+    """
+    fingerprint: str
+    shape: Dict
+    count: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    max_took: int = 0
+    # Where requests of this shape came from, as tenant/dataset/endpoint
+    sources: Dict[str, int] = field(default_factory=dict)
+    # JSON body of the slowest request of this shape, cut off at MAX_EXAMPLE_SIZE characters
+    example: str = ""
+    example_truncated: bool = False
+
+
+class SlowQueryLog:
+    """
+    Logs slow requests and keeps statistics of the slowest request shapes.
+    """
+    def __init__(self, threshold: float = 1.0, sample_rate: float = 0.0, max_shapes: int = 200):
+        """
+        :param threshold: Requests taking at least this many seconds are logged
+        :param sample_rate: Fraction of the faster requests which is logged
+        :param max_shapes: Maximum amount of request shapes to keep statistics for
+        """
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_shapes = max_shapes
+        self._shapes: Dict[str, QueryShapeStatistics] = {}
+        self._lock = threading.Lock()
+
+    def record(self, context: SearchContext, request: ElasticRequest):
+        """
+        Record an Elasticsearch request, if it is slow or sampled.
+        :param context:
+        :param request:
+        :return:
+        """
+        response = request.response
+        duration = request.duration
+        slow = duration >= self.threshold
+        if not slow and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return
+
+        shape = canonicalize(request.body)
+        entry = {
+            "slow": slow,
+            "operation": request.operation,
+            "tenant": context.origin.tenant,
+            "dataset": context.origin.dataset,
+            "endpoint": context.origin.endpoint,
+            "fingerprint": fingerprint(shape),
+            "duration": round(duration * 1000, 3),
+            "took": response.get("took"),
+            "hits": response.get("hits", {}).get("total"),
+            "buckets": count_buckets(response.get("aggregations")),
+            "response_size": response_size(response),
+            "body": shape,
+        }
+        logger.log(logging.WARNING if slow else logging.INFO, json.dumps(entry, default=str))
+        if slow:
+            self._add(entry, shape, str(context.origin), request)
+
+    def _add(self, entry: Dict, shape: Dict, source: str, request: ElasticRequest):
+        duration = request.duration
+        example = json.dumps(request.body, default=str)
+        with self._lock:
+            statistics = self._shapes.get(entry["fingerprint"])
+            if statistics is None:
+                if len(self._shapes) >= self.max_shapes:
+                    # Make room by forgetting the shape which cost the least time in total
+                    cheapest = min(self._shapes.values(), key=lambda shape: shape.total_time)
+                    del self._shapes[cheapest.fingerprint]
+                statistics = QueryShapeStatistics(entry["fingerprint"], shape)
+                self._shapes[entry["fingerprint"]] = statistics
+            if duration > statistics.max_time:
+                statistics.example = example[:MAX_EXAMPLE_SIZE]
+                statistics.example_truncated = len(example) > MAX_EXAMPLE_SIZE
+            statistics.count += 1
+            statistics.total_time += duration
+            statistics.max_time = max(statistics.max_time, duration)
+            statistics.max_took = max(statistics.max_took, entry["took"] or 0)
+            statistics.sources[source] = statistics.sources.get(source, 0) + 1
+
+    def worst(self, amount: int = 20) -> List[QueryShapeStatistics]:
+        """
+        Get the request shapes which cost the most time in total.
+        :param amount:
+        :return:
+        """
+        with self._lock:
+            return sorted(self._shapes.values(), key=lambda shape: shape.total_time,
+                          reverse=True)[:amount]
+
+    def clear(self):
+        """
+        Forget the statistics.
+        :return:
+        """
+        with self._lock:
+            self._shapes.clear()
+
+
+def response_size(response) -> Optional[int]:
+    """
+    Get the size of a response in bytes, as reported by Elasticsearch.
+    :param response:
+    :return: None if unknown (for example, for compressed or chunked responses)
+    """
+    meta = getattr(response, "meta", None)
+    length = meta.headers.get("content-length") if meta is not None else None
+    return int(length) if length is not None else None
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,137 @@
+"""
+suggest.py
+Suggestions for the text query while typing, taken from the fields declared in the search
+configuration of a dataset: completion fields using the completion suggester, and
+search_as_you_type fields using the values of the matching documents. Only the suggested values
+and their counts are retrieved, in a single request without hits, so suggestions are much cheaper
+than searching.
+"""
+import hashlib
+import re
+from typing import Dict, List
+
+from app.exceptions.search import QueryCostException
+from app.models import SuggestField, SuggestionType
+from app.services.cache import TTLCache
+from app.services.search.elastic_index import Index, is_partial
+from app.services.search.text import normalize_value
+
+# Suggestions per (index, text, amount, configuration)
+suggestion_cache = TTLCache(maxsize=2048, ttl=60, name="suggestions")
+
+# How many more values to request from search_as_you_type fields, as values of the matching
+# documents which do not match the text are left out
+SUGGEST_OVERSAMPLE = 4
+# Splits text into words, like the standard analyzer roughly does
+WORD_SEPARATOR = re.compile(r"\W+")
+
+
+def make_suggest_body(fields: List[SuggestField], text: str, amount: int) -> Dict:
+    """
+    Create the request for the suggestions of every field.
+    :param fields:
+    :param text:
+    :param amount:
+    :return:
+    """
+    body = {"size": 0, "_source": False}
+    for number, field in enumerate(fields):
+        name = f"field-{number}"
+        if field.type == SuggestionType.COMPLETION:
+            body.setdefault("suggest", {})[name] = {
+                "prefix": text,
+                "completion": {"field": field.field, "size": amount, "skip_duplicates": True},
+            }
+            continue
+        body.setdefault("aggs", {})[name] = {
+            "filter": {
+                "multi_match": {
+                    "query": text,
+                    "type": "bool_prefix",
+                    "fields": [field.field, f"{field.field}._2gram", f"{field.field}._3gram"],
+                },
+            },
+            "aggs": {
+                "values": {
+                    "terms": {
+                        "field": field.value_field or f"{field.field}.keyword",
+                        "size": amount * SUGGEST_OVERSAMPLE,
+                    },
+                },
+            },
+        }
+    return body
+
+
+def matches_words(value: str, words: List[str]) -> bool:
+    """
+    Check whether every typed word is the start of a word of a value, ignoring case and
+    diacritics.
+    :param value:
+    :param words: Normalized typed words
+    :return:
+    """
+    value_words = [word for word in WORD_SEPARATOR.split(normalize_value(value)) if word]
+    return all(any(value_word.startswith(word) for value_word in value_words) for word in words)
+
+
+def format_suggestions(fields: List[SuggestField], text: str, response: Dict,
+                       amount: int) -> List[Dict]:
+    """
+    Combine the suggestions of the fields, in the order of the fields. Values suggested by
+    multiple fields are only included once.
+    :param fields:
+    :param text:
+    :param response:
+    :param amount:
+    :return: The suggested values with the amount of documents having them. Completion suggesters
+        do not count documents, so their count is None.
+    """
+    words = [word for word in WORD_SEPARATOR.split(normalize_value(text)) if word]
+    suggestions = {}
+    for number, field in enumerate(fields):
+        name = f"field-{number}"
+        if field.type == SuggestionType.COMPLETION:
+            options = [{"value": option["text"], "count": None}
+                       for entry in response.get("suggest", {}).get(name, [])
+                       for option in entry["options"]]
+        else:
+            options = [{"value": bucket["key"], "count": bucket["doc_count"]}
+                       for bucket in response["aggregations"][name]["values"]["buckets"]
+                       if matches_words(str(bucket["key"]), words)]
+        for option in options:
+            suggestions.setdefault(normalize_value(str(option["value"])), option)
+    return list(suggestions.values())[:amount]
+
+
+def get_suggestions(index: Index, text: str, amount: int) -> List[Dict]:
+    """
+    Get suggestions for the text query of a dataset.
+    :param index: Index of the dataset, with the search configuration of the dataset
+    :param text: What was typed so far
+    :param amount: Maximum amount of suggestions
+    :return:
+    """
+    policy = index.config.cost
+    text = " ".join(text.lower().split())
+    if len(text) > policy.max_query_length:
+        raise QueryCostException("Query too long", "max_query_length", policy.max_query_length)
+    fields = index.config.suggest
+    if len(text) < policy.min_prefix_length or not fields:
+        return []
+
+    configuration = hashlib.sha1("".join(field.model_dump_json() for field in fields).encode(),
+                                 usedforsecurity=False).hexdigest()
+    key = (index.cache_name, text, amount, configuration)
+    cached = suggestion_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with index.context.phase("query_building"):
+        body = make_suggest_body(fields, text, amount)
+    response = index.search(body)
+    with index.context.phase("post_processing"):
+        suggestions = format_suggestions(fields, text, response, amount)
+    if not is_partial(response):
+        suggestion_cache.set(key, suggestions)
+    return suggestions
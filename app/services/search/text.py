@@ -0,0 +1,52 @@
+"""
+text.py
+Helpers for dealing with user input in Elasticsearch queries.
+"""
+import unicodedata
+
+# Characters with a special meaning in Lucene regular expressions
+REGEX_RESERVED_CHARS = frozenset('.?+*|{}[]()"\\#@&<>~')
+# Lowercase letters which asciifolding replaces, but which have no Unicode decomposition
+FOLDED_LETTERS = str.maketrans({
+    "ø": "o", "æ": "ae", "œ": "oe", "ß": "ss", "ł": "l", "đ": "d", "ð": "d", "þ": "th",
+    "ı": "i", "ħ": "h", "ŧ": "t", "ŀ": "l", "ĸ": "q",
+})
+
+
+def escape_regex(value: str) -> str:
+    """
+    Escape user input for use in a Lucene regular expression.
+    :param value:
+    :return:
+    """
+    return "".join(f"\\{char}" if char in REGEX_RESERVED_CHARS else char for char in value)
+
+
+def prefix_regex(value: str, ignore_case: bool = False) -> str:
+    """
+    Create a Lucene regular expression matching the values starting with :value:. As the
+    expression is anchored at the start, Elasticsearch only visits the terms with the prefix.
+    :param value:
+    :param ignore_case: Match both cases of every letter
+    :return:
+    """
+    parts = []
+    for char in value:
+        upper, lower = char.upper(), char.lower()
+        if ignore_case and upper != lower and len(upper) == 1 and len(lower) == 1:
+            parts.append(f"[{upper}{lower}]")
+        else:
+            parts.append(escape_regex(char))
+    return "".join(parts) + ".*"
+
+
+def normalize_value(value: str) -> str:
+    """
+    Normalize a value the same way a lowercase/asciifolding normalizer does, so user input can be
+    compared with the values in a normalized keyword field. Letters with diacritics are
+    decomposed, and letters like ø and ß, which do not decompose, are folded explicitly.
+    :param value:
+    :return:
+    """
+    decomposed = unicodedata.normalize("NFKD", value.lower().translate(FOLDED_LETTERS))
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
@@ -0,0 +1,173 @@
+"""
+warmup.py
+Warms up the caches after startup: for every dataset, the landing page requests and the most
+frequent requests from the query log are replayed through the application. This loads the
+configuration from MongoDB, fills the caches (configuration, minimum and maximum values, facet
+options, facet value indexes) and the Elasticsearch caches. Datasets are warmed up again when the
+contents of their index change, after invalidating the cached values of the index in all workers.
+Until the first warm-up is done, the process reports that it is not ready.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+from app.config import Settings
+from app.dependencies import database_connections, get_es_client
+from app.exceptions.cache import CacheBackendException
+from app.models import Dataset, FacetType, Tenant
+from app.services.cache import KEY_PREFIX, shared_store
+from app.services.metrics import timed_task
+from app.services.query_log import LoggedQuery, WARMUP_HEADER, frequent_queries
+from app.services.search.elastic_index import Index, facet_options_cache, min_max_cache
+
+logger = logging.getLogger(__name__)
+
+# Seconds the last invalidated generation of an index is kept in the shared backend
+GENERATION_TTL = 7 * 24 * 3600
+
+
+def index_generation(dataset: Dataset) -> str:
+    """
+    Get the generation of the index of a dataset.
+    :param dataset:
+    :return:
+    """
+    return Index(get_es_client(dataset.es_cluster), dataset.es_index, []).get_generation()
+
+
+def invalidate_index(dataset: Dataset, generation: str):
+    """
+    Invalidate the cached minimum and maximum values and facet options of the index of a dataset,
+    in all workers. Every worker notices the new generation of the index, but only the first one
+    invalidates the shared caches, so the workers do not wipe the entries the others warmed up.
+    :param dataset:
+    :param generation: The new generation of the index
+    :return:
+    """
+    index = Index(get_es_client(dataset.es_cluster), dataset.es_index, [])
+    index.cluster = dataset.es_cluster
+    if shared_store.available:
+        try:
+            if not shared_store.call("set_if_changed", f"{KEY_PREFIX}generation:{index.cache_name}",
+                                     generation.encode(), GENERATION_TTL):
+                return
+        except CacheBackendException:
+            pass
+    for cache in (min_max_cache, facet_options_cache):
+        cache.invalidate(index.cache_name)
+
+
+class Warmer:
+    """
+    Warms up the caches, and keeps track of the generations of the indexes which were warmed up.
+    """
+    def __init__(self):
+        self.ready = False
+        self.generations: Dict[Tuple[str, str], str] = {}
+
+    async def run(self, application, settings: Settings):
+        """
+        Warm up, and then periodically warm up the datasets of which the index changed. Runs until
+        cancelled.
+        :param application: The ASGI application to replay the requests on
+        :param settings:
+        :return:
+        """
+        try:
+            await asyncio.wait_for(self.warm_up(application, settings),
+                                   settings.warmup_timeout)
+        except TimeoutError:
+            logger.warning("Warm-up did not finish within %s seconds", settings.warmup_timeout)
+        except Exception: # pylint: disable=broad-exception-caught
+            logger.exception("Warm-up failed")
+        finally:
+            self.ready = True
+
+        while True:
+            await asyncio.sleep(settings.warmup_check_interval)
+            try:
+                await self.warm_up(application, settings, changed_only=True)
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception("Warm-up of changed indexes failed")
+
+    async def warm_up(self, application, settings: Settings, changed_only: bool = False):
+        """
+        Warm up the caches for the datasets of all tenants.
+        :param application:
+        :param settings:
+        :param changed_only: Only warm up datasets of which the index changed since the last time
+        :return:
+        """
+        client = database_connections["mongo"]
+        semaphore = asyncio.Semaphore(settings.warmup_concurrency)
+
+        async def warm(tenant: Tenant, dataset_data: Dict):
+            async with semaphore:
+                try:
+                    dataset = Dataset(**dataset_data)
+                    generation = await run_in_threadpool(index_generation, dataset)
+                    key = (tenant.name, dataset.name)
+                    if changed_only and self.generations.get(key) == generation:
+                        return
+                    if key in self.generations:
+                        await run_in_threadpool(invalidate_index, dataset, generation)
+                    await self.warm_dataset(application, tenant, dataset, settings.warmup_queries)
+                    self.generations[key] = generation
+                except Exception: # pylint: disable=broad-exception-caught
+                    logger.exception("Warm-up of %s/%s failed", tenant.name,
+                                     dataset_data.get("name"))
+
+        with timed_task("warmup"):
+            warmers = []
+            for tenant_data in await client.get_database("main")["tenants"].find().to_list():
+                tenant = Tenant(**tenant_data)
+                datasets = await client.get_database(tenant.name)["datasets"].find().to_list()
+                warmers.extend(warm(tenant, dataset) for dataset in datasets)
+            await asyncio.gather(*warmers)
+
+    @staticmethod
+    async def warm_dataset(application, tenant: Tenant, dataset: Dataset, amount: int):
+        """
+        Replay the landing page requests and the most frequent requests of a dataset.
+        :param application:
+        :param tenant:
+        :param dataset:
+        :param amount: Amount of requests from the query log
+        :return:
+        """
+        client = database_connections["mongo"]
+        prefix = f"/api/datasets/{dataset.name}"
+        requests: List[LoggedQuery] = [
+            LoggedQuery(tenant.name, dataset.name, "GET", f"{prefix}/facets", "options=true", "")
+        ]
+        tree_facets = await client.get_database(tenant.name)["facets"].find({
+            "dataset_name": dataset.name,
+            "type": FacetType.TREE.value,
+        }).to_list()
+        requests.extend(
+            LoggedQuery(tenant.name, dataset.name, "GET",
+                        f"{prefix}/facet/{facet['property']}/tree", "", "")
+            for facet in tree_facets
+        )
+        requests.extend(await frequent_queries(client, tenant.name, dataset.name, amount))
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=application),
+                                     base_url=f"http://{tenant.domain}",
+                                     headers={WARMUP_HEADER: "1"}, timeout=None) as http:
+            for request in requests:
+                url = f"{request.path}?{request.query_string}" if request.query_string \
+                    else request.path
+                response = await http.request(
+                    request.method, url, content=request.body.encode() or None,
+                    headers={"content-type": "application/json"} if request.body else None
+                )
+                if response.status_code >= 400:
+                    logger.info("Warm-up request %s %s failed with status %d", request.method,
+                                url, response.status_code)
+        logger.info("Warmed up %s/%s with %d requests", tenant.name, dataset.name, len(requests))
+
+
+warmer = Warmer()
@@ -0,0 +1,249 @@
+"""
+Records of background jobs, stored in the "jobs" collection of the tenant database. The web
+workers create the records and read them for the status endpoint, the job workers update them
+while running the jobs.
+
+Only one job of a type can be active for the same dataset and target at a time. A unique index on
+the key of the active jobs makes sure of that, also when multiple web workers submit the same job.
+
+The tasks running the jobs, and with them Celery, are imported when the first job is submitted, so
+the web workers start without loading Celery.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Set, Tuple
+import asyncio
+import functools
+import importlib
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+
+from app.config import get_settings
+from app.models import Job, JobProgress, JobStatus
+
+JOBS_COLLECTION = "jobs"
+# Modules defining the task of each type of job. The task has the name of the job type.
+JOB_TASKS = {
+    "rebuild_tree": "app.tasks.tree_facets",
+}
+# Databases of which the indexes of the jobs collection have been created by this process
+indexed_databases: Set[str] = set()
+# Jobs running eagerly, referenced until they are done
+eager_jobs: Set[asyncio.Future] = set()
+
+
+def now() -> datetime:
+    """
+    Current time, in UTC as stored by MongoDB.
+    :return:
+    """
+    return datetime.now(timezone.utc)
+
+
+def job_key(job_type: str, dataset_name: str, target: str) -> str:
+    """
+    Key identifying the jobs which should not run at the same time.
+    :param job_type:
+    :param dataset_name:
+    :param target:
+    :return:
+    """
+    return f"{job_type}:{dataset_name}:{target}"
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """
+    Create the indexes of the jobs collection, once per database.
+    :param db:
+    :return:
+    """
+    if db.name in indexed_databases:
+        return
+    await db[JOBS_COLLECTION].create_index(
+        "key", name="active_key", unique=True, partialFilterExpression={"active": True}
+    )
+    await db[JOBS_COLLECTION].create_index([("dataset_name", 1), ("created", -1)])
+    indexed_databases.add(db.name)
+
+
+async def create_job(db: AsyncIOMotorDatabase, job_type: str, dataset_name: str, target: str,
+                     stale_after: float) -> Tuple[Job, bool]:
+    """
+    Create a job, unless the same job is already active. Active jobs which have not been updated
+    for :stale_after: seconds are considered lost, for example because the worker running them was
+    killed, and are replaced.
+    :param db:
+    :param job_type:
+    :param dataset_name:
+    :param target:
+    :param stale_after:
+    :return: The new or the active job, and whether it was created
+    """
+    await ensure_indexes(db)
+    key = job_key(job_type, dataset_name, target)
+    collection = db[JOBS_COLLECTION]
+    for _ in range(3):
+        created = now()
+        document = {
+            "_id": uuid.uuid4().hex,
+            "key": key,
+            "active": True,
+            "type": job_type,
+            "dataset_name": dataset_name,
+            "target": target,
+            "status": JobStatus.QUEUED.value,
+            "progress": JobProgress().model_dump(),
+            "attempts": 0,
+            "created": created,
+            "updated": created,
+        }
+        try:
+            await collection.insert_one(document)
+            return Job(**document), True
+        except DuplicateKeyError:
+            active = await collection.find_one({"key": key, "active": True})
+            if active is None:
+                # Finished in the meantime
+                continue
+            replaced = await collection.update_one(
+                {"_id": active["_id"], "active": True,
+                 "updated": {"$lt": created - timedelta(seconds=stale_after)}},
+                {"$set": {"status": JobStatus.FAILED.value, "error": "Job was lost",
+                          "finished": created},
+                 "$unset": {"active": ""}},
+            )
+            if replaced.modified_count == 0:
+                return Job(**active), False
+    raise RuntimeError(f"Could not create job {key}")
+
+
+async def get_job(db: AsyncIOMotorDatabase, dataset_name: str, job_id: str) -> Job | None:
+    """
+    Get a job of a dataset.
+    :param db:
+    :param dataset_name:
+    :param job_id:
+    :return:
+    """
+    document = await db[JOBS_COLLECTION].find_one({"_id": job_id, "dataset_name": dataset_name})
+    return Job(**document) if document else None
+
+
+class JobTracker:
+    """
+    Records the status and progress of a job while a worker runs it.
+    """
+    def __init__(self, db: Database, job_id: str):
+        self.collection = db[JOBS_COLLECTION]
+        self.job_id = job_id
+
+    def update(self, fields: dict, unset: dict | None = None) -> None:
+        """
+        Update fields of the job.
+        :param fields:
+        :param unset:
+        :return:
+        """
+        change = {"$set": {**fields, "updated": now()}}
+        if unset:
+            change["$unset"] = unset
+        self.collection.update_one({"_id": self.job_id}, change)
+
+    def start(self, attempt: int) -> None:
+        """
+        Record that an attempt to run the job started.
+        :param attempt: Number of the attempt, starting at 1
+        :return:
+        """
+        self.update({"status": JobStatus.RUNNING.value, "attempts": attempt,
+                     "progress": JobProgress(step="starting").model_dump()})
+
+    def progress(self, step: str, done: int = 0, total: int | None = None) -> None:
+        """
+        Record the progress of the job.
+        :param step: Description of what the job is doing
+        :param done:
+        :param total:
+        :return:
+        """
+        self.update({"progress": JobProgress(step=step, done=done, total=total).model_dump()})
+
+    def retrying(self, error: str) -> None:
+        """
+        Record that the current attempt failed and the job will be retried.
+        :param error:
+        :return:
+        """
+        self.update({"status": JobStatus.RETRYING.value, "error": error})
+
+    def finish(self, status: JobStatus, error: str | None = None) -> None:
+        """
+        Record that the job is done, which allows the same job to be submitted again.
+        :param status:
+        :param error:
+        :return:
+        """
+        self.update({"status": status.value, "error": error, "finished": now()},
+                    unset={"active": ""})
+
+
+async def abandon_job(db: AsyncIOMotorDatabase, job_id: str, error: str) -> None:
+    """
+    Mark a job as failed before it was started, for example because it could not be queued.
+    :param db:
+    :param job_id:
+    :param error:
+    :return:
+    """
+    await db[JOBS_COLLECTION].update_one(
+        {"_id": job_id},
+        {"$set": {"status": JobStatus.FAILED.value, "error": error, "finished": now(),
+                  "updated": now()},
+         "$unset": {"active": ""}},
+    )
+
+
+def load_task(job_type: str):
+    """
+    Get the Celery task running a type of job, importing it if needed.
+    :param job_type:
+    :return:
+    """
+    return getattr(importlib.import_module(JOB_TASKS[job_type]), job_type)
+
+
+async def submit_job(db: AsyncIOMotorDatabase, tenant: str, job_type: str, dataset_name: str,
+                     target: str) -> Tuple[Job, bool]:
+    """
+    Submit a job, unless the same job is already active. The task is called with the id of the job,
+    the tenant, the dataset name and the target.
+    :param db:
+    :param tenant:
+    :param job_type:
+    :param dataset_name:
+    :param target:
+    :return: The new or the active job, and whether it was created
+    """
+    job, created = await create_job(db, job_type, dataset_name, target,
+                                    get_settings().job_stale_after)
+    if not created:
+        return job, False
+
+    task = await run_in_threadpool(load_task, job_type)
+    send = functools.partial(task.apply_async, (job.id, tenant, dataset_name, target),
+                             task_id=job.id)
+    if task.app.conf.task_always_eager:
+        future = asyncio.get_running_loop().run_in_executor(None, send)
+        eager_jobs.add(future)
+        future.add_done_callback(eager_jobs.discard)
+        return job, True
+
+    try:
+        await run_in_threadpool(send)
+    except Exception as e:
+        await abandon_job(db, job.id, f"Could not queue job: {e}")
+        raise
+    return job, True
@@ -2,45 +2,109 @@
 Queue tasks related to tree facets.
 """
 
-from app.dependencies import TenantDbDep, ElasticIndexDep, DatasetDep
+from typing import Dict, Iterator, List
+
+from pymongo import ReplaceOne
+from pymongo.database import Database
+
+from app.models import Dataset, Facet
+from app.services.metrics import timed_task
 from app.services.search.dataclasses import FilterOptions
+from app.services.search.elastic_index import Index
+from app.tasks.jobs import JobTracker
+from app.tasks.worker import celery_app, run_job, worker_es_client
+
+# Nodes written to the database at once
+NODE_BATCH_SIZE = 1000
 
 
-async def construct_tree(facet_name: str, dataset: DatasetDep, db: TenantDbDep,
-                         es_index: ElasticIndexDep):
+@celery_app.task(bind=True, name="rebuild_tree")
+def rebuild_tree(self, job_id: str, tenant: str, dataset_name: str, facet_name: str):
     """
-    Construct a tree for a facet.
+    Job rebuilding the tree of a tree facet.
+    :param self:
+    :param job_id:
+    :param tenant:
+    :param dataset_name:
     :param facet_name:
-    :param es_index:
-    :param db:
-    :param dataset:
     :return:
     """
-    cursor = db['facets'].find({
-        "dataset_name": dataset.name,
-        "property": facet_name
-    })
-    facet_data = (await cursor.to_list())[0]
+    def work(db: Database, tracker: JobTracker):
+        construct_tree(db, dataset_name, facet_name, tracker)
+
+    run_job(self, job_id, tenant, work)
+
+
+@timed_task("construct_tree")
+def construct_tree(db: Database, dataset_name: str, facet_name: str, tracker: JobTracker):
+    """
+    Construct the tree of a facet, and store its nodes for lazy loading. Nodes of the previous tree
+    are removed when the new tree is stored, so the old tree can be used until then.
+    :param db: Tenant database
+    :param dataset_name:
+    :param facet_name:
+    :param tracker:
+    :return:
+    """
+    dataset_data = db['datasets'].find_one({"name": dataset_name})
+    if dataset_data is None:
+        raise ValueError(f"Dataset {dataset_name} not found")
+    dataset = Dataset(**dataset_data)
+    facets = [Facet(**facet) for facet in db['facets'].find({"dataset_name": dataset.name})]
+    facet = next((facet for facet in facets if facet.property == facet_name), None)
+    if facet is None:
+        raise ValueError(f"Facet {facet_name} not found")
+
+    tracker.progress("retrieving options")
+    es_index = Index(worker_es_client(dataset.es_cluster), dataset.es_index, facets,
+                     dataset.search_configuration)
+    es_index.cluster = dataset.es_cluster
+    tree = es_index.get_tree(facet, FilterOptions(facets={}))
 
-    filter_options = FilterOptions([])
+    nodes = list(tree_nodes(tree, facet.id, facet_name, dataset.name, facet.tree_separator))
+    for start in range(0, len(nodes), NODE_BATCH_SIZE):
+        tracker.progress("storing nodes", start, len(nodes))
+        db["nodes"].bulk_write([
+            ReplaceOne({"_id": node["_id"]}, {**node, "job": tracker.job_id}, upsert=True)
+            for node in nodes[start:start + NODE_BATCH_SIZE]
+        ], ordered=False)
+    tracker.progress("removing old nodes", len(nodes), len(nodes))
+    db["nodes"].delete_many({
+        "dataset": dataset.name,
+        "facet_name": facet_name,
+        "job": {"$ne": tracker.job_id},
+    })
 
-    tree = es_index.get_tree(facet_name, filter_options)
 
-    def add_node(node, parent):
-        db["nodes"].insert_one({
-            "_id": f"{facet_data["_id"]}_{node["value"]}",
+def tree_nodes(tree: List[Dict], facet_id, facet_name: str, dataset_name: str,
+               separator: str = "|") -> Iterator[Dict]:
+    """
+    Get the documents of the nodes of a tree, for lazily loading the tree. Children come before
+    their parent.
+    :param tree: The tree, as built by Index.build_tree
+    :param facet_id: Id of the facet document
+    :param facet_name:
+    :param dataset_name:
+    :param separator: Separator of the levels in the values of the facet
+    :return:
+    """
+    def iterate_tree(node, parent_value=None):
+        # Nodes which only exist as parents of options have no value of their own
+        value = node.get("value")
+        if value is None:
+            value = node["name"] if parent_value is None else \
+                f"{parent_value}{separator}{node["name"]}"
+        for child in node["children"]:
+            yield from iterate_tree(child, value)
+        yield {
+            "_id": f"{facet_id}_{value}",
             "facet_name": facet_name,
-            "dataset": dataset.name,
-            "parent": parent["value"] if parent is not None else None,
-            "value": node["value"],
+            "dataset": dataset_name,
+            "parent": parent_value,
+            "value": value,
             "name": node["name"],
             "has_children": len(node["children"]) > 0,
-        })
-
-    def iterate_tree(node, parent = None):
-        for child in node["children"]:
-            iterate_tree(child, node)
-        add_node(node, parent)
+        }
 
-    for n in tree:
-        iterate_tree(n)
+    for node in tree:
+        yield from iterate_tree(node)
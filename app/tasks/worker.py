@@ -0,0 +1,108 @@
+"""
+Celery application running background jobs in separate worker processes, so heavy work like
+rebuilding trees does not compete with the searches of the web workers. Start a worker with:
+
+    celery -A app.tasks.worker worker
+
+Without a configured broker, jobs run eagerly in a thread of the web worker instead. That is only
+meant for development and tests.
+"""
+from typing import Any, Callable, Dict
+import logging
+
+from celery import Celery, Task
+from elasticsearch import Elasticsearch
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from app.config import get_settings
+from app.dependencies import create_es_client
+from app.models import JobStatus
+from app.tasks.jobs import JOB_TASKS, JobTracker
+
+logger = logging.getLogger(__name__)
+
+
+def celery_config() -> Dict[str, Any]:
+    """
+    Configuration of the Celery application, read from the settings when it is first used.
+    :return:
+    """
+    settings = get_settings()
+    return {
+        "broker_url": settings.celery_broker_url or "memory://localhost/",
+        "task_always_eager": settings.celery_broker_url is None,
+        "task_ignore_result": True,
+        # A job is only removed from the queue when it is done, so jobs of killed workers run again
+        "task_acks_late": True,
+        "task_reject_on_worker_lost": True,
+        "worker_prefetch_multiplier": 1,
+        "imports": sorted(set(JOB_TASKS.values())),
+    }
+
+
+celery_app = Celery("panoptes")
+celery_app.add_defaults(celery_config)
+
+# Connections of the job worker process, created when first used, so after forking
+worker_connections: Dict[str, Any] = {}
+
+
+def worker_db(tenant: str) -> Database:
+    """
+    Get the database of a tenant, in a job worker.
+    :param tenant:
+    :return:
+    """
+    if "mongo" not in worker_connections:
+        worker_connections["mongo"] = MongoClient(get_settings().mongo_connection)
+    return worker_connections["mongo"].get_database(tenant)
+
+
+def worker_es_client(cluster: str | None = None) -> Elasticsearch:
+    """
+    Get the client for an Elasticsearch cluster, in a job worker.
+    :param cluster: Name of the cluster, or None for the default cluster
+    :return:
+    """
+    key = f"elastic:{cluster or ''}"
+    if key not in worker_connections:
+        settings = get_settings()
+        if cluster is None:
+            worker_connections[key] = create_es_client(settings.default_es_cluster())
+        elif cluster in settings.es_clusters:
+            worker_connections[key] = create_es_client(settings.es_clusters[cluster])
+        else:
+            raise ValueError(f"Unknown Elasticsearch cluster {cluster}")
+    return worker_connections[key]
+
+
+def run_job(task: Task, job_id: str, tenant: str,
+            work: Callable[[Database, JobTracker], None]) -> None:
+    """
+    Run the work of a job, recording its status. Failed attempts are retried with an exponential
+    backoff, until the maximum amount of retries.
+    :param task: The bound task running the job
+    :param job_id:
+    :param tenant:
+    :param work: Function doing the work, given the tenant database and the tracker for reporting
+    progress
+    :return:
+    """
+    settings = get_settings()
+    db = worker_db(tenant)
+    tracker = JobTracker(db, job_id)
+    retries = task.request.retries
+    tracker.start(retries + 1)
+    try:
+        work(db, tracker)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        if retries < settings.job_max_retries:
+            logger.warning("Job %s failed, retrying: %s", job_id, e)
+            tracker.retrying(str(e))
+            raise task.retry(exc=e, countdown=settings.job_retry_delay * 2 ** retries,
+                             max_retries=settings.job_max_retries)
+        logger.exception("Job %s failed", job_id)
+        tracker.finish(JobStatus.FAILED, str(e))
+        return
+    tracker.finish(JobStatus.SUCCEEDED)
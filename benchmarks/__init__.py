@@ -0,0 +1,4 @@
+"""
+Benchmarks for the API. They run the application against local stand-ins for Elasticsearch and
+MongoDB, so they need no services and can be run offline. See the README for usage.
+"""
@@ -0,0 +1,232 @@
+"""
+data.py
+Synthetic tenants, datasets, facets and tree nodes for benchmarking, at a configurable scale. The
+same generated data is used for filling the fake MongoDB and for the responses of the fake
+Elasticsearch, so the values requested by the load generator exist in both.
+"""
+import random
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+# Facet types, in the order they are assigned to the facets of a dataset
+FACET_TYPES = ("text", "tree", "histogram", "date", "range")
+TREE_SEPARATOR = "|"
+
+
+@dataclass
+class Scale:
+    """
+    Size of the generated data.
+    """
+    tenants: int = 2
+    datasets: int = 2 # Per tenant
+    facets: int = 10 # Per dataset
+    values: int = 1000 # Distinct values per text facet
+    tree_nodes: int = 2000 # Leaves per tree facet
+    tree_depth: int = 3
+    documents: int = 100_000 # Per dataset
+
+
+@dataclass
+class FieldData:
+    """
+    Values of a field in a synthetic index.
+    """
+    type: str
+    # (value, count) tuples of keyword fields, highest count first
+    buckets: List[Tuple[str, int]] = field(default_factory=list)
+    minimum: float = 0
+    maximum: float = 0
+
+
+@dataclass
+class SyntheticIndex:
+    """
+    Contents of a synthetic Elasticsearch index.
+    """
+    name: str
+    documents: int
+    fields: Dict[str, FieldData]
+
+
+@dataclass
+class SyntheticData:
+    """
+    Generated data: the MongoDB databases with their collections, and the Elasticsearch indexes.
+    """
+    databases: Dict[str, Dict[str, List[Dict]]]
+    indexes: Dict[str, SyntheticIndex]
+
+    def tenants(self) -> List[Dict]:
+        """
+        Get the tenants.
+        :return:
+        """
+        return self.databases["main"]["tenants"]
+
+    def datasets(self, tenant: str) -> List[Dict]:
+        """
+        Get the datasets of a tenant.
+        :param tenant:
+        :return:
+        """
+        return self.databases[tenant]["datasets"]
+
+    def facets(self, tenant: str, dataset: str) -> List[Dict]:
+        """
+        Get the facets of a dataset.
+        :param tenant:
+        :param dataset:
+        :return:
+        """
+        return [facet for facet in self.databases[tenant]["facets"]
+                if facet["dataset_name"] == dataset]
+
+
+def zipf_counts(amount: int, documents: int) -> List[int]:
+    """
+    Get document counts for values following a Zipf distribution, like real facet values do.
+    :param amount:
+    :param documents:
+    :return: Counts, highest first
+    """
+    weights = [1 / rank for rank in range(1, amount + 1)]
+    total = sum(weights)
+    return [max(1, int(documents * weight / total)) for weight in weights]
+
+
+def tree_paths(prefix: str, leaves: int, depth: int) -> List[str]:
+    """
+    Get the values of a tree facet: paths of :depth: levels joined by the tree separator.
+    :param prefix:
+    :param leaves:
+    :param depth:
+    :return:
+    """
+    branching = max(2, round(leaves ** (1 / depth)))
+    paths = []
+    for leaf in range(leaves):
+        parts = []
+        for level in range(depth):
+            parts.append(f"{prefix} {level}.{leaf // branching ** (depth - level - 1) % branching}")
+        paths.append(TREE_SEPARATOR.join(parts))
+    return paths
+
+
+def tree_nodes(dataset: str, facet: str, paths: List[str]) -> List[Dict]:
+    """
+    Get the nodes of a tree facet, as stored for lazily loading the tree.
+    :param dataset:
+    :param facet:
+    :param paths:
+    :return:
+    """
+    nodes = {}
+    for path in paths:
+        parts = path.split(TREE_SEPARATOR)
+        for level, name in enumerate(parts):
+            value = TREE_SEPARATOR.join(parts[:level + 1])
+            if value not in nodes:
+                nodes[value] = {
+                    "dataset": dataset,
+                    "facet_name": facet,
+                    "name": name,
+                    "value": value,
+                    "parent": TREE_SEPARATOR.join(parts[:level]) or None,
+                    "has_children": level < len(parts) - 1,
+                }
+    return list(nodes.values())
+
+
+def make_fields(facets: List[Dict], scale: Scale,
+                rng: random.Random) -> Tuple[Dict[str, FieldData], List[Dict]]:
+    """
+    Generate the field data of the facets of a dataset, and the nodes of its tree facets.
+    :param facets:
+    :param scale:
+    :param rng:
+    :return:
+    """
+    fields = {}
+    nodes = []
+    for facet in facets:
+        if facet["type"] == "text":
+            values = [f"{facet['name']} {value}" for value in range(scale.values)]
+            rng.shuffle(values)
+            fields[facet["property"]] = FieldData(
+                "keyword", list(zip(values, zipf_counts(len(values), scale.documents)))
+            )
+        elif facet["type"] == "tree":
+            paths = tree_paths(facet["name"], scale.tree_nodes, scale.tree_depth)
+            fields[facet["property"]] = FieldData(
+                "keyword", list(zip(paths, zipf_counts(len(paths), scale.documents)))
+            )
+            nodes.extend(tree_nodes(facet["dataset_name"], facet["property"], paths))
+        elif facet["type"] == "date":
+            start = rng.randint(-200, 0) * 365 * 24 * 3600 * 1000
+            fields[facet["property"]] = FieldData("date", minimum=start,
+                                                  maximum=start + 150 * 365 * 24 * 3600 * 1000)
+        else:
+            start = rng.randint(0, 1000)
+            fields[facet["property"]] = FieldData("long", minimum=start,
+                                                  maximum=start + rng.randint(100, 10_000))
+    return fields, nodes
+
+
+def generate(scale: Scale, seed: int = 42) -> SyntheticData:
+    """
+    Generate the data for benchmarking. The same seed generates the same data.
+    :param scale:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    databases = {"main": {"tenants": []}}
+    indexes = {}
+    for tenant_number in range(scale.tenants):
+        tenant = f"tenant{tenant_number}"
+        databases["main"]["tenants"].append({
+            "name": tenant,
+            "domain": f"{tenant}.benchmark",
+        })
+        collections = databases[tenant] = {
+            "datasets": [], "facets": [], "result_properties": [], "detail_properties": [],
+            "nodes": [],
+        }
+        for dataset_number in range(scale.datasets):
+            dataset = f"dataset{dataset_number}"
+            index_name = f"{tenant}-{dataset}"
+            collections["datasets"].append({
+                "tenant_name": tenant,
+                "name": dataset,
+                "es_index": index_name,
+                "data_type": "elasticsearch",
+                "data_configuration": {"id_property": "id", "base_url": ""},
+                "metadata": {},
+                "detail_id": "id",
+            })
+            facets = [{
+                "dataset_name": dataset,
+                "property": f"{FACET_TYPES[number % len(FACET_TYPES)]}_{number}",
+                "name": f"{FACET_TYPES[number % len(FACET_TYPES)]} {number}",
+                "type": FACET_TYPES[number % len(FACET_TYPES)],
+                "order": number,
+            } for number in range(scale.facets)]
+            collections["facets"].extend(facets)
+            collections["result_properties"].extend([
+                {"dataset_name": dataset, "name": "title", "path": "$.title", "order": 0,
+                 "type": "text"},
+                {"dataset_name": dataset, "name": "description", "path": "$._highlight",
+                 "order": 1, "type": "text"},
+            ] + [{"dataset_name": dataset, "name": facet["name"], "path": f"$.{facet['property']}",
+                  "order": facet["order"] + 2, "type": facet["type"]}
+                 for facet in facets if facet["type"] in ("text", "tree")])
+            collections["detail_properties"].extend(
+                {"dataset_name": dataset, "name": name, "path": f"$.{name}", "order": order,
+                 "type": "text"}
+                for order, name in enumerate(["title", "description", "id"])
+            )
+            fields, nodes = make_fields(facets, scale, rng)
+            collections["nodes"].extend(nodes)
+            indexes[index_name] = SyntheticIndex(index_name, scale.documents, fields)
+    return SyntheticData(databases, indexes)
@@ -0,0 +1,556 @@
+"""
+fakes.py
+In-process stand-ins for MongoDB (the parts of the Motor API the application uses),
+Elasticsearch (a synchronous client answering requests from synthetic indexes) and Redis (a server
+for the commands of the shared cache). MongoDB and Elasticsearch can add latency, so waiting on the
+services is part of the measurements.
+"""
+import asyncio
+import random
+import re
+import socketserver
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.data import SyntheticData, SyntheticIndex
+
+
+def matches(document: Dict, query: Dict) -> bool:
+    """
+    Check whether a document matches a MongoDB query. Supports equality, $in and $ne.
+    :param document:
+    :param query:
+    :return:
+    """
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$ne" in condition and value == condition["$ne"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    """
+    Cursor over the documents found in a fake collection.
+    """
+    def __init__(self, documents: List[Dict], latency: float):
+        self.documents = documents
+        self.latency = latency
+
+    def sort(self, key: str, direction: int = 1) -> "FakeCursor":
+        """
+        Sort the documents by a key.
+        :param key:
+        :param direction: 1 for ascending, -1 for descending
+        :return:
+        """
+        self.documents.sort(key=lambda document: document.get(key, 0), reverse=direction < 0)
+        return self
+
+    def limit(self, amount: int) -> "FakeCursor":
+        """
+        Limit the amount of documents.
+        :param amount:
+        :return:
+        """
+        if amount:
+            self.documents = self.documents[:amount]
+        return self
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict]:
+        """
+        Get the documents. Every document is a copy, like documents decoded from BSON.
+        :param length:
+        :return:
+        """
+        await asyncio.sleep(self.latency)
+        documents = self.documents if length is None else self.documents[:length]
+        return [dict(document) for document in documents]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in await self.to_list():
+            yield document
+
+
+class FakeCollection:
+    """
+    Collection of documents, kept in a list.
+    """
+    def __init__(self, documents: List[Dict], latency: float):
+        self.documents = documents
+        self.latency = latency
+
+    def find(self, query: Optional[Dict] = None, **_kwargs) -> FakeCursor:
+        """
+        Find documents.
+        :param query:
+        :return:
+        """
+        return FakeCursor([document for document in self.documents
+                           if matches(document, query or {})], self.latency)
+
+    async def find_one(self, query: Optional[Dict] = None, **_kwargs) -> Optional[Dict]:
+        """
+        Find a single document.
+        :param query:
+        :return:
+        """
+        documents = await self.find(query).limit(1).to_list()
+        return documents[0] if documents else None
+
+    async def insert_one(self, document: Dict):
+        """
+        Insert a document.
+        :param document:
+        :return:
+        """
+        await asyncio.sleep(self.latency)
+        self.documents.append(dict(document))
+
+    async def delete_many(self, query: Dict):
+        """
+        Delete the documents matching a query.
+        :param query:
+        :return:
+        """
+        await asyncio.sleep(self.latency)
+        self.documents[:] = [document for document in self.documents
+                             if not matches(document, query)]
+
+    async def count_documents(self, query: Dict) -> int:
+        """
+        Count the documents matching a query.
+        :param query:
+        :return:
+        """
+        await asyncio.sleep(self.latency)
+        return sum(1 for document in self.documents if matches(document, query))
+
+
+class FakeDatabase:
+    """
+    Database of fake collections. Collections can be accessed as items and as attributes.
+    """
+    def __init__(self, name: str, collections: Dict[str, List[Dict]], latency: float):
+        self.name = name
+        self.collections = {name: FakeCollection(documents, latency)
+                            for name, documents in collections.items()}
+        self.latency = latency
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self.collections:
+            self.collections[name] = FakeCollection([], self.latency)
+        return self.collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+class FakeMongoClient:
+    """
+    Stand-in for AsyncIOMotorClient.
+    """
+    def __init__(self, data: SyntheticData, latency: float = 0.0):
+        """
+        :param data:
+        :param latency: Time every read and write takes, in seconds
+        """
+        self.databases = {name: FakeDatabase(name, collections, latency)
+                          for name, collections in data.databases.items()}
+        self.latency = latency
+
+    def get_database(self, name: str) -> FakeDatabase:
+        """
+        Get a database, creating it if it does not exist.
+        :param name:
+        :return:
+        """
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase(name, {}, self.latency)
+        return self.databases[name]
+
+    def close(self):
+        """
+        Close the client.
+        :return:
+        """
+
+
+class _FakeIndices:
+    def __init__(self, client: "FakeElasticsearch"):
+        self.client = client
+
+    def stats(self, index: str, **_kwargs) -> Dict:
+        """
+        Get the document counts of an index.
+        :param index:
+        :return:
+        """
+        synthetic = self.client.indexes[index]
+        return {"indices": {index: {
+            "uuid": index,
+            "primaries": {"docs": {"count": synthetic.documents, "deleted": 0}},
+        }}}
+
+
+class _FakeTasks:
+    def list(self, **_kwargs) -> Dict:
+        """
+        List running tasks. Requests are answered synchronously, so there are none.
+        :return:
+        """
+        return {"tasks": []}
+
+    def cancel(self, **_kwargs) -> Dict:
+        """
+        Cancel a task.
+        :return:
+        """
+        return {}
+
+
+class _FakeNodePool:
+    def all(self) -> List:
+        """
+        Get the nodes. The fake has no connections.
+        :return:
+        """
+        return []
+
+
+class FakeElasticsearch:
+    """
+    Stand-in for the Elasticsearch client. Answers searches from synthetic indexes: aggregations
+    return buckets of the generated values, hits are generated documents.
+    """
+    def __init__(self, data: SyntheticData, latency: float = 0.0, jitter: float = 0.0):
+        """
+        :param data:
+        :param latency: Time every request takes, in seconds
+        :param jitter: Maximum random time added to the latency, in seconds
+        """
+        self.indexes: Dict[str, SyntheticIndex] = data.indexes
+        self.latency = latency
+        self.jitter = jitter
+        self.indices = _FakeIndices(self)
+        self.tasks = _FakeTasks()
+        self.transport = SimpleNamespace(node_pool=_FakeNodePool())
+        self.requests = 0
+
+    def options(self, **_kwargs) -> "FakeElasticsearch":
+        """
+        Get a client with other request options.
+        :return:
+        """
+        return self
+
+    def _wait(self) -> int:
+        """
+        Wait for the latency of a request, blocking like the synchronous client does.
+        :return: The time waited in milliseconds, used as took
+        """
+        self.requests += 1
+        duration = self.latency + random.uniform(0, self.jitter)
+        if duration > 0:
+            time.sleep(duration)
+        return int(duration * 1000)
+
+    def search(self, index: str, body: Dict, **_kwargs) -> Dict:
+        """
+        Search in a synthetic index.
+        :param index:
+        :param body:
+        :return:
+        """
+        took = self._wait()
+        return {"took": took, **self._respond(self.indexes[index], body)}
+
+    def msearch(self, index: str, searches: List[Dict], **_kwargs) -> Dict:
+        """
+        Run multiple searches in a synthetic index.
+        :param index:
+        :param searches: Alternating headers and bodies
+        :return:
+        """
+        took = self._wait()
+        return {"took": took, "responses": [
+            {"took": took, **self._respond(self.indexes[index], body)}
+            for body in searches[1::2]
+        ]}
+
+    def count(self, index: str, **_kwargs) -> Dict:
+        """
+        Count the documents of a synthetic index.
+        :param index:
+        :return:
+        """
+        self._wait()
+        return {"count": self.indexes[index].documents}
+
+    def close(self):
+        """
+        Close the client.
+        :return:
+        """
+
+    def _respond(self, synthetic: SyntheticIndex, body: Dict) -> Dict:
+        size = body.get("size", 10)
+        offset = body.get("from", 0)
+        total = {"value": synthetic.documents, "relation": "eq"}
+        hits = {
+            "hits": [make_hit(synthetic, number, "highlight" in body)
+                     for number in range(offset, min(offset + size, synthetic.documents))],
+        }
+        if body.get("track_total_hits", True) is not False:
+            hits["total"] = total
+        response = {"timed_out": False, "hits": hits}
+        if "aggs" in body:
+            response["aggregations"] = aggregate(synthetic, body["aggs"], synthetic.documents)
+        return response
+
+
+def make_hit(synthetic: SyntheticIndex, number: int, highlight: bool) -> Dict:
+    """
+    Generate a search hit.
+    :param synthetic:
+    :param number:
+    :param highlight:
+    :return:
+    """
+    source = {
+        "id": str(number),
+        "title": f"Document {number} of {synthetic.name}",
+        "description": f"Description of document {number}, " * 5,
+    }
+    for name, field_data in synthetic.fields.items():
+        if field_data.buckets:
+            source[name] = field_data.buckets[number % len(field_data.buckets)][0]
+        else:
+            source[name] = field_data.minimum + number % max(1, int(
+                field_data.maximum - field_data.minimum))
+    hit = {"_id": str(number), "_score": 1.0, "_source": source}
+    if highlight:
+        hit["highlight"] = {"description": [f"<em>Description</em> of document {number}"]}
+    return hit
+
+
+def aggregate(synthetic: SyntheticIndex, aggs: Dict[str, Dict], documents: int) -> Dict:
+    """
+    Answer the aggregations of a request.
+    :param synthetic:
+    :param aggs:
+    :param documents: Amount of documents being aggregated
+    :return:
+    """
+    results = {}
+    for name, aggregation in aggs.items():
+        sub_aggs = aggregation.get("aggs", {})
+        agg_type, settings = next((key, value) for key, value in aggregation.items()
+                                  if key != "aggs")
+        if agg_type in ("sampler", "random_sampler", "diversified_sampler"):
+            sampled = min(documents, settings.get("shard_size", documents)) \
+                if agg_type != "random_sampler" else documents
+            results[name] = {"doc_count": sampled,
+                             **aggregate(synthetic, sub_aggs, sampled)}
+        elif agg_type in ("min", "max"):
+            field_data = synthetic.fields.get(settings["field"])
+            value = None if field_data is None else \
+                field_data.minimum if agg_type == "min" else field_data.maximum
+            results[name] = {"value": value}
+        elif agg_type == "terms":
+            results[name] = {"buckets": terms(synthetic, settings)}
+        elif agg_type == "composite":
+            results[name] = composite(synthetic, settings)
+        elif agg_type == "histogram":
+            results[name] = {"buckets": histogram(synthetic, settings)}
+        elif agg_type in ("date_histogram", "auto_date_histogram"):
+            results[name] = date_histogram(synthetic, settings)
+        else:
+            results[name] = {"buckets": []}
+    return results
+
+
+def terms(synthetic: SyntheticIndex, settings: Dict) -> List[Dict]:
+    """
+    Answer a terms aggregation.
+    :param synthetic:
+    :param settings:
+    :return:
+    """
+    field_data = synthetic.fields.get(settings["field"])
+    buckets = field_data.buckets if field_data is not None else []
+    if "include" in settings:
+        include = re.compile(settings["include"])
+        buckets = [bucket for bucket in buckets if include.fullmatch(bucket[0])]
+    order = settings.get("order", {})
+    if "_key" in order:
+        buckets = sorted(buckets, reverse=order["_key"] == "desc")
+    return [{"key": key, "doc_count": count}
+            for key, count in buckets[:settings.get("size", 10)]]
+
+
+def composite(synthetic: SyntheticIndex, settings: Dict) -> Dict:
+    """
+    Answer a composite aggregation over a single terms source.
+    :param synthetic:
+    :param settings:
+    :return:
+    """
+    source = settings["sources"][0]
+    name, source_settings = next(iter(source.items()))
+    field_data = synthetic.fields.get(source_settings["terms"]["field"])
+    buckets = sorted(field_data.buckets) if field_data is not None else []
+    after = settings.get("after", {}).get(name)
+    if after is not None:
+        buckets = [bucket for bucket in buckets if bucket[0] > after]
+    page = buckets[:settings.get("size", 10)]
+    result: Dict[str, Any] = {"buckets": [{"key": {name: key}, "doc_count": count}
+                                          for key, count in page]}
+    if page:
+        result["after_key"] = {name: page[-1][0]}
+    return result
+
+
+def histogram(synthetic: SyntheticIndex, settings: Dict) -> List[Dict]:
+    """
+    Answer a histogram aggregation.
+    :param synthetic:
+    :param settings:
+    :return:
+    """
+    field_data = synthetic.fields.get(settings["field"])
+    if field_data is None:
+        return []
+    interval = float(settings.get("interval", 1))
+    start = field_data.minimum // interval * interval
+    amount = int((field_data.maximum - start) // interval) + 1
+    return [{"key": start + number * interval, "doc_count": 1 + number % 17}
+            for number in range(amount)]
+
+
+def date_histogram(synthetic: SyntheticIndex, settings: Dict) -> Dict:
+    """
+    Answer a (auto) date histogram with yearly buckets.
+    :param synthetic:
+    :param settings:
+    :return:
+    """
+    field_data = synthetic.fields.get(settings["field"])
+    if field_data is None:
+        return {"buckets": []}
+    year = 365.25 * 24 * 3600 * 1000
+    amount = min(settings.get("buckets", 100), int((field_data.maximum - field_data.minimum)
+                                                    // year) + 1)
+    step = max(1, int((field_data.maximum - field_data.minimum) // year) // amount)
+    first = 1970 + int(field_data.minimum // year)
+    buckets = []
+    for number in range(amount):
+        buckets.append({
+            "key": int((first + number * step - 1970) * year),
+            "key_as_string": f"{first + number * step:04d}-01-01",
+            "doc_count": 1 + number % 13,
+        })
+    return {"buckets": buckets, "interval": f"{step}y"}
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+    server: "FakeRedisServer"
+
+    def read_command(self) -> List[bytes] | None:
+        """
+        Read a command, sent as an array of bulk strings.
+        :return: The command and its arguments, or None if the client disconnected
+        """
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+        return arguments
+
+    def handle(self):
+        while (arguments := self.read_command()) is not None:
+            self.wfile.write(self.server.execute(arguments))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """
+    Stand-in for a Redis server, supporting the commands used by the shared cache (GET, SET with
+    PX, INCR). Runs in a thread on a free local port.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _RedisHandler)
+        self.entries: Dict[bytes, Tuple[bytes, float]] = {}
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    @property
+    def url(self) -> str:
+        """
+        URL to connect to the server.
+        :return:
+        """
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def start(self) -> "FakeRedisServer":
+        """
+        Start serving in a thread.
+        :return:
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def bulk(self, key: bytes) -> bytes:
+        """
+        Encode the value of a key as a reply, like GET does.
+        :param key:
+        :return:
+        """
+        value, expires = self.entries.get(key, (None, 0.0))
+        if value is None or expires < time.monotonic():
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def execute(self, arguments: List[bytes]) -> bytes:
+        """
+        Execute a command.
+        :param arguments:
+        :return: The encoded reply
+        """
+        command = arguments[0].upper()
+        with self.lock:
+            self.commands += 1
+            if command == b"GET":
+                return self.bulk(arguments[1])
+            if command == b"SET":
+                ttl = float("inf")
+                if len(arguments) >= 5 and arguments[3].upper() == b"PX":
+                    ttl = int(arguments[4]) / 1000
+                # With the GET option, the previous value is returned
+                reply = self.bulk(arguments[1]) if len(arguments) > 3 \
+                    and arguments[-1].upper() == b"GET" else b"+OK\r\n"
+                self.entries[arguments[1]] = (arguments[2], time.monotonic() + ttl)
+                return reply
+            if command == b"INCR":
+                value = int(self.entries.get(arguments[1], (b"0", 0.0))[0]) + 1
+                self.entries[arguments[1]] = (str(value).encode(), float("inf"))
+                return b":%d\r\n" % value
+            if command in (b"PING", b"AUTH", b"SELECT"):
+                return b"+OK\r\n"
+        return b"-ERR unknown command\r\n"
@@ -0,0 +1,383 @@
+"""
+load.py
+End-to-end load test: runs the application in-process against the fake Elasticsearch and MongoDB,
+drives the search, facet, tree and detail endpoints with concurrent clients, and reports the
+throughput, latency percentiles per endpoint and the lag of the event loop. Cache entries can be
+shared through the SQLite backend or the Redis backend (with the fake Redis server), to measure
+the overhead of sharing them between workers.
+
+Usage: python -m benchmarks.load --help
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import httpx
+
+from benchmarks.data import Scale, SyntheticData, generate
+from benchmarks.fakes import FakeElasticsearch, FakeMongoClient, FakeRedisServer
+
+# Relative frequency of the endpoints in the default mix, roughly like a search interface
+DEFAULT_MIX = {"search": 5, "facets": 1, "facet": 3, "tree": 1, "details": 1}
+# Words used in text queries
+QUERY_WORDS = ["document", "description", "letter", "map", "photo", "archive", ""]
+
+
+@dataclass
+class Latency:
+    """
+    Latency of the fake services, in seconds.
+    """
+    elasticsearch: float = 0.005
+    elasticsearch_jitter: float = 0.005 # Maximum random time added to the latency
+    mongo: float = 0.0005
+
+
+@dataclass
+class Options: # pylint: disable=too-many-instance-attributes
+    """
+    Options of a load test run.
+    """
+    scale: Scale = field(default_factory=Scale)
+    seed: int = 42
+    concurrency: int = 32
+    duration: float = 10 # Seconds of measuring
+    warmup: float = 2 # Seconds of load before measuring
+    mix: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_MIX))
+    latency: Latency = field(default_factory=Latency)
+    cache_backend: str = "local" # Backend sharing cache entries: local, sqlite or redis
+
+
+@dataclass
+class Results:
+    """
+    Measurements of a load test run.
+    """
+    duration: float = 0.0
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    statuses: Counter = field(default_factory=Counter)
+    loop_lag: List[float] = field(default_factory=list)
+    es_requests: int = 0
+
+    def summary(self) -> Dict:
+        """
+        Summarize the measurements. Latencies are in milliseconds.
+        :return:
+        """
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "duration": round(self.duration, 3),
+            "requests": requests,
+            "throughput": round(requests / self.duration, 1) if self.duration else 0.0,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "es_requests": self.es_requests,
+            "endpoints": {
+                endpoint: {
+                    "requests": len(latencies),
+                    "p50": round(percentile(latencies, 0.5) * 1000, 2),
+                    "p99": round(percentile(latencies, 0.99) * 1000, 2),
+                    "max": round(max(latencies) * 1000, 2),
+                }
+                for endpoint, latencies in sorted(self.latencies.items()) if latencies
+            },
+            "loop_lag": {
+                "p50": round(percentile(self.loop_lag, 0.5) * 1000, 2),
+                "p99": round(percentile(self.loop_lag, 0.99) * 1000, 2),
+                "max": round(max(self.loop_lag, default=0.0) * 1000, 2),
+            },
+        }
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Get a percentile of values, using the nearest rank.
+    :param values:
+    :param fraction: Between 0 and 1
+    :return:
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class Workload:
+    """
+    Generates requests for the synthetic datasets.
+    """
+    def __init__(self, data: SyntheticData, seed: int = 0):
+        self.data = data
+        self.rng = random.Random(seed)
+        self.datasets = [(tenant, dataset["name"]) for tenant in data.tenants()
+                         for dataset in data.datasets(tenant["name"])]
+        self.nodes = {(tenant["name"], dataset): defaultdict(list)
+                      for tenant, dataset in self.datasets}
+        for tenant in data.tenants():
+            for node in data.databases[tenant["name"]]["nodes"]:
+                if node["has_children"]:
+                    self.nodes[(tenant["name"], node["dataset"])][node["facet_name"]].append(
+                        node["value"]
+                    )
+
+    def request(self, endpoint: str) -> Tuple[str, str, Optional[Dict]]:
+        """
+        Generate a request to an endpoint, for a random dataset.
+        :param endpoint:
+        :return: The method, URL and JSON body
+        """
+        tenant, dataset = self.rng.choice(self.datasets)
+        base = f"http://{tenant['domain']}/api/datasets/{dataset}"
+        facets = self.data.facets(tenant["name"], dataset)
+        if endpoint == "search":
+            return "POST", f"{base}/search", {
+                "query": self.rng.choice(QUERY_WORDS),
+                "facets": self.selection(tenant["name"], dataset, facets),
+                "offset": self.rng.choice([0, 0, 0, 10, 20]),
+                "limit": 10,
+            }
+        if endpoint == "facets":
+            return "GET", f"{base}/facets?options={self.rng.choice(['true', 'false'])}", None
+        if endpoint == "facet":
+            facet = self.rng.choice([facet for facet in facets if facet["type"] != "range"])
+            return "POST", f"{base}/facet/{facet['property']}", {
+                "name": facet["property"],
+                "amount": 10,
+                "filter": self.rng.choice(["", "", "1"]) if facet["type"] == "text" else "",
+                "facets": self.selection(tenant["name"], dataset, facets),
+                "query": self.rng.choice(QUERY_WORDS),
+                "sort": "hits",
+            }
+        if endpoint == "tree":
+            trees = self.nodes[(tenant["name"], dataset)]
+            facet = self.rng.choice(sorted(trees)) if trees else "tree_1"
+            parent = self.rng.choice([None] + trees.get(facet, []))
+            query = f"?{urlencode({'parent': parent})}" if parent is not None else ""
+            return "GET", f"{base}/facet/{facet}/tree{query}", None
+        if endpoint == "details":
+            documents = self.data.indexes[f"{tenant['name']}-{dataset}"].documents
+            return "GET", f"{base}/details/{self.rng.randrange(documents)}", None
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+
+    def selection(self, tenant: str, dataset: str, facets: List[Dict]) -> Dict[str, List[str]]:
+        """
+        Select values of a text facet, or nothing.
+        :param tenant:
+        :param dataset:
+        :param facets:
+        :return:
+        """
+        text_facets = [facet for facet in facets if facet["type"] == "text"]
+        if not text_facets or self.rng.random() < 0.5:
+            return {}
+        facet = self.rng.choice(text_facets)
+        buckets = self.data.indexes[f"{tenant}-{dataset}"].fields[facet["property"]].buckets
+        return {facet["property"]: [value for value, _ in
+                                    self.rng.sample(buckets[:50], min(2, len(buckets)))]}
+
+
+async def monitor_loop(lags: List[float], stop: asyncio.Event, interval: float = 0.01):
+    """
+    Measure how late the event loop wakes up a sleeping task. Lag means the loop was blocked by
+    synchronous work.
+    :param lags: The lag of every wake up is appended, in seconds
+    :param stop:
+    :param interval:
+    :return:
+    """
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def client_loop(client: httpx.AsyncClient, workload: Workload, mix: Dict[str, float],
+                      until: float, results: Optional[Results]):
+    """
+    Send requests one after the other until a moment in time.
+    :param client:
+    :param workload:
+    :param mix: Relative frequency of the endpoints
+    :param until: time.perf_counter() to stop at
+    :param results: Where to record the measurements, None for not measuring
+    :return:
+    """
+    endpoints, weights = zip(*mix.items())
+    while time.perf_counter() < until:
+        endpoint = workload.rng.choices(endpoints, weights)[0]
+        method, url, body = workload.request(endpoint)
+        started = time.perf_counter()
+        response = await client.request(method, url, json=body)
+        if results is not None:
+            results.latencies[endpoint].append(time.perf_counter() - started)
+            results.statuses[response.status_code] += 1
+
+
+@contextmanager
+def shared_cache(backend: str):
+    """
+    Share cache entries through a backend while running, like multiple workers would.
+    :param backend: local, sqlite or redis
+    :return:
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from app.services.cache import shared_store
+    # pylint: disable-next=import-outside-toplevel
+    from app.services.cache_backends import RedisBackend, SqliteBackend
+
+    if backend == "local":
+        yield
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        server = FakeRedisServer().start() if backend == "redis" else None
+        shared_store.configure(RedisBackend(server.url) if server is not None
+                               else SqliteBackend(os.path.join(directory, "cache.sqlite")))
+        try:
+            yield
+        finally:
+            shared_store.configure(None)
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+
+async def run(options: Options) -> Results:
+    """
+    Run a load test.
+    :param options:
+    :return:
+    """
+    # Settings are read when the application is imported
+    os.environ.setdefault("MONGO_CONNECTION", "mongodb://benchmark")
+    os.environ.setdefault("ES_HOST", "benchmark")
+    from app import dependencies  # pylint: disable=import-outside-toplevel
+    from app.main import app  # pylint: disable=import-outside-toplevel
+
+    data = generate(options.scale, options.seed)
+    elastic = FakeElasticsearch(data, options.latency.elasticsearch,
+                                options.latency.elasticsearch_jitter)
+    dependencies.database_connections["mongo"] = FakeMongoClient(data, options.latency.mongo)
+    dependencies.database_connections["elastic"] = elastic
+    workload = Workload(data, options.seed)
+    results = Results()
+
+    transport = httpx.ASGITransport(app=app)
+    with shared_cache(options.cache_backend):
+        async with httpx.AsyncClient(transport=transport, timeout=None) as client:
+            until = time.perf_counter() + options.warmup
+            await asyncio.gather(*(client_loop(client, workload, options.mix, until, None)
+                                   for _ in range(options.concurrency)))
+
+            stop = asyncio.Event()
+            monitor = asyncio.create_task(monitor_loop(results.loop_lag, stop))
+            requests_before = elastic.requests
+            started = time.perf_counter()
+            until = started + options.duration
+            await asyncio.gather(*(client_loop(client, workload, options.mix, until, results)
+                                   for _ in range(options.concurrency)))
+            results.duration = time.perf_counter() - started
+            results.es_requests = elastic.requests - requests_before
+            stop.set()
+            await monitor
+    return results
+
+
+def format_summary(summary: Dict) -> str:
+    """
+    Format a summary as a table.
+    :param summary:
+    :return:
+    """
+    lines = [
+        f"{summary['requests']} requests in {summary['duration']}s: "
+        f"{summary['throughput']} requests/s, {summary['es_requests']} Elasticsearch requests",
+        f"Statuses: {summary['statuses']}",
+        "",
+        f"{'endpoint':<10} {'requests':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}",
+    ]
+    for endpoint, statistics in summary["endpoints"].items():
+        lines.append(f"{endpoint:<10} {statistics['requests']:>9} {statistics['p50']:>9} "
+                     f"{statistics['p99']:>9} {statistics['max']:>9}")
+    lag = summary["loop_lag"]
+    lines.append("")
+    lines.append(f"Event loop lag: p50 {lag['p50']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+    return "\n".join(lines)
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """
+    Parse an endpoint mix like "search=5,facet=3".
+    :param value:
+    :return:
+    """
+    mix = {}
+    for part in value.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint: {endpoint}")
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+def main():
+    """
+    Run a load test from the command line.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    defaults = Options()
+    for name, value in asdict(defaults.scale).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=value,
+                            help=f"Data scale (default: {value})")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency)
+    parser.add_argument("--duration", type=float, default=defaults.duration,
+                        help="Seconds of measuring")
+    parser.add_argument("--warmup", type=float, default=defaults.warmup,
+                        help="Seconds of load before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=defaults.mix,
+                        help="Endpoints with their relative frequency, like search=5,facet=3")
+    parser.add_argument("--es-latency", type=float, default=defaults.latency.elasticsearch,
+                        help="Seconds every Elasticsearch request takes")
+    parser.add_argument("--es-jitter", type=float, default=defaults.latency.elasticsearch_jitter,
+                        help="Maximum random seconds added to the Elasticsearch latency")
+    parser.add_argument("--mongo-latency", type=float, default=defaults.latency.mongo,
+                        help="Seconds every MongoDB request takes")
+    parser.add_argument("--cache-backend", choices=["local", "sqlite", "redis"],
+                        default=defaults.cache_backend,
+                        help="Backend sharing cache entries (default: local)")
+    parser.add_argument("--output", help="Write the summary as JSON to this file")
+    arguments = parser.parse_args()
+
+    options = Options(
+        scale=Scale(**{name: getattr(arguments, name) for name in asdict(defaults.scale)}),
+        seed=arguments.seed,
+        concurrency=arguments.concurrency,
+        duration=arguments.duration,
+        warmup=arguments.warmup,
+        mix=arguments.mix,
+        latency=Latency(arguments.es_latency, arguments.es_jitter, arguments.mongo_latency),
+        cache_backend=arguments.cache_backend,
+    )
+    # Logging every request would be measured as well
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    summary = asyncio.run(run(options)).summary()
+    print(format_summary(summary))
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            json.dump({"options": asdict(options), "summary": summary}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""
+micro.py
+Microbenchmarks of the pure Python code which runs on every request: building trees, formatting
+results and highlights, building queries and converting buckets. Every benchmark runs on synthetic
+inputs of increasing size. The time and peak allocation are compared with stored baselines, and
+the run fails when a benchmark is slower or allocates more than allowed.
+
+Times depend on the machine and on what else it is doing, so they are compared relative to the time
+of a fixed amount of calibration work, measured together with every benchmark. Allocations are
+compared as they are; they are measured with the garbage collector paused, so they do not depend
+on the order of the benchmarks.
+
+Usage: python -m benchmarks.micro --help
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Settings are read when the application is imported
+os.environ.setdefault("MONGO_CONNECTION", "mongodb://benchmark")
+os.environ.setdefault("ES_HOST", "benchmark")
+
+# pylint: disable=wrong-import-position
+from app.models import Facet, FacetType, ResultProperty, SearchConfiguration
+from app.services.search.dataclasses import FacetRequest, FilterOptions, ResultItem
+from app.services.search.elastic_index import Index, parse_interval
+from app.services.search.query_builder import QueryBuilder
+from app.services.search.text import normalize_value
+from app.tasks.tree_facets import tree_nodes
+from benchmarks.data import tree_paths, zipf_counts
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+# Minimum time of a single measurement, in seconds
+MIN_MEASUREMENT_TIME = 0.05
+REPEATS = 5
+
+
+@dataclass
+class Benchmark:
+    """
+    A function to measure, for inputs of several sizes.
+    """
+    name: str
+    sizes: Sequence[int]
+    # Gets the size of the input and returns the function to measure
+    setup: Callable[[int], Callable[[], Any]]
+
+
+def tree_facet() -> Facet:
+    """
+    Get a tree facet.
+    :return:
+    """
+    return Facet(dataset_name="benchmark", property="tree", name="Tree", type=FacetType.TREE)
+
+
+def tree_options(size: int) -> List[Dict]:
+    """
+    Get the options of a tree facet: leaves of a three level tree, with counts.
+    :param size:
+    :return:
+    """
+    paths = tree_paths("node", size, 3)
+    return [{"value": path, "count": count}
+            for path, count in zip(paths, zipf_counts(size, 1_000_000))]
+
+
+def setup_build_tree(size: int) -> Callable[[], Any]:
+    """
+    Index.build_tree, including simplify_children.
+    :param size: Amount of options
+    :return:
+    """
+    facet = tree_facet()
+    options = tree_options(size)
+    return lambda: Index.build_tree(facet, options)
+
+
+def setup_tree_nodes(size: int) -> Callable[[], Any]:
+    """
+    The traversal of construct_tree. Every node has a value, like when all levels are indexed.
+    :param size: Amount of leaves
+    :return:
+    """
+    options = tree_options(size)
+    prefixes = {}
+    for option in options:
+        parts = option["value"].split("|")
+        for level in range(1, len(parts) + 1):
+            prefixes.setdefault("|".join(parts[:level]), option["count"])
+    tree = Index.build_tree(tree_facet(), [{"value": value, "count": count}
+                                           for value, count in prefixes.items()])
+    return lambda: list(tree_nodes(tree, "facet", "tree", "benchmark"))
+
+
+def result_items(size: int) -> List[ResultItem]:
+    """
+    Get search results with highlights.
+    :param size:
+    :return:
+    """
+    return [ResultItem(
+        es_result={
+            "id": str(number),
+            "title": f"Document {number}",
+            "description": "Some description " * 20,
+            "creator": {"name": f"Creator {number % 50}", "role": "author"},
+            "subjects": [f"Subject {subject}" for subject in range(5)],
+        },
+        index=str(number),
+        highlight={
+            "description": [f"Some <em>description</em> {fragment}" for fragment in range(3)],
+            "title": [f"<em>Document</em> {number}"],
+        },
+    ) for number in range(size)]
+
+
+def setup_format_result(size: int) -> Callable[[], Any]:
+    """
+    ResultItem.format_result for a page of results.
+    :param size: Amount of results
+    :return:
+    """
+    properties = [
+        ResultProperty(dataset_name="benchmark", name=name, path=path, order=order,
+                       type=FacetType.TEXT)
+        for order, (name, path) in enumerate([
+            ("title", "$.title"), ("description", "$._highlight"), ("creator", "$.creator.name"),
+            ("subject", "$.subjects[0]"), ("id", "$._id"),
+        ])
+    ]
+    items = result_items(size)
+    return lambda: [item.format_result(properties) for item in items]
+
+
+def setup_format_highlight(size: int) -> Callable[[], Any]:
+    """
+    ResultItem.format_highlight for a page of results.
+    :param size: Amount of results
+    :return:
+    """
+    items = result_items(size)
+    return lambda: [item.format_highlight() for item in items]
+
+
+def setup_make_matches(size: int) -> Callable[[], Any]:
+    """
+    QueryBuilder.make_matches, which checks the text query against the cost policy.
+    :param size: Length of the query in words
+    :return:
+    """
+    builder = QueryBuilder({}, SearchConfiguration())
+    words = ["letter", "amsterdam", "1650", "map*", '"city hall"', "-draft", "portrait"]
+    options = FilterOptions(facets={}, query=" ".join(words[number % len(words)]
+                                                     for number in range(size)))
+    return lambda: builder.make_matches(options)
+
+
+def setup_filter_options(size: int) -> Callable[[], Any]:
+    """
+    The conversion of filtered facet options aggregated on a normalized subfield in
+    Index.get_facet, which looks up the stored spelling of every value.
+    :param size: Amount of buckets
+    :return:
+    """
+    index = Index(None, "benchmark", [])
+    facet = Facet(dataset_name="benchmark", property="place", name="Place", type=FacetType.TEXT,
+                  filter_property="place.normalized")
+    request = FacetRequest(facet=facet, amount=size, body={}, agg_settings={})
+    values = ["Ämsterdam", "Rotterdam", "Leiden", "Haarlem", "Delft", "Utrecht", "Zwolle"]
+    buckets = []
+    for number in range(size):
+        value = f"{values[number % len(values)]} {number}"
+        buckets.append({"key": normalize_value(value), "doc_count": size - number, "values": {
+            "buckets": [{"key": f"{values[(number + 1) % len(values)]} {number + 1}",
+                         "doc_count": size - number},
+                        {"key": value, "doc_count": size - number}]
+        }})
+    response = {"aggregations": {"names": {"buckets": buckets}}}
+    return lambda: index.format_facet_response(request, response)
+
+
+def setup_parse_interval(size: int) -> Callable[[], Any]:
+    """
+    parse_interval for the intervals of auto date histograms.
+    :param size: Amount of intervals
+    :return:
+    """
+    intervals = [f"{value}{unit}" for value in (1, 5, 10, 20, 50, 100) for unit in "smhdMy"]
+    intervals = (intervals * (size // len(intervals) + 1))[:size]
+    return lambda: [parse_interval(interval) for interval in intervals]
+
+
+def setup_date_buckets(size: int) -> Callable[[], Any]:
+    """
+    The conversion of date histogram buckets in Index.get_facet.
+    :param size: Amount of buckets
+    :return:
+    """
+    index = Index(None, "benchmark", [])
+    facet = Facet(dataset_name="benchmark", property="date", name="Date", type=FacetType.DATE)
+    request = FacetRequest(facet=facet, amount=10, body={}, agg_settings={})
+    year = 365.25 * 24 * 3600 * 1000
+    response = {"aggregations": {"names": {"interval": "1y", "buckets": [
+        {"key": int((number - 300) * year), "key_as_string": f"{1670 + number:04d}-01-01",
+         "doc_count": number % 17 + 1}
+        for number in range(size)
+    ]}}}
+    return lambda: index.format_facet_response(request, response)
+
+
+BENCHMARKS = [
+    Benchmark("build_tree", (1_000, 10_000), setup_build_tree),
+    Benchmark("tree_nodes", (1_000, 10_000), setup_tree_nodes),
+    Benchmark("format_result", (10, 100), setup_format_result),
+    Benchmark("format_highlight", (10, 100), setup_format_highlight),
+    Benchmark("make_matches", (5, 50), setup_make_matches),
+    Benchmark("filter_options", (100, 1_000), setup_filter_options),
+    Benchmark("parse_interval", (100, 1_000), setup_parse_interval),
+    Benchmark("date_buckets", (100, 1_000, 10_000), setup_date_buckets),
+]
+
+
+def calibration_work() -> int:
+    """
+    A fixed amount of pure Python work, for comparing times measured on different machines (or on
+    a machine which is busy with something else).
+    :return:
+    """
+    values = {}
+    for number in range(20_000):
+        values[str(number)] = [number, number * 2]
+    return sum(value[1] for value in values.values())
+
+
+def loops(func: Callable[[], Any]) -> int:
+    """
+    Get how often to call a function for a measurement to take at least MIN_MEASUREMENT_TIME.
+    :param func:
+    :return:
+    """
+    number = 1
+    while timed(func, number) * number < MIN_MEASUREMENT_TIME:
+        number *= 2
+    return number
+
+
+def timed(func: Callable[[], Any], number: int) -> float:
+    """
+    Call a function a number of times. Like timeit, the garbage collector is paused, so the time
+    does not depend on how many objects earlier benchmarks left behind.
+    :param func:
+    :param number:
+    :return: The time per call, in seconds
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        return (time.perf_counter() - started) / number
+    finally:
+        gc.enable()
+
+
+def measure_time(func: Callable[[], Any]) -> Tuple[float, float]:
+    """
+    Measure the time of a call to a function, absolute and relative to the calibration work. The
+    measurements of both are interleaved, so they are done under the same circumstances, and the
+    minimum of several measurements is used.
+    :param func:
+    :return: The time of the function in seconds, and its time divided by the time of the
+        calibration work
+    """
+    number, calibration_number = loops(func), loops(calibration_work)
+    times, calibrations = [], []
+    for _ in range(REPEATS):
+        calibrations.append(timed(calibration_work, calibration_number))
+        times.append(timed(func, number))
+    return min(times), min(times) / min(calibrations)
+
+
+def measure_allocation(func: Callable[[], Any]) -> int:
+    """
+    Measure the peak of the memory allocated during a call to a function, including the result.
+    The garbage of earlier calls (and other benchmarks) is collected first, and the garbage
+    collector is paused during the call, so the peak does not depend on when it happens to run.
+    The minimum of several measurements is used.
+    :param func:
+    :return: The peak in bytes
+    """
+    func()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(REPEATS):
+            gc.collect()
+            gc.disable()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                func()
+                peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            finally:
+                gc.enable()
+    finally:
+        tracemalloc.stop()
+    return min(peaks)
+
+
+def cases(benchmarks: List[Benchmark]) -> Dict[str, Callable[[], Any]]:
+    """
+    Set up the functions to measure for every size of the benchmarks.
+    :param benchmarks:
+    :return: The functions by name, like build_tree[1000]
+    """
+    return {f"{benchmark.name}[{size}]": benchmark.setup(size)
+            for benchmark in benchmarks for size in benchmark.sizes}
+
+
+def run(functions: Dict[str, Callable[[], Any]]) -> Dict:
+    """
+    Measure functions.
+    :param functions: The functions by name
+    :return: Per function the time, the time relative to the calibration work and the peak
+        allocation
+    """
+    results = {}
+    for name, func in functions.items():
+        duration, relative = measure_time(func)
+        results[name] = {
+            "time": duration,
+            "relative": relative,
+            "allocated": measure_allocation(func),
+        }
+    return results
+
+
+def compare(results: Dict, baselines: Dict, time_threshold: float,
+            memory_threshold: float) -> List[Dict]:
+    """
+    Compare results with baselines.
+    :param results:
+    :param baselines:
+    :param time_threshold: Allowed relative increase of the time
+    :param memory_threshold: Allowed relative increase of the peak allocation
+    :return: Per benchmark the relative change of the time and allocation (None without a
+        baseline) and whether it is a regression
+    """
+    comparisons = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        comparison = {"name": name, **result, "time_change": None, "allocated_change": None,
+                      "regression": False}
+        if baseline is not None:
+            # Times relative to the calibration work are comparable across machines
+            comparison["time_change"] = result["relative"] / baseline["relative"] - 1
+            # Small allocations vary a bit, for example by caches warming up
+            comparison["allocated_change"] = \
+                (result["allocated"] - baseline["allocated"]) / max(baseline["allocated"], 1024)
+            comparison["regression"] = comparison["time_change"] > time_threshold \
+                or comparison["allocated_change"] > memory_threshold
+        comparisons.append(comparison)
+    return comparisons
+
+
+def format_comparisons(comparisons: List[Dict]) -> str:
+    """
+    Format the comparisons as a table.
+    :param comparisons:
+    :return:
+    """
+    def change(value: Optional[float]) -> str:
+        return "" if value is None else f"{value:+.0%}"
+
+    lines = [f"{'benchmark':<26} {'time us':>11} {'change':>8} {'peak KiB':>10} {'change':>8}"]
+    for comparison in comparisons:
+        lines.append(
+            f"{comparison['name']:<26} {comparison['time'] * 1e6:>11.1f} "
+            f"{change(comparison['time_change']):>8} {comparison['allocated'] / 1024:>10.1f} "
+            f"{change(comparison['allocated_change']):>8}"
+            f"{'  REGRESSION' if comparison['regression'] else ''}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    """
+    Run the microbenchmarks from the command line.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--filter", default="", help="Only run benchmarks containing this text")
+    parser.add_argument("--baselines", default=BASELINES, help="File with the baselines")
+    parser.add_argument("--save", action="store_true",
+                        help="Store the results as baselines instead of comparing")
+    parser.add_argument("--time-threshold", type=float, default=0.3,
+                        help="Allowed relative increase of the time (default: 0.3)")
+    parser.add_argument("--memory-threshold", type=float, default=0.10,
+                        help="Allowed relative increase of the peak allocation (default: 0.10)")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="How often to measure a regression again (default: 2)")
+    arguments = parser.parse_args()
+
+    functions = cases([benchmark for benchmark in BENCHMARKS
+                       if arguments.filter in benchmark.name])
+    results = run(functions)
+    baselines = {}
+    if os.path.exists(arguments.baselines):
+        with open(arguments.baselines, encoding="utf-8") as file:
+            baselines = json.load(file)
+
+    if arguments.save:
+        # Keep the baselines of the benchmarks which did not run
+        baselines.update(results)
+        with open(arguments.baselines, "w", encoding="utf-8") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(format_comparisons(compare(results, {}, 0, 0)))
+        return
+
+    comparisons = compare(results, baselines, arguments.time_threshold,
+                          arguments.memory_threshold)
+    # Measure regressions again, so a hiccup of the machine does not fail the run. The best
+    # time and allocation of all measurements are used.
+    for _ in range(arguments.retries):
+        suspects = [comparison["name"] for comparison in comparisons if comparison["regression"]]
+        if not suspects:
+            break
+        for name, result in run({name: functions[name] for name in suspects}).items():
+            results[name] = {key: min(value, results[name][key]) for key, value in result.items()}
+        comparisons = compare(results, baselines, arguments.time_threshold,
+                              arguments.memory_threshold)
+    print(format_comparisons(comparisons))
+    regressions = [comparison["name"] for comparison in comparisons if comparison["regression"]]
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+startup.py
+Cold start of the API: the time it takes to import app.main in a fresh interpreter, with the
+import time per module as reported by `python -X importtime`. The run fails when the import takes
+longer than the budget, or when a module which should only be imported on first use (S3 signing,
+the job queue) is imported at startup.
+
+Usage: python -m benchmarks.startup --help
+"""
+import argparse
+import os
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Dict, List
+
+# Modules which are only needed by a few endpoints, and are imported on first use
+LAZY_MODULES = ("boto3", "botocore", "celery", "kombu")
+# Imports app.main and prints how long that took
+IMPORT_SCRIPT = (
+    "import time; started = time.perf_counter(); import app.main; "
+    "print(time.perf_counter() - started)"
+)
+
+
+@dataclass
+class ModuleImport:
+    """
+    Import time of a module, in microseconds.
+    """
+    name: str
+    own: int
+    cumulative: int
+    depth: int
+
+
+@dataclass
+class Startup:
+    """
+    Measurement of a cold start.
+    """
+    duration: float
+    modules: List[ModuleImport]
+
+
+def parse_import_times(output: str) -> List[ModuleImport]:
+    """
+    Parse the output of -X importtime. Modules imported by another module are indented below it.
+    :param output:
+    :return:
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules.append(ModuleImport(name.strip(), int(own), int(cumulative),
+                                    (len(name) - len(name.lstrip())) // 2))
+    return modules
+
+
+def measure(environment: Dict[str, str]) -> Startup:
+    """
+    Import the application in a fresh interpreter.
+    :param environment:
+    :return:
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT],
+                             env=environment, capture_output=True, text=True, check=True)
+    return Startup(float(process.stdout.strip().splitlines()[-1]),
+                   parse_import_times(process.stderr))
+
+
+def package_times(modules: List[ModuleImport]) -> Dict[str, int]:
+    """
+    Sum the time of the modules per top-level package, in microseconds.
+    :param modules:
+    :return:
+    """
+    times: Dict[str, int] = {}
+    for module in modules:
+        package = module.name.split(".")[0]
+        times[package] = times.get(package, 0) + module.own
+    return times
+
+
+def format_report(startup: Startup, top: int) -> str:
+    """
+    Format the slowest packages and modules of a cold start.
+    :param startup:
+    :param top: Amount of packages and modules to show
+    :return:
+    """
+    lines = [f"Importing app.main took {startup.duration * 1000:.0f} ms", "",
+             f"{'package':40} {'ms':>8}"]
+    packages = sorted(package_times(startup.modules).items(), key=lambda item: -item[1])
+    lines.extend(f"{name:40} {time / 1000:8.1f}" for name, time in packages[:top])
+    lines.extend(["", f"{'module':60} {'self ms':>8} {'total ms':>9}"])
+    modules = sorted(startup.modules, key=lambda module: -module.cumulative)
+    lines.extend(f"{module.name:60} {module.own / 1000:8.1f} {module.cumulative / 1000:9.1f}"
+                 for module in modules[:top])
+    return "\n".join(lines)
+
+
+def main():
+    """
+    Measure the cold start from the command line.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--budget", type=float, default=1.5,
+                        help="Maximum time for importing app.main, in seconds (default: 1.5)")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Amount of cold starts; the fastest is reported (default: 5)")
+    parser.add_argument("--top", type=int, default=25,
+                        help="Amount of packages and modules to show (default: 25)")
+    arguments = parser.parse_args()
+
+    # Settings are read when the application is imported
+    environment = {"MONGO_CONNECTION": "mongodb://benchmark", "ES_HOST": "benchmark",
+                   **os.environ}
+    startup = min((measure(environment) for _ in range(arguments.runs)),
+                  key=lambda measurement: measurement.duration)
+    print(format_report(startup, arguments.top))
+
+    failures = []
+    if startup.duration > arguments.budget:
+        failures.append(f"importing app.main took {startup.duration:.2f} s, the budget is "
+                        f"{arguments.budget:.2f} s")
+    imported = {module.name.split(".")[0] for module in startup.modules}
+    failures.extend(f"{name} is imported at startup" for name in LAZY_MODULES if name in imported)
+    if failures:
+        print("\n" + "\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()